@@ -57,7 +57,10 @@ def run_migrations_offline() -> None:
 
 
 def do_run_migrations(connection: Connection) -> None:
-    context.configure(connection=connection, target_metadata=target_metadata)
+    # SQLite 不支持大部分 ALTER TABLE 操作；render_as_batch 只影响 autogenerate 生成的脚本（生成 batch_alter_table），
+    # 不会改变运行时手写的 op.alter_column / op.drop_column 等，手写迁移在 SQLite 上需自行使用 op.batch_alter_table
+    context.configure(connection=connection, target_metadata=target_metadata,
+                      render_as_batch=connection.dialect.name == "sqlite")
 
     with context.begin_transaction():
         context.run_migrations()
@@ -0,0 +1,178 @@
+import time
+from abc import ABC, abstractmethod
+from collections import deque
+from datetime import datetime, timedelta
+from enum import Enum
+
+from api.conf import Config
+from api.models.doc import AskLogDocument, AskCountBucketDocument
+from utils.common import SingletonMeta
+from utils.logger import get_logger
+
+logger = get_logger(__name__)
+config = Config()
+
+WINDOW_SECONDS = 3 * 60 * 60
+BUCKET_SECONDS = 60
+
+
+def get_model_family(model: str | Enum) -> str:
+    """
+    gpt_4, gpt_4o, gpt_4_browsing 等都归为 gpt_4
+    """
+    name = model.name if isinstance(model, Enum) else model
+    return "gpt_4" if name.startswith("gpt_4") else name
+
+
+class _SlidingWindowCounter:
+    """
+    按分钟分桶的滑动窗口计数，record() 和 count() 均摊 O(1)
+    """
+
+    def __init__(self):
+        self._buckets: deque[list[int]] = deque()  # [分桶起始时间, 计数]
+        self._total = 0
+
+    def _expire(self, now: float):
+        while self._buckets and self._buckets[0][0] <= now - WINDOW_SECONDS:
+            self._total -= self._buckets.popleft()[1]
+
+    def record(self, timestamp: float, count: int = 1):
+        bucket_start = int(timestamp) - int(timestamp) % BUCKET_SECONDS
+        # 时间早于最后一个分桶时（时钟回拨）计入最后一个分桶
+        if self._buckets and self._buckets[-1][0] >= bucket_start:
+            self._buckets[-1][1] += count
+        else:
+            self._buckets.append([bucket_start, count])
+        self._total += count
+
+    def count(self, now: float) -> int:
+        self._expire(now)
+        return self._total
+
+
+class AskCounterBackend(ABC):
+    @abstractmethod
+    async def record(self, source: str, model_family: str, timestamp: float, count: int):
+        pass
+
+    @abstractmethod
+    async def count(self, source: str, model_family: str, now: float) -> int:
+        pass
+
+    @abstractmethod
+    async def restore(self, buckets: dict[tuple[str, str, int], int]):
+        """
+        用从 ask_logs 统计出的各分桶次数恢复计数
+        """
+
+
+class InProcessAskCounterBackend(AskCounterBackend):
+    """
+    单 worker 部署使用，计数只保存在内存中
+    """
+
+    def __init__(self):
+        self._counters: dict[tuple[str, str], _SlidingWindowCounter] = {}
+
+    async def record(self, source: str, model_family: str, timestamp: float, count: int):
+        counter = self._counters.get((source, model_family))
+        if counter is None:
+            counter = self._counters[(source, model_family)] = _SlidingWindowCounter()
+        counter.record(timestamp, count)
+
+    async def count(self, source: str, model_family: str, now: float) -> int:
+        counter = self._counters.get((source, model_family))
+        return counter.count(now) if counter is not None else 0
+
+    async def restore(self, buckets: dict[tuple[str, str, int], int]):
+        self._counters.clear()
+        for (source, model_family, bucket), count in sorted(buckets.items(), key=lambda item: item[0][2]):
+            await self.record(source, model_family, bucket, count)
+
+
+class MongoAskCounterBackend(AskCounterBackend):
+    """
+    多 worker 部署使用，各 worker 的对话次数累加到 ask_count_buckets 集合中的同一分桶，过期的分桶由 TTL 索引删除
+    """
+
+    @staticmethod
+    def _bucket_id(source: str, model_family: str, bucket: int) -> str:
+        return f"{source}:{model_family}:{bucket}"
+
+    @staticmethod
+    def _bucket_fields(source: str, model_family: str, bucket: int) -> dict:
+        return {"source": source, "family": model_family, "bucket": bucket,
+                "expire_at": datetime.utcfromtimestamp(bucket + WINDOW_SECONDS + BUCKET_SECONDS)}
+
+    async def record(self, source: str, model_family: str, timestamp: float, count: int):
+        bucket = int(timestamp) - int(timestamp) % BUCKET_SECONDS
+        await AskCountBucketDocument.get_motor_collection().update_one(
+            {"_id": self._bucket_id(source, model_family, bucket)},
+            {"$inc": {"ask_count": count}, "$setOnInsert": self._bucket_fields(source, model_family, bucket)},
+            upsert=True
+        )
+
+    async def count(self, source: str, model_family: str, now: float) -> int:
+        pipeline = [
+            {"$match": {"source": source, "family": model_family, "bucket": {"$gt": now - WINDOW_SECONDS}}},
+            {"$group": {"_id": None, "count": {"$sum": "$ask_count"}}},
+        ]
+        async for item in AskCountBucketDocument.get_motor_collection().aggregate(pipeline):
+            return item["count"]
+        return 0
+
+    async def restore(self, buckets: dict[tuple[str, str, int], int]):
+        # 多个 worker 同时启动时都会恢复，使用 $max 保证结果不重复累加，也不会覆盖已记录的更大的计数
+        collection = AskCountBucketDocument.get_motor_collection()
+        for (source, model_family, bucket), count in buckets.items():
+            await collection.update_one(
+                {"_id": self._bucket_id(source, model_family, bucket)},
+                {"$max": {"ask_count": count}, "$setOnInsert": self._bucket_fields(source, model_family, bucket)},
+                upsert=True
+            )
+
+
+class AskCounter(metaclass=SingletonMeta):
+    """
+    最近 3 小时内各来源、各模型系列的对话次数，供 /status/common 使用
+    启动时从 ask_logs 重建一次，之后由 chat() 在记录 AskLogDocument 时更新
+    common.coordination_backend 为 mongodb 时计数由所有 worker 共享，否则只保存在本进程内存中
+    """
+
+    def __init__(self):
+        if config.common.coordination_backend == "mongodb":
+            self.backend: AskCounterBackend = MongoAskCounterBackend()
+        else:
+            self.backend = InProcessAskCounterBackend()
+
+    async def record(self, source: str | Enum, model: str | Enum, timestamp: float | None = None, count: int = 1):
+        source = source.value if isinstance(source, Enum) else source
+        await self.backend.record(source, get_model_family(model),
+                                  timestamp if timestamp is not None else time.time(), count)
+
+    async def count(self, source: str, model_family: str) -> int:
+        return await self.backend.count(source, model_family, time.time())
+
+    async def rebuild(self):
+        pipeline = [
+            {"$match": {"time": {"$gte": datetime.utcnow() - timedelta(seconds=WINDOW_SECONDS)}}},
+            {"$group": {
+                "_id": {
+                    "source": "$meta.source",
+                    "model": "$meta.model",
+                    "bucket": {"$subtract": [{"$toLong": "$time"},
+                                             {"$mod": [{"$toLong": "$time"}, BUCKET_SECONDS * 1000]}]}
+                },
+                "count": {"$sum": 1}
+            }},
+        ]
+        buckets: dict[tuple[str, str, int], int] = {}
+        total = 0
+        async for item in AskLogDocument.get_motor_collection().aggregate(pipeline):
+            key = item["_id"]
+            bucket_key = (key["source"], get_model_family(key["model"]), key["bucket"] // 1000)
+            buckets[bucket_key] = buckets.get(bucket_key, 0) + item["count"]
+            total += item["count"]
+        await self.backend.restore(buckets)
+        logger.info(f"Ask counter rebuilt from {total} ask logs in the last {WINDOW_SECONDS // 3600} hours.")
@@ -0,0 +1,113 @@
+from typing import Awaitable, Callable, Optional
+
+from sqlalchemy import select, update, and_
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from api.database.sqlalchemy import get_async_session_context
+from api.enums import ChatSourceTypes
+from api.models.db import UserAskQuota, TOTAL_ASK_COUNT_KEY
+from utils.logger import get_logger
+
+logger = get_logger(__name__)
+
+
+class AskQuotaExhaustedException(Exception):
+    def __init__(self, model: str):
+        super().__init__(f"no available ask count for {model}")
+        self.model = model  # TOTAL_ASK_COUNT_KEY 表示总次数用尽
+
+    @property
+    def is_total(self) -> bool:
+        return self.model == TOTAL_ASK_COUNT_KEY
+
+
+class AskQuotaReservation:
+    """
+    已预留的对话次数：提问成功后 commit()，否则 refund() 退回
+    """
+
+    def __init__(self, user_setting_id: int, source: ChatSourceTypes, models: list[str]):
+        self.user_setting_id = user_setting_id
+        self.source = source
+        self.models = models  # 实际扣减了的计数（不含不限次数的）
+        self._settled = False
+        self._refund_callbacks: list[Callable[[], Awaitable]] = []
+
+    def on_refund(self, callback: Callable[[], Awaitable]):
+        """
+        退回次数时一并撤销的其它记录，例如频率限制
+        """
+        self._refund_callbacks.append(callback)
+
+    def commit(self):
+        self._settled = True
+
+    async def refund(self):
+        if self._settled:
+            return
+        self._settled = True
+        for callback in self._refund_callbacks:
+            await callback()
+        if not self.models:
+            return
+        try:
+            async with get_async_session_context() as session:
+                await session.execute(
+                    update(UserAskQuota)
+                    .where(and_(UserAskQuota.user_setting_id == self.user_setting_id,
+                                UserAskQuota.source == self.source,
+                                UserAskQuota.model.in_(self.models),
+                                UserAskQuota.remaining != -1))
+                    .values(remaining=UserAskQuota.remaining + 1)
+                )
+                await session.commit()
+        except Exception as e:
+            logger.error(f"Failed to refund ask quota {self.models} of user setting {self.user_setting_id}: "
+                         f"{e.__class__.__name__} {e}")
+
+
+async def _reserve(session: AsyncSession, user_setting_id: int, source: ChatSourceTypes, model: str,
+                   remaining: Optional[dict[str, int]]) -> AskQuotaReservation:
+    models = [TOTAL_ASK_COUNT_KEY, model]
+    if remaining is None:
+        r = await session.execute(
+            select(UserAskQuota.model, UserAskQuota.remaining)
+            .where(and_(UserAskQuota.user_setting_id == user_setting_id,
+                        UserAskQuota.source == source,
+                        UserAskQuota.model.in_(models)))
+        )
+        remaining = dict(r.tuples().all())
+
+    reserved = []
+    for m in models:
+        if remaining.get(m, 0) == -1:
+            continue
+        r = await session.execute(
+            update(UserAskQuota)
+            .where(and_(UserAskQuota.user_setting_id == user_setting_id,
+                        UserAskQuota.source == source,
+                        UserAskQuota.model == m,
+                        UserAskQuota.remaining > 0))
+            .values(remaining=UserAskQuota.remaining - 1)
+        )
+        if r.rowcount != 1:
+            await session.rollback()
+            raise AskQuotaExhaustedException(m)
+        reserved.append(m)
+    await session.commit()
+    return AskQuotaReservation(user_setting_id, source, reserved)
+
+
+async def reserve_ask_quota(user_setting_id: int, source: ChatSourceTypes, model: str,
+                            session: Optional[AsyncSession] = None,
+                            remaining: Optional[dict[str, int]] = None) -> AskQuotaReservation:
+    """
+    在同一个事务中扣减总次数和模型次数，任一不足时都不扣减并抛出 AskQuotaExhaustedException
+    扣减使用带 remaining > 0 条件的 UPDATE，并发提问不会超额
+    :param session: 在已有的 session 中扣减并提交，为空时使用新的 session
+    :param remaining: 已读取的各项剩余次数，仅用于跳过不限次数的项；为空时先查询
+    """
+    if session is not None:
+        return await _reserve(session, user_setting_id, source, model, remaining)
+    async with get_async_session_context() as session:
+        return await _reserve(session, user_setting_id, source, model, remaining)
@@ -0,0 +1,221 @@
+import asyncio
+import json
+import uuid
+from typing import Any, Optional
+
+from fastapi.encoders import jsonable_encoder
+from pydantic import BaseModel
+from starlette.websockets import WebSocket
+
+from api.conf import Config
+from api.models.doc import BaseChatMessage
+from api.schemas import AskResponse, AskResponseType, AskMessageDelta
+
+config = Config()
+
+
+def _get_streaming_text(content: Optional[BaseModel]) -> Optional[str]:
+    if content is None:
+        return None
+    parts = getattr(content, "parts", None)
+    if parts and isinstance(parts[-1], str):
+        return parts[-1]
+    text = getattr(content, "text", None)
+    return text if isinstance(text, str) else None
+
+
+def _split_streaming_text(content: Optional[BaseModel]) -> tuple[Optional[str], Optional[BaseModel]]:
+    """
+    将 content 拆分为流式增长的正文和其余部分
+    openai_web 的正文为 parts 的最后一项（若为字符串），其余类型和 openai_api 为 text
+    """
+    if content is None:
+        return None, None
+    parts = getattr(content, "parts", None)
+    if parts and isinstance(parts[-1], str):
+        return parts[-1], content.model_copy(update={"parts": parts[:-1]})
+    text = getattr(content, "text", None)
+    if isinstance(text, str):
+        return text, content.model_copy(update={"text": None})
+    return None, content
+
+
+class AskMessageDeltaEncoder:
+    """
+    将每次收到的完整消息转换为 delta 帧，仅在以下情况发送完整消息：
+    - 第一帧，或消息 id 发生变化
+    - 正文不是在末尾追加（例如被改写）
+    - 距离上一次完整消息已经过了 ask_delta_snapshot_interval 帧
+    """
+
+    def __init__(self):
+        self.snapshot_interval = config.common.ask_delta_snapshot_interval
+        self._last_id: Optional[uuid.UUID] = None
+        self._last_text: Optional[str] = None
+        self._last_content_rest: Optional[BaseModel] = None
+        self._last_fields: dict[str, Any] = {}
+        self._frames_since_snapshot = 0
+
+    def _remember(self, message: BaseChatMessage, text: Optional[str], content_rest: Optional[BaseModel]):
+        # openai_api 会原地修改同一个消息对象，因此需要保存各字段的浅拷贝
+        self._last_id = message.id
+        self._last_text = text
+        self._last_content_rest = content_rest
+        self._last_fields = {
+            name: value.model_copy() if isinstance(value, BaseModel) else value
+            for name, value in message if name != "content"
+        }
+
+    def _diff(self, message: BaseChatMessage, text: Optional[str],
+              content_rest: Optional[BaseModel]) -> Optional[AskMessageDelta]:
+        """
+        返回 None 表示需要发送完整消息
+        """
+        changed = {}
+        for name, value in message:
+            if name != "content" and value != self._last_fields.get(name):
+                changed[name] = jsonable_encoder(value)
+
+        text_append = None
+        if content_rest != self._last_content_rest or (text is None) != (self._last_text is None):
+            changed["content"] = jsonable_encoder(message.content)
+        elif text is not None and text != self._last_text:
+            if not text.startswith(self._last_text):
+                return None
+            text_append = text[len(self._last_text):]
+
+        return AskMessageDelta(id=message.id, text_append=text_append, changed=changed or None)
+
+    def encode(self, conversation_id: uuid.UUID, message: BaseChatMessage) -> Optional[AskResponse]:
+        """
+        返回 None 表示消息没有变化，无需发送
+        """
+        text, content_rest = _split_streaming_text(message.content)
+
+        delta = None
+        if message.id == self._last_id and self._frames_since_snapshot < self.snapshot_interval:
+            delta = self._diff(message, text, content_rest)
+        self._remember(message, text, content_rest)
+
+        if delta is None:
+            self._frames_since_snapshot = 0
+            return AskResponse(type=AskResponseType.message, conversation_id=conversation_id, message=message)
+        if delta.text_append is None and delta.changed is None:
+            return None
+        self._frames_since_snapshot += 1
+        return AskResponse(type=AskResponseType.delta, conversation_id=conversation_id, delta=delta)
+
+
+class AskStreamStalledException(Exception):
+    pass
+
+
+class AskStreamSender:
+    """
+    单个 /chat 连接的输出级，将上游的每次更新合并后再发送给客户端
+
+    - put() 只记录每条消息的最新状态，不等待网络，因此内存占用不会随客户端变慢而增长
+    - 后台任务在 ask_stream_merge_window_ms 内合并更新，或在新增文本超过 ask_stream_merge_max_chars 时提前发送
+    - 客户端接收缓慢时，发送期间到达的中间状态会被合并，只发送最新状态
+    - 单帧发送超过 ask_stream_stall_timeout_seconds 时认为客户端已停滞，之后的 put() 抛出 AskStreamStalledException
+    """
+
+    def __init__(self, websocket: WebSocket, accept_delta: bool = False):
+        self.websocket = websocket
+        self.encoder = AskMessageDeltaEncoder() if accept_delta else None
+        self.merge_window = config.common.ask_stream_merge_window_ms / 1000
+        self.merge_max_chars = config.common.ask_stream_merge_max_chars
+        self.stall_timeout = config.common.ask_stream_stall_timeout_seconds
+
+        # message id -> (conversation_id, 最新消息, 合并的更新次数)
+        self._pending: dict[uuid.UUID, tuple[uuid.UUID, BaseChatMessage, int]] = {}
+        self._sent_text_length: dict[uuid.UUID, int] = {}
+        self._wakeup = asyncio.Event()
+        self._flush_now = asyncio.Event()
+        self._closing = False
+        self._error: Optional[Exception] = None
+        self._task = asyncio.create_task(self._run())
+
+        self.frames_sent = 0
+        self.frames_merged = 0
+        self.bytes_sent = 0
+        self.bytes_saved = 0  # 估算值：被合并的帧按合并后发送的帧的大小（delta 帧不计追加文本）计算
+
+    def put(self, conversation_id: uuid.UUID, message: BaseChatMessage):
+        if self._error is not None:
+            raise self._error
+        _, _, count = self._pending.get(message.id, (None, None, 0))
+        self._pending[message.id] = (conversation_id, message, count + 1)
+
+        text = _get_streaming_text(message.content)
+        if text is not None and len(text) - self._sent_text_length.get(message.id, 0) >= self.merge_max_chars:
+            self._flush_now.set()
+        self._wakeup.set()
+
+    async def _send(self, response: AskResponse) -> int:
+        text = json.dumps(jsonable_encoder(response), separators=(",", ":"), ensure_ascii=False)
+        try:
+            await asyncio.wait_for(self.websocket.send_text(text), timeout=self.stall_timeout)
+        except asyncio.TimeoutError:
+            raise AskStreamStalledException(f"client did not receive a frame in {self.stall_timeout}s")
+        return len(text.encode())
+
+    async def _flush(self):
+        pending, self._pending = self._pending, {}
+        for message_id, (conversation_id, message, count) in pending.items():
+            text = _get_streaming_text(message.content)
+            if self.encoder is not None:
+                response = self.encoder.encode(conversation_id, message)
+            else:
+                response = AskResponse(type=AskResponseType.message, conversation_id=conversation_id, message=message)
+            if response is None:
+                self.frames_merged += count
+                continue
+
+            size = await self._send(response)
+            self._sent_text_length[message_id] = len(text) if text is not None else 0
+            self.frames_sent += 1
+            self.frames_merged += count - 1
+            self.bytes_sent += size
+            overhead = size
+            if response.delta is not None and response.delta.text_append:
+                overhead -= len(response.delta.text_append.encode())
+            self.bytes_saved += (count - 1) * overhead
+
+    async def _run(self):
+        try:
+            while True:
+                await self._wakeup.wait()
+                if not self._closing and self.merge_window > 0:
+                    try:
+                        await asyncio.wait_for(self._flush_now.wait(), timeout=self.merge_window)
+                    except asyncio.TimeoutError:
+                        pass
+                self._wakeup.clear()
+                self._flush_now.clear()
+                await self._flush()
+                if self._closing and not self._pending:
+                    break
+        except Exception as e:
+            self._error = e
+
+    async def close(self):
+        """
+        发送剩余的更新并结束后台任务
+        发送失败时抛出后台任务遇到的异常，例如 ConnectionClosed 或 AskStreamStalledException
+        """
+        self._closing = True
+        self._wakeup.set()
+        self._flush_now.set()
+        if self._error is None:
+            await self._task
+        else:
+            self._task.cancel()
+        if self._error is not None:
+            raise self._error
+
+    def abort(self):
+        """
+        不再发送剩余的更新，直接结束后台任务；用于提问出错时的清理
+        """
+        self._task.cancel()
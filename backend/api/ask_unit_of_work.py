@@ -0,0 +1,61 @@
+from typing import Optional
+
+from sqlalchemy import select, func, and_
+from sqlalchemy.orm import aliased, joinedload
+
+from api.ask_quota import AskQuotaReservation, reserve_ask_quota
+from api.database.sqlalchemy import async_read_session_maker
+from api.models.db import User, UserSetting, BaseConversation
+from api.schemas import AskRequest
+
+
+class AskUnitOfWork:
+    """
+    一次提问开始前对 SQL 数据库的读写
+
+    - load(): 在只读 session 中用一条查询读取用户（含设置和剩余对话次数）、该对话类型下的有效对话数，以及要继续的对话
+    - reserve_ask_quota(): 只在写 session 中执行预留对话次数的 UPDATE 并立即提交；
+      检查限制期间（例如等待频率限制）不占用写连接，SQLite 下其它请求的写入不会因此排队
+    对话状态由 Coordinator 维护，不再写入数据库；提问结束后只需一个事务写入对话或退回次数
+    """
+
+    def __init__(self, user_id: int, ask_request: AskRequest):
+        self.user_id = user_id
+        self.ask_request = ask_request
+        self.user: Optional[User] = None
+        self.conversation: Optional[BaseConversation] = None
+        self.conv_count = 0
+
+    async def load(self) -> Optional[User]:
+        counted = aliased(BaseConversation)
+        conv_count = (
+            select(func.count(counted.id))
+            .where(and_(counted.user_id == User.id, counted.is_valid == True,
+                        counted.source == self.ask_request.source))
+            .correlate(User)
+            .scalar_subquery()
+        )
+        stmt = (
+            select(User, conv_count)
+            .where(User.id == self.user_id)
+            .options(joinedload(User.setting).joinedload(UserSetting.ask_quotas))
+        )
+        load_conversation = not self.ask_request.new_conversation and self.ask_request.conversation_id is not None
+        if load_conversation:
+            stmt = stmt.add_columns(BaseConversation).outerjoin(
+                BaseConversation, BaseConversation.conversation_id == str(self.ask_request.conversation_id))
+
+        async with async_read_session_maker() as session:
+            r = await session.execute(stmt)
+            row = r.unique().one_or_none()
+        if row is None:
+            return None
+        self.user, self.conv_count = row[0], row[1]
+        if load_conversation:
+            self.conversation = row[2]
+        return self.user
+
+    async def reserve_ask_quota(self) -> AskQuotaReservation:
+        source = self.ask_request.source
+        remaining = {quota.model: quota.remaining for quota in self.user.setting.ask_quotas if quota.source == source}
+        return await reserve_ask_quota(self.user.setting.id, source, self.ask_request.model, remaining=remaining)
@@ -1,6 +1,6 @@
 from typing import Optional
 
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
 
 from api.conf.base_config import BaseConfig
 from utils.common import SingletonMeta
@@ -8,10 +8,19 @@ from utils.common import SingletonMeta
 _TYPE_CHECKING = False
 
 
+class OpenaiWebAccountCredentials(BaseModel):
+    source_id: str = Field(..., description="Unique id of this account, saved as source_id of its conversations")
+    access_token: str
+    chatgpt_account_id: Optional[str] = Field(None, description="Set this for ChatGPT Team workspace accounts")
+    is_team: bool = False
+    max_completion_concurrency: int = Field(1, ge=1)
+
+
 class CredentialsModel(BaseModel):
     openai_web_access_token: Optional[str] = None
     # chatgpt_account_username: Optional[str] = None
     # chatgpt_account_password: Optional[str] = None
+    openai_web_extra_accounts: list[OpenaiWebAccountCredentials] = []
     openai_api_key: Optional[str] = None
 
 
@@ -20,6 +29,7 @@ class Credentials(BaseConfig[CredentialsModel], metaclass=SingletonMeta):
         openai_web_access_token: Optional[str]
         # chatgpt_account_username: Optional[str]
         # chatgpt_account_password: Optional[str]
+        openai_web_extra_accounts: list[OpenaiWebAccountCredentials]
         openai_api_key: Optional[str]
 
     def __init__(self, load_config: bool = True):
@@ -0,0 +1,183 @@
+import asyncio
+import time
+import uuid
+from collections import OrderedDict
+from datetime import datetime, timezone
+from typing import Optional
+
+from api.conf import Config
+from api.database.sqlalchemy import get_async_session_context
+from api.exceptions import OpenaiWebException
+from api.models.db import BaseConversation
+from api.models.doc import OpenaiWebConversationHistoryDocument
+from api.sources import OpenaiWebChatManager
+from utils.common import SingletonMeta
+from utils.logger import get_logger
+
+logger = get_logger(__name__)
+config = Config()
+
+
+def _as_utc(value: Optional[datetime]) -> Optional[datetime]:
+    # mongodb 中读出的时间不带时区
+    if value is not None and value.tzinfo is None:
+        return value.replace(tzinfo=timezone.utc)
+    return value
+
+
+class _CacheEntry:
+    def __init__(self, doc: OpenaiWebConversationHistoryDocument, validated_time: Optional[datetime]):
+        self.doc = doc
+        # 该历史记录已经与哪个时间点的 SQL update_time 对齐
+        self.validated_time = validated_time
+        self.validated_at = time.monotonic()
+
+
+class ConversationHistoryCache(metaclass=SingletonMeta):
+    """
+    openai_web 对话历史的读缓存（内存 LRU + mongodb），仅在 SQL 中记录的 update_time 前进时才需要从 ChatGPT 获取
+
+    - 缓存中的记录晚于 SQL update_time 时直接返回
+    - 记录落后于 SQL update_time、被标记为脏、或超过 conversation_history_revalidate_seconds 时，
+      仍先返回旧记录，同时在后台刷新（stale-while-revalidate）
+    - 没有任何缓存，或提问后被 expire 时同步从 ChatGPT 获取
+    - 同一对话同时只有一个刷新请求
+    """
+
+    def __init__(self):
+        self.max_size = config.openai_web.conversation_history_cache_size
+        self.revalidate_seconds = config.openai_web.conversation_history_revalidate_seconds
+        self._entries: OrderedDict[uuid.UUID, _CacheEntry] = OrderedDict()
+        self._dirty: set[uuid.UUID] = set()
+        # conversation_id -> expire 的时间，在此之后开始的刷新成功前，读取时都需要等待刷新
+        self._expired: dict[uuid.UUID, float] = {}
+        self._refreshing: dict[uuid.UUID, asyncio.Task] = {}
+        # 事件循环只持有任务的弱引用，后台任务需保留引用直到完成
+        self._tasks: set[asyncio.Task] = set()
+
+    def _put(self, conversation_id: uuid.UUID, entry: _CacheEntry):
+        if self.max_size <= 0:
+            return
+        self._entries[conversation_id] = entry
+        self._entries.move_to_end(conversation_id)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, conversation_id: uuid.UUID):
+        """
+        标记为脏：下次读取时先返回旧记录并在后台刷新
+        """
+        self._entries.pop(conversation_id, None)
+        self._dirty.add(conversation_id)
+
+    def expire(self, conversation_id: uuid.UUID):
+        """
+        丢弃缓存：对话有了新消息，下次读取时等待从 ChatGPT 获取，不再返回旧记录
+        """
+        self._entries.pop(conversation_id, None)
+        self._dirty.discard(conversation_id)
+        self._expired[conversation_id] = time.monotonic()
+
+    def remove(self, conversation_id: uuid.UUID):
+        self._entries.pop(conversation_id, None)
+        self._dirty.discard(conversation_id)
+        self._expired.pop(conversation_id, None)
+
+    async def get(self, conversation: BaseConversation) -> OpenaiWebConversationHistoryDocument:
+        conversation_id = conversation.conversation_id
+        sql_update_time = _as_utc(conversation.update_time)
+
+        if conversation_id in self._expired:
+            doc = await self.refresh(conversation)
+            if conversation_id in self._expired:
+                # 加入的是 expire 之前开始的刷新，需要重新获取
+                doc = await self.refresh(conversation)
+            return doc
+
+        entry = self._entries.get(conversation_id)
+        if entry is not None:
+            self._entries.move_to_end(conversation_id)
+        else:
+            doc = await OpenaiWebConversationHistoryDocument.get(conversation_id)
+            if doc is None:
+                return await self.refresh(conversation)
+            entry = _CacheEntry(doc, _as_utc(doc.update_time))
+            self._put(conversation_id, entry)
+
+        is_stale = conversation_id in self._dirty or \
+            sql_update_time is not None and (entry.validated_time is None or entry.validated_time < sql_update_time)
+        is_expired = self.revalidate_seconds > 0 and time.monotonic() - entry.validated_at > self.revalidate_seconds
+        if is_stale or is_expired:
+            self.revalidate(conversation)
+        return entry.doc
+
+    async def refresh(self, conversation: BaseConversation) -> OpenaiWebConversationHistoryDocument:
+        """
+        从 ChatGPT 获取最新的历史记录
+        """
+        task = self._refreshing.get(conversation.conversation_id)
+        if task is None:
+            task = asyncio.create_task(self._fetch(conversation))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+            self._refreshing[conversation.conversation_id] = task
+            task.add_done_callback(lambda _: self._refreshing.pop(conversation.conversation_id, None))
+        return await asyncio.shield(task)
+
+    def revalidate(self, conversation: BaseConversation):
+        """
+        在后台刷新，不等待结果
+        """
+        if conversation.conversation_id in self._refreshing:
+            return
+
+        async def _revalidate():
+            try:
+                await self.refresh(conversation)
+            except Exception as e:
+                logger.warning(f"revalidate conversation history {conversation.conversation_id} failed: "
+                               f"{e.__class__.__name__} {e}")
+
+        task = asyncio.create_task(_revalidate())
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _fetch(self, conversation: BaseConversation) -> OpenaiWebConversationHistoryDocument:
+        conversation_id = conversation.conversation_id
+        sql_update_time = _as_utc(conversation.update_time)
+        started_at = time.monotonic()
+        self._dirty.discard(conversation_id)
+        try:
+            doc = await OpenaiWebChatManager().get_conversation_history(conversation_id, conversation.source_id,
+                                                                        save=False)
+        except OpenaiWebException as e:
+            if e.code == 404 and conversation.is_valid:
+                async with get_async_session_context() as session:
+                    conv = await session.get(BaseConversation, conversation.id)
+                    conv.is_valid = False
+                    await session.commit()
+                self.remove(conversation_id)
+            raise e
+
+        # 没有变化时不写入 mongodb
+        entry = self._entries.get(conversation_id)
+        old_doc = entry.doc if entry is not None else await OpenaiWebConversationHistoryDocument.get(conversation_id)
+        if old_doc is None or _as_utc(old_doc.update_time) != _as_utc(doc.update_time) or \
+                old_doc.current_node != doc.current_node or old_doc.title != doc.title:
+            await doc.save()
+
+        if doc.current_model != conversation.current_model or not conversation.is_valid:
+            async with get_async_session_context() as session:
+                conv = await session.get(BaseConversation, conversation.id)
+                conv.current_model = doc.current_model
+                conv.is_valid = True
+                await session.commit()
+
+        validated_time = _as_utc(doc.update_time)
+        if sql_update_time is not None and (validated_time is None or validated_time < sql_update_time):
+            validated_time = sql_update_time
+        self._put(conversation_id, _CacheEntry(doc, validated_time))
+        expired_at = self._expired.get(conversation_id)
+        if expired_at is not None and expired_at <= started_at:
+            del self._expired[conversation_id]
+        return doc
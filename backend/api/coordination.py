@@ -0,0 +1,298 @@
+import asyncio
+import uuid
+from abc import ABC, abstractmethod
+from datetime import datetime, timedelta
+from typing import Optional
+
+from pymongo.errors import DuplicateKeyError
+
+from api.conf import Config
+from api.enums import OpenaiWebChatStatus
+from api.models.doc import CoordinationWorkerDocument, UserChatStatusDocument, AccountSlotDocument
+from utils.common import SingletonMeta
+from utils.logger import get_logger
+
+logger = get_logger(__name__)
+config = Config()
+
+WORKER_HEARTBEAT_INTERVAL_SECONDS = 10
+WORKER_LEASE_SECONDS = 30
+DEFAULT_ACCOUNT_SLOT_KEY = "default"
+
+
+def get_slot_key(source_id: Optional[str]) -> str:
+    return source_id if source_id is not None else DEFAULT_ACCOUNT_SLOT_KEY
+
+
+class CoordinationBackend(ABC):
+    """
+    多个 worker 之间需要一致的状态：用户的 OpenAI Web 对话状态，以及各 ChatGPT 账号正在使用的并发槽位
+    """
+
+    # 状态是否由多个 worker 共享；共享时其它 worker 释放槽位不会通知本进程，调度器需要轮询
+    shared = False
+
+    async def start(self):
+        pass
+
+    async def stop(self):
+        pass
+
+    @abstractmethod
+    async def get_chat_status(self, user_id: int) -> OpenaiWebChatStatus:
+        pass
+
+    @abstractmethod
+    async def get_chat_statuses(self) -> dict[int, OpenaiWebChatStatus]:
+        """
+        所有非空闲用户的对话状态
+        """
+
+    @abstractmethod
+    async def set_chat_status(self, user_id: int, status: OpenaiWebChatStatus):
+        pass
+
+    @abstractmethod
+    async def compare_and_set_chat_status(self, user_id: int, expected: OpenaiWebChatStatus,
+                                          status: OpenaiWebChatStatus) -> bool:
+        """
+        当前状态为 expected 时才设置为 status，返回是否设置成功
+        """
+
+    @abstractmethod
+    async def count_chat_status(self, status: OpenaiWebChatStatus) -> int:
+        pass
+
+    @abstractmethod
+    async def try_acquire_slot(self, slot_key: str, limit: int) -> bool:
+        """
+        账号已占用的槽位少于 limit 时占用一个，返回是否占用成功
+        """
+
+    @abstractmethod
+    async def release_slot(self, slot_key: str):
+        pass
+
+    @abstractmethod
+    async def get_slot_counts(self) -> dict[str, int]:
+        pass
+
+
+class InProcessCoordinationBackend(CoordinationBackend):
+    """
+    单 worker 部署使用，状态只保存在内存中，进程重启后所有用户都是空闲的
+    """
+
+    def __init__(self):
+        self._chat_statuses: dict[int, OpenaiWebChatStatus] = {}
+        self._slots: dict[str, int] = {}
+
+    async def get_chat_status(self, user_id: int) -> OpenaiWebChatStatus:
+        return self._chat_statuses.get(user_id, OpenaiWebChatStatus.idling)
+
+    async def get_chat_statuses(self) -> dict[int, OpenaiWebChatStatus]:
+        return dict(self._chat_statuses)
+
+    async def set_chat_status(self, user_id: int, status: OpenaiWebChatStatus):
+        if status == OpenaiWebChatStatus.idling:
+            self._chat_statuses.pop(user_id, None)
+        else:
+            self._chat_statuses[user_id] = status
+
+    async def compare_and_set_chat_status(self, user_id: int, expected: OpenaiWebChatStatus,
+                                          status: OpenaiWebChatStatus) -> bool:
+        if await self.get_chat_status(user_id) != expected:
+            return False
+        await self.set_chat_status(user_id, status)
+        return True
+
+    async def count_chat_status(self, status: OpenaiWebChatStatus) -> int:
+        return sum(1 for s in self._chat_statuses.values() if s == status)
+
+    async def try_acquire_slot(self, slot_key: str, limit: int) -> bool:
+        if self._slots.get(slot_key, 0) >= limit:
+            return False
+        self._slots[slot_key] = self._slots.get(slot_key, 0) + 1
+        return True
+
+    async def release_slot(self, slot_key: str):
+        if self._slots.get(slot_key, 0) > 0:
+            self._slots[slot_key] -= 1
+
+    async def get_slot_counts(self) -> dict[str, int]:
+        return dict(self._slots)
+
+
+class MongoCoordinationBackend(CoordinationBackend):
+    """
+    多 worker 部署使用，状态保存在 MongoDB 中，每条记录都带有写入它的 worker_id
+
+    每个 worker 定期续期自己在 coordination_workers 中的租约，并回收租约已过期的 worker 留下的对话状态和槽位，
+    因此某个 worker 异常退出后，其用户不会一直处于提问中，账号槽位也不会一直被占用
+    """
+
+    shared = True
+
+    def __init__(self):
+        self.worker_id = uuid.uuid4().hex
+        self._heartbeat_task: asyncio.Task | None = None
+
+    async def _heartbeat(self):
+        await CoordinationWorkerDocument.get_motor_collection().update_one(
+            {"_id": self.worker_id},
+            {"$set": {"expire_at": datetime.utcnow() + timedelta(seconds=WORKER_LEASE_SECONDS)}},
+            upsert=True
+        )
+
+    async def _reap(self):
+        live_workers = [doc["_id"] async for doc in CoordinationWorkerDocument.get_motor_collection().find(
+            {"expire_at": {"$gt": datetime.utcnow()}}, {"_id": 1})]
+        r = await UserChatStatusDocument.get_motor_collection().delete_many({"worker_id": {"$nin": live_workers}})
+        if r.deleted_count:
+            logger.info(f"Reset chat status of {r.deleted_count} users left by stopped workers.")
+        slots = AccountSlotDocument.get_motor_collection()
+        async for doc in slots.find({}):
+            for worker_id, count in (doc.get("workers") or {}).items():
+                if worker_id in live_workers:
+                    continue
+                # 带上 count 条件，避免与该 worker 的并发更新（理论上不存在）重复扣减
+                await slots.update_one({"_id": doc["_id"], f"workers.{worker_id}": count},
+                                       {"$inc": {"total": -count}, "$unset": {f"workers.{worker_id}": ""}})
+
+    async def _heartbeat_loop(self):
+        while True:
+            await asyncio.sleep(WORKER_HEARTBEAT_INTERVAL_SECONDS)
+            try:
+                await self._heartbeat()
+                await self._reap()
+            except Exception as e:
+                logger.warning(f"Coordination heartbeat failed: {e.__class__.__name__} {e}")
+
+    async def start(self):
+        await self._heartbeat()
+        await self._reap()
+        if self._heartbeat_task is None:
+            self._heartbeat_task = asyncio.create_task(self._heartbeat_loop())
+        logger.info(f"Coordination worker {self.worker_id} started.")
+
+    async def stop(self):
+        if self._heartbeat_task is not None:
+            self._heartbeat_task.cancel()
+            self._heartbeat_task = None
+        await CoordinationWorkerDocument.get_motor_collection().delete_one({"_id": self.worker_id})
+        await self._reap()
+
+    async def get_chat_status(self, user_id: int) -> OpenaiWebChatStatus:
+        doc = await UserChatStatusDocument.get_motor_collection().find_one({"_id": user_id}, {"status": 1})
+        return OpenaiWebChatStatus(doc["status"]) if doc is not None else OpenaiWebChatStatus.idling
+
+    async def get_chat_statuses(self) -> dict[int, OpenaiWebChatStatus]:
+        return {doc["_id"]: OpenaiWebChatStatus(doc["status"])
+                async for doc in UserChatStatusDocument.get_motor_collection().find({}, {"status": 1})}
+
+    def _status_doc(self, status: OpenaiWebChatStatus) -> dict:
+        return {"status": status.value, "worker_id": self.worker_id, "updated_at": datetime.utcnow()}
+
+    async def set_chat_status(self, user_id: int, status: OpenaiWebChatStatus):
+        collection = UserChatStatusDocument.get_motor_collection()
+        if status == OpenaiWebChatStatus.idling:
+            await collection.delete_one({"_id": user_id})
+        else:
+            await collection.update_one({"_id": user_id}, {"$set": self._status_doc(status)}, upsert=True)
+
+    async def compare_and_set_chat_status(self, user_id: int, expected: OpenaiWebChatStatus,
+                                          status: OpenaiWebChatStatus) -> bool:
+        collection = UserChatStatusDocument.get_motor_collection()
+        if expected == status:
+            return await self.get_chat_status(user_id) == expected
+        if expected == OpenaiWebChatStatus.idling:
+            # 空闲的用户没有记录，依靠 _id 唯一性保证只有一个 worker 能插入
+            try:
+                await collection.insert_one({"_id": user_id, **self._status_doc(status)})
+                return True
+            except DuplicateKeyError:
+                return False
+        if status == OpenaiWebChatStatus.idling:
+            r = await collection.delete_one({"_id": user_id, "status": expected.value})
+            return r.deleted_count == 1
+        r = await collection.update_one({"_id": user_id, "status": expected.value}, {"$set": self._status_doc(status)})
+        return r.matched_count == 1
+
+    async def count_chat_status(self, status: OpenaiWebChatStatus) -> int:
+        return await UserChatStatusDocument.get_motor_collection().count_documents({"status": status.value})
+
+    async def try_acquire_slot(self, slot_key: str, limit: int) -> bool:
+        # 槽位已满时过滤条件不匹配，upsert 会因为 _id 重复而失败
+        try:
+            await AccountSlotDocument.get_motor_collection().update_one(
+                {"_id": slot_key, "total": {"$lt": limit}},
+                {"$inc": {"total": 1, f"workers.{self.worker_id}": 1}},
+                upsert=True
+            )
+            return True
+        except DuplicateKeyError:
+            return False
+
+    async def release_slot(self, slot_key: str):
+        await AccountSlotDocument.get_motor_collection().update_one(
+            {"_id": slot_key, f"workers.{self.worker_id}": {"$gt": 0}},
+            {"$inc": {"total": -1, f"workers.{self.worker_id}": -1}}
+        )
+
+    async def get_slot_counts(self) -> dict[str, int]:
+        return {doc["_id"]: doc.get("total", 0)
+                async for doc in AccountSlotDocument.get_motor_collection().find({}, {"total": 1})}
+
+
+class Coordinator(metaclass=SingletonMeta):
+    """
+    根据 common.coordination_backend 选择的协调状态后端
+    """
+
+    def __init__(self):
+        if config.common.coordination_backend == "mongodb":
+            self.backend: CoordinationBackend = MongoCoordinationBackend()
+        else:
+            self.backend = InProcessCoordinationBackend()
+
+    @property
+    def shared(self) -> bool:
+        return self.backend.shared
+
+    async def start(self):
+        await self.backend.start()
+
+    async def stop(self):
+        try:
+            await self.backend.stop()
+        except Exception as e:
+            logger.warning(f"Failed to stop coordination backend: {e.__class__.__name__} {e}")
+
+    async def get_chat_status(self, user_id: int) -> OpenaiWebChatStatus:
+        return await self.backend.get_chat_status(user_id)
+
+    async def get_chat_statuses(self) -> dict[int, OpenaiWebChatStatus]:
+        return await self.backend.get_chat_statuses()
+
+    async def set_chat_status(self, user_id: int, status: OpenaiWebChatStatus):
+        await self.backend.set_chat_status(user_id, status)
+
+    async def compare_and_set_chat_status(self, user_id: int, expected: OpenaiWebChatStatus,
+                                          status: OpenaiWebChatStatus) -> bool:
+        return await self.backend.compare_and_set_chat_status(user_id, expected, status)
+
+    async def count_chat_status(self, status: OpenaiWebChatStatus) -> int:
+        return await self.backend.count_chat_status(status)
+
+    async def try_acquire_slot(self, source_id: Optional[str], limit: int) -> bool:
+        return await self.backend.try_acquire_slot(get_slot_key(source_id), limit)
+
+    async def release_slot(self, source_id: Optional[str]):
+        await self.backend.release_slot(get_slot_key(source_id))
+
+    async def get_slot_counts(self) -> dict[Optional[str], int]:
+        """
+        :return: source_id -> 已占用的槽位数，默认账号的 source_id 为 None
+        """
+        counts = await self.backend.get_slot_counts()
+        return {(None if key == DEFAULT_ACCOUNT_SLOT_KEY else key): count for key, count in counts.items()}
@@ -0,0 +1,93 @@
+import asyncio
+from collections import deque
+from typing import Type
+
+from beanie import Document
+
+from api.conf import Config
+from api.stats_rollup import rollup_logs
+from utils.common import SingletonMeta
+from utils.logger import get_logger
+
+logger = get_logger(__name__)
+config = Config()
+
+
+class LogSink(metaclass=SingletonMeta):
+    """
+    日志文档（RequestLogDocument, AskLogDocument）的进程内缓冲写入器
+
+    - put() 只写入内存中的环形缓冲区，不等待 MongoDB
+    - 每累计 log_flush_size 条或每隔 log_flush_interval_ms 毫秒，按文档类型批量 insert_many
+    - 缓冲区超过 3/4 时，可丢弃的日志（请求日志）只按 1/request_log_overload_sample_rate 采样保留；
+      缓冲区满时丢弃最旧的日志
+    - 写入成功后将日志累加到统计汇总（api.stats_rollup）中
+    - stop() 在关闭时写入剩余的全部日志
+    """
+
+    def __init__(self):
+        self.buffer_size = config.stats.log_buffer_size
+        self.flush_size = config.stats.log_flush_size
+        self.flush_interval = config.stats.log_flush_interval_ms / 1000
+        self.overload_sample_rate = config.stats.request_log_overload_sample_rate
+        self._buffer: deque[Document] = deque(maxlen=self.buffer_size)
+        self._flush_event = asyncio.Event()
+        self._flush_task: asyncio.Task | None = None
+        self._stopping = False
+        self._sample_counter = 0
+        self.dropped_count = 0
+
+    def put(self, doc: Document, droppable: bool = True):
+        if droppable and len(self._buffer) >= self.buffer_size * 3 // 4:
+            self._sample_counter += 1
+            if self._sample_counter % self.overload_sample_rate != 0:
+                self.dropped_count += 1
+                return
+        if len(self._buffer) == self.buffer_size:
+            self.dropped_count += 1
+        self._buffer.append(doc)
+        if len(self._buffer) >= self.flush_size:
+            self._flush_event.set()
+
+    async def flush(self):
+        while self._buffer:
+            batch: dict[Type[Document], list[Document]] = {}
+            for _ in range(min(len(self._buffer), self.flush_size)):
+                doc = self._buffer.popleft()
+                batch.setdefault(type(doc), []).append(doc)
+            for doc_type, docs in batch.items():
+                try:
+                    await doc_type.insert_many(docs)
+                except Exception as e:
+                    logger.error(f"Failed to write {len(docs)} {doc_type.__name__}: {e.__class__.__name__} {e}")
+                    continue
+                try:
+                    await rollup_logs(docs)
+                except Exception as e:
+                    logger.error(f"Failed to update stats rollup of {len(docs)} {doc_type.__name__}: "
+                                 f"{e.__class__.__name__} {e}")
+        if self.dropped_count:
+            logger.warning(f"Log buffer overloaded, {self.dropped_count} logs dropped")
+            self.dropped_count = 0
+
+    async def _flush_loop(self):
+        while not self._stopping:
+            try:
+                await asyncio.wait_for(self._flush_event.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._flush_event.clear()
+            await self.flush()
+
+    def start(self):
+        if self._flush_task is None:
+            self._flush_task = asyncio.create_task(self._flush_loop())
+
+    async def stop(self):
+        self._stopping = True
+        if self._flush_task is not None:
+            self._flush_event.set()
+            await self._flush_task
+            self._flush_task = None
+        await self.flush()
+        logger.info("Log sink drained.")
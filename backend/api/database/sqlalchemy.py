@@ -0,0 +1,204 @@
+import contextlib
+from contextvars import ContextVar
+from typing import AsyncGenerator, Optional
+
+from fastapi import Depends
+import sqlalchemy
+from sqlalchemy import text, event
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine, AsyncConnection
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+from fastapi_users_db_sqlalchemy import SQLAlchemyUserDatabase
+
+from alembic.config import Config as AlembicConfig
+from alembic import command
+
+from api.conf import Config
+from api.models.db import Base, User
+
+from utils.logger import get_logger
+
+import json
+import pydantic.json
+
+
+def _custom_json_serializer(*args, **kwargs) -> str:
+    """
+    Encodes json in the same way that pydantic does.
+    """
+    return json.dumps(*args, default=pydantic.json.pydantic_encoder, **kwargs)
+
+
+logger = get_logger(__name__)
+config = Config()
+
+database_url = config.data.database_url
+is_sqlite = database_url.startswith("sqlite")
+pool_options = dict(pool_size=config.data.database_pool_size, max_overflow=config.data.database_max_overflow)
+
+
+def _create_engine(**kwargs):
+    return create_async_engine(database_url, echo=config.common.print_sql, json_serializer=_custom_json_serializer,
+                               **kwargs)
+
+
+if is_sqlite:
+    # SQLite 同一时间只允许一个写事务，多个连接并发写入时会互相等待直至 "database is locked"
+    # 因此所有读写 session 共用一个连接，在进程内排队串行执行；只读查询使用单独的只读连接池，WAL 模式下读写互不阻塞
+    # aiosqlite 默认不复用连接（NullPool），这里显式使用连接池，连接上的 PRAGMA 设置也因此只需执行一次
+    engine = _create_engine(poolclass=AsyncAdaptedQueuePool, pool_size=1, max_overflow=0)
+    read_engine = _create_engine(poolclass=AsyncAdaptedQueuePool, **pool_options)
+else:
+    # PostgreSQL 在取出连接时检查连接是否已断开
+    engine = _create_engine(**pool_options, pool_pre_ping=True)
+    read_engine = engine
+async_session_maker = sessionmaker(engine, class_=AsyncSession, expire_on_commit=False)
+async_read_session_maker = sessionmaker(read_engine, class_=AsyncSession, expire_on_commit=False)
+metadata = sqlalchemy.MetaData()
+alembic_cfg = AlembicConfig("alembic.ini")
+alembic_cfg.set_main_option("sqlalchemy.url", database_url)
+
+
+def _set_sqlite_pragmas(dbapi_connection, query_only: bool):
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    # WAL 模式下 NORMAL 不会损坏数据库，只可能在断电时丢失最近提交的事务
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute(f"PRAGMA busy_timeout={config.data.sqlite_busy_timeout_ms}")
+    cursor.execute(f"PRAGMA mmap_size={config.data.sqlite_mmap_size}")
+    if query_only:
+        cursor.execute("PRAGMA query_only=ON")
+    cursor.close()
+
+
+if is_sqlite:
+    event.listen(engine.sync_engine, "connect", lambda conn, record: _set_sqlite_pragmas(conn, query_only=False))
+    event.listen(read_engine.sync_engine, "connect", lambda conn, record: _set_sqlite_pragmas(conn, query_only=True))
+
+
+class SqlQueryCounter:
+    def __init__(self):
+        self.count = 0
+
+
+_sql_query_counter: ContextVar[Optional[SqlQueryCounter]] = ContextVar("sql_query_counter", default=None)
+
+
+def _count_sql_query(conn, cursor, statement, parameters, context, executemany):
+    counter = _sql_query_counter.get()
+    if counter is not None:
+        counter.count += 1
+
+
+event.listen(engine.sync_engine, "before_cursor_execute", _count_sql_query)
+if is_sqlite:
+    event.listen(read_engine.sync_engine, "before_cursor_execute", _count_sql_query)
+
+
+@contextlib.contextmanager
+def count_sql_queries():
+    """
+    统计当前上下文（一次请求或一次提问）中执行的 SQL 语句数
+
+        with count_sql_queries() as counter:
+            ...
+        print(counter.count)
+    """
+    counter = SqlQueryCounter()
+    token = _sql_query_counter.set(counter)
+    try:
+        yield counter
+    finally:
+        _sql_query_counter.reset(token)
+
+
+def run_upgrade(conn, cfg):
+    cfg.attributes["connection"] = conn
+    command.upgrade(cfg, "head")
+    conn.commit()
+
+
+def run_stamp(conn, cfg, revision):
+    cfg.attributes["connection"] = conn
+    command.stamp(cfg, revision)
+    conn.commit()
+
+
+def run_ensure_version(conn, cfg):
+    cfg.attributes["connection"] = conn
+    command.ensure_version(cfg)
+    conn.commit()
+
+
+async def initialize_db():
+    # 如果数据库不存在则创建数据库（数据表）；若有更新，则执行迁移
+    # https://alembic.sqlalchemy.org/en/latest/autogenerate.html
+    async with engine.connect() as conn:
+        # 判断数据库是否存在
+        def user_inspector(conn):
+            inspector = sqlalchemy.inspect(conn)
+            return inspector.has_table("user")
+
+        result = await conn.run_sync(user_inspector)
+
+        if not result:
+            logger.info("database not exists, creating database...")
+            await conn.run_sync(Base.metadata.create_all)
+            logger.info("database created!")
+            await conn.run_sync(run_stamp, alembic_cfg, "head")
+            logger.info(f"stamped database to head")
+            return
+
+        is_alembic_empty = await check_alembic_version_empty(conn)
+        if is_alembic_empty:
+            await conn.run_sync(run_stamp, alembic_cfg, "aa3d85891014")
+            logger.warning(
+                f"Alembic version table is empty, stamped database to baseline(aa3d85891014)!\n"
+                "        Note: This is necessary to update from old version. If you see this message, ensure that you have "
+                "already set run_migration to true in config file,\n"
+                "              or run `alembic upgrade head` manually."
+            )
+
+        if config.data.run_migration:
+            try:
+                logger.info("try to migrate database...")
+                await conn.run_sync(run_upgrade, alembic_cfg)
+            except Exception as e:
+                logger.warning("Database migration might fail, please check the database manually!")
+                logger.warning(f"detail: {str(e)}")
+
+        logger.info("Database initialized.")
+
+
+async def check_alembic_version_empty(conn: AsyncConnection):
+    try:
+        result = (await conn.execute(text("SELECT version_num FROM alembic_version"))).fetchall()
+        return len(result) == 0
+    except Exception as e:
+        logger.warning(f"check alembic version failed: {str(e)}")
+        raise e
+
+
+async def get_async_session() -> AsyncGenerator[AsyncSession, None]:
+    async with async_session_maker() as session:
+        yield session
+
+
+async def get_async_read_session() -> AsyncGenerator[AsyncSession, None]:
+    """
+    只读 session，不能用于写入；使用 SQLite 时不会占用写入连接
+    """
+    async with async_read_session_maker() as session:
+        yield session
+
+
+async def get_user_db(session: AsyncSession = Depends(get_async_read_session)):
+    # 该 session 会在整个请求期间保持打开，只用于读取当前用户；UserManager 的写入使用各自的 session
+    yield SQLAlchemyUserDatabase(session, User)
+
+
+# 使得 get_async_session_context 和 get_user_db_context 可以使用async with语法
+
+get_async_session_context = contextlib.asynccontextmanager(get_async_session)
+get_async_read_session_context = contextlib.asynccontextmanager(get_async_read_session)
+get_user_db_context = contextlib.asynccontextmanager(get_user_db)
@@ -8,33 +8,53 @@ class ChatSourceTypes(StrEnum):
     openai_api = auto()
 
 
-def get_model_code_mapping(source_cls):
-    from api.conf import Config
+# 模型类 -> (模型名 -> code, code -> 模型)
+# 配置加载或更新时整体替换，读取时不加锁
+_model_code_index: dict[type, tuple[dict[str, str], dict[str, "BaseChatModelEnum"]]] = {}
 
-    cls_to_source = {
-        "OpenaiWebChatModels": ChatSourceTypes.openai_web,
-        "OpenaiApiChatModels": ChatSourceTypes.openai_api,
-    }
-    source = cls_to_source.get(source_cls.__name__, None)
-    source_model_code_mapping = {
-        "openai_web": Config().openai_web.model_code_mapping,
-        "openai_api": Config().openai_api.model_code_mapping,
-    }
-    return source_model_code_mapping[source]
+
+def rebuild_model_code_index(config_model):
+    """
+    根据 ConfigModel 中的 model_code_mapping 重建模型和 code 的双向索引
+    多个模型对应同一个 code 时，from_code 返回先出现的模型
+    """
+    global _model_code_index
+    index = {}
+    for model_cls, mapping in ((OpenaiWebChatModels, config_model.openai_web.model_code_mapping),
+                               (OpenaiApiChatModels, config_model.openai_api.model_code_mapping)):
+        code_by_name = {}
+        model_by_code = {}
+        for model, code in mapping.items():
+            model = model_cls(model)
+            code_by_name[model.name] = code
+            model_by_code.setdefault(code, model)
+        index[model_cls] = (code_by_name, model_by_code)
+    _model_code_index = index
+
+
+def _get_model_code_index(source_cls):
+    index = _model_code_index.get(source_cls)
+    if index is None:
+        from api.conf import Config
+
+        rebuild_model_code_index(Config())
+        index = _model_code_index[source_cls]
+    return index
+
+
+def get_model_code_mapping(source_cls) -> dict[str, str]:
+    return _get_model_code_index(source_cls)[0]
 
 
 class BaseChatModelEnum(StrEnum):
     def code(self):
-        result = get_model_code_mapping(self.__class__).get(self.name, None)
+        result = _get_model_code_index(self.__class__)[0].get(self.name)
         assert result, f"model name not found: {self.name}"
         return result
 
     @classmethod
     def from_code(cls, code: str):
-        for name, value in get_model_code_mapping(cls).items():
-            if value == code:
-                return cls[name]
-        return None
+        return _get_model_code_index(cls)[1].get(code)
 
 
 class OpenaiWebChatModels(BaseChatModelEnum):
@@ -12,6 +12,7 @@ from sqlalchemy import select
 from sqlalchemy.ext.asyncio import AsyncSession
 
 from api.conf import Config
+from api.database.sqlalchemy import get_async_session_context
 from api.models.db import UploadedFileInfo
 from api.models.json import UploadedFileExtraInfo
 
@@ -25,7 +26,7 @@ class FileProvider:
         if not self.storage_dir.exists():
             self.storage_dir.mkdir()
 
-    async def save_file(self, file: UploadFile, user_id: int, session: AsyncSession) -> UploadedFileInfo:
+    async def save_file(self, file: UploadFile, user_id: int) -> UploadedFileInfo:
         file_name = f"{uuid.uuid4()}.dat"
         file_dir_path = self.storage_dir / f"{user_id}"
         file_path = file_dir_path / file_name
@@ -57,8 +58,10 @@ class FileProvider:
             upload_time=datetime.now().astimezone(tz=timezone.utc),
             extra_info=UploadedFileExtraInfo(width=width, height=height)
         )
-        session.add(file_info)
-        await session.commit()
+        # 文件写入完成后才打开写 session，写入期间不占用数据库连接
+        async with get_async_session_context() as session:
+            session.add(file_info)
+            await session.commit()
 
         return file_info
 
@@ -1,3 +1,5 @@
 server_log_filename = None
 
 startup_time = None
+
+sync_conversations_task = None
@@ -1,4 +1,3 @@
-import json
 import re
 import time
 from typing import Optional
@@ -7,6 +6,8 @@ from asgiref.typing import ASGI3Application, HTTPScope, ASGIReceiveCallable, ASG
 from fastapi.routing import APIRoute
 
 import api.globals as g
+from api.database.log_sink import LogSink
+from api.database.sqlalchemy import count_sql_queries
 from api.models.doc import RequestLogDocument, RequestLogMeta
 
 from utils.logger import get_logger
@@ -32,28 +33,18 @@ class StatisticsMiddleware:
             return await self.app(scope, receive, send)
 
         raw_status_code = None
-        body_code = None
 
-        async def send_with_inspecting_body(message):
-            """用于记录状态码"""
-            nonlocal raw_status_code, body_code
+        async def send_with_status_code(message):
+            """用于记录状态码；CustomJSONResponse 中的 code 由其写入 scope["response_code"]"""
+            nonlocal raw_status_code
             if message["type"] == "http.response.start":
                 raw_status_code = message.get("status", None)
-            elif message["type"] == "http.response.body":
-                body = message.get("body", None)  # byte string
-                if body is not None:
-                    body = body.decode("utf-8")
-                    try:
-                        body = json.loads(body)
-                        body_code = body.get("code", None)
-                    except json.JSONDecodeError:
-                        pass
-
             await send(message)
 
         start_time = time.time()
 
-        await self.app(scope, receive, send_with_inspecting_body)
+        with count_sql_queries() as sql_counter:
+            await self.app(scope, receive, send_with_status_code)
 
         end_time = time.time()
 
@@ -82,9 +73,10 @@ class StatisticsMiddleware:
         elapsed_ms = end_time - start_time
         elapsed_ms = round(elapsed_ms * 1000, 2)
 
-        await RequestLogDocument(
+        LogSink().put(RequestLogDocument(
             meta=RequestLogMeta(route_path=route.path, method=method),
             user_id=user_id,
             elapsed_ms=elapsed_ms,
-            status=body_code or raw_status_code or scope.get("ask_websocket_close_code", None),
-        ).create()
+            sql_query_count=sql_counter.count,
+            status=scope.get("response_code", None) or raw_status_code or scope.get("ask_websocket_close_code", None),
+        ))
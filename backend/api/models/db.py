@@ -3,7 +3,7 @@ from datetime import datetime
 from typing import List, Optional
 
 from fastapi_users_db_sqlalchemy import Integer
-from sqlalchemy import String, Enum, Boolean, ForeignKey, func, Float
+from sqlalchemy import String, Enum, Boolean, ForeignKey, func, Float, UniqueConstraint, Index
 from sqlalchemy.orm import relationship, DeclarativeBase, Mapped, mapped_column
 
 from api.database.custom_types import Pydantic, UTCDateTime, GUID
@@ -26,7 +26,8 @@ class User(Base):
     email: Mapped[str]
     # openai_web_chat_status: Mapped[WebChatStatus] = mapped_column(Enum(WebChatStatus), default=WebChatStatus.idling,
     #                                                               comment="对话状态")
-    last_active_time: Mapped[Optional[datetime]] = mapped_column(UTCDateTime(timezone=True), comment="最后活跃时间")
+    last_active_time: Mapped[Optional[datetime]] = mapped_column(UTCDateTime(timezone=True), index=True,
+                                                                 comment="最后活跃时间")
     create_time: Mapped[datetime] = mapped_column(UTCDateTime(timezone=True),
                                                   server_default=func.now(), comment="创建时间")
     avatar: Mapped[Optional[str]] = mapped_column(comment="头像")
@@ -48,14 +49,88 @@ class UserSetting(Base):
     __tablename__ = "user_setting"
 
     id: Mapped[int] = mapped_column(Integer, primary_key=True)
-    user_id: Mapped[int] = mapped_column(ForeignKey("user.id"), comment="用户id")
+    user_id: Mapped[int] = mapped_column(ForeignKey("user.id"), index=True, comment="用户id")
     user: Mapped[User] = relationship("User", back_populates="setting", lazy="joined")
     credits: Mapped[float] = mapped_column(Float, default=0, comment="积分")
+    # 对话状态已由 api.coordination.Coordinator 维护，该列不再更新
     openai_web_chat_status: Mapped[OpenaiWebChatStatus] = mapped_column(Enum(OpenaiWebChatStatus),
                                                                         default=OpenaiWebChatStatus.idling,
                                                                         comment="对话状态")
-    openai_web: Mapped[OpenaiWebSourceSettingSchema] = mapped_column(Pydantic(OpenaiWebSourceSettingSchema))
-    openai_api: Mapped[OpenaiApiSourceSettingSchema] = mapped_column(Pydantic(OpenaiApiSourceSettingSchema))
+    # total_ask_count 和 per_model_ask_count 以 ask_quotas 为准，JSON 中的值仅为最后一次设置时的值
+    _openai_web: Mapped[OpenaiWebSourceSettingSchema] = mapped_column("openai_web",
+                                                                      Pydantic(OpenaiWebSourceSettingSchema))
+    _openai_api: Mapped[OpenaiApiSourceSettingSchema] = mapped_column("openai_api",
+                                                                      Pydantic(OpenaiApiSourceSettingSchema))
+    ask_quotas: Mapped[List["UserAskQuota"]] = relationship("UserAskQuota", back_populates="user_setting",
+                                                            lazy="selectin", cascade="all, delete-orphan")
+
+    def _get_source_setting(self, source: ChatSourceTypes, setting):
+        if setting is None:
+            return None
+        quotas = {quota.model: quota.remaining for quota in self.ask_quotas if quota.source == source}
+        if not quotas:
+            return setting
+        per_model_ask_count = dict(setting.per_model_ask_count.root)
+        for model, remaining in quotas.items():
+            if model != TOTAL_ASK_COUNT_KEY:
+                per_model_ask_count[model] = remaining
+        return setting.model_copy(update={
+            "total_ask_count": quotas.get(TOTAL_ASK_COUNT_KEY, setting.total_ask_count),
+            "per_model_ask_count": type(setting.per_model_ask_count)(root=per_model_ask_count),
+        })
+
+    def _set_ask_quotas(self, source: ChatSourceTypes, setting):
+        remainings = {TOTAL_ASK_COUNT_KEY: setting.total_ask_count, **setting.per_model_ask_count.root}
+        quotas = {quota.model: quota for quota in self.ask_quotas if quota.source == source}
+        # 不再设置次数的模型视为 0 次，删除其记录（delete-orphan）
+        for model, quota in quotas.items():
+            if model not in remainings:
+                self.ask_quotas.remove(quota)
+        for model, remaining in remainings.items():
+            quota = quotas.get(model)
+            if quota is None:
+                self.ask_quotas.append(UserAskQuota(source=source, model=model, remaining=remaining))
+            elif quota.remaining != remaining:
+                quota.remaining = remaining
+
+    @property
+    def openai_web(self) -> OpenaiWebSourceSettingSchema:
+        return self._get_source_setting(ChatSourceTypes.openai_web, self._openai_web)
+
+    @openai_web.setter
+    def openai_web(self, value: OpenaiWebSourceSettingSchema | dict):
+        value = OpenaiWebSourceSettingSchema.model_validate(value)
+        self._set_ask_quotas(ChatSourceTypes.openai_web, value)
+        self._openai_web = value
+
+    @property
+    def openai_api(self) -> OpenaiApiSourceSettingSchema:
+        return self._get_source_setting(ChatSourceTypes.openai_api, self._openai_api)
+
+    @openai_api.setter
+    def openai_api(self, value: OpenaiApiSourceSettingSchema | dict):
+        value = OpenaiApiSourceSettingSchema.model_validate(value)
+        self._set_ask_quotas(ChatSourceTypes.openai_api, value)
+        self._openai_api = value
+
+
+TOTAL_ASK_COUNT_KEY = "total"
+
+
+class UserAskQuota(Base):
+    """
+    剩余对话次数，-1 表示不限制；model 为 TOTAL_ASK_COUNT_KEY 时表示该来源的总次数
+    提问前由 api.ask_quota 原子地预留（扣减）一次，提问失败时退回
+    """
+    __tablename__ = "user_ask_quota"
+    __table_args__ = (UniqueConstraint("user_setting_id", "source", "model"),)
+
+    id: Mapped[int] = mapped_column(Integer, primary_key=True)
+    user_setting_id: Mapped[int] = mapped_column(ForeignKey("user_setting.id"), comment="用户设置id")
+    user_setting: Mapped[UserSetting] = relationship("UserSetting", back_populates="ask_quotas")
+    source: Mapped[ChatSourceTypes] = mapped_column(Enum(ChatSourceTypes), comment="对话类型")
+    model: Mapped[str] = mapped_column(String(64), comment="模型")
+    remaining: Mapped[int] = mapped_column(Integer, comment="剩余次数")
 
 
 class BaseConversation(Base):
@@ -65,6 +140,8 @@ class BaseConversation(Base):
     """
 
     __tablename__ = "conversation"
+    # 对话列表按 update_time、id 分页；用户的对话列表使用联合索引，管理员的全部对话列表使用 update_time 索引
+    __table_args__ = (Index("ix_conversation_user_id_is_valid_update_time", "user_id", "is_valid", "update_time"),)
     __mapper_args__ = {
         "polymorphic_on": "source",
         "polymorphic_identity": "base",
@@ -80,7 +157,8 @@ class BaseConversation(Base):
     user: Mapped["User"] = relationship(back_populates="conversations")
     is_valid: Mapped[bool] = mapped_column(Boolean, comment="是否有效")
     create_time: Mapped[Optional[datetime]] = mapped_column(UTCDateTime(timezone=True), comment="创建时间")
-    update_time: Mapped[Optional[datetime]] = mapped_column(UTCDateTime(timezone=True), comment="最后更新时间")
+    update_time: Mapped[Optional[datetime]] = mapped_column(UTCDateTime(timezone=True), index=True,
+                                                            comment="最后更新时间")
 
 
 class OpenaiWebConversation(BaseConversation):
@@ -119,5 +197,5 @@ class UploadedFileInfo(Base):
     openai_web_info: Mapped[Optional[UploadedFileOpenaiWebInfo]] = mapped_column(Pydantic(UploadedFileOpenaiWebInfo),
                                                                                  nullable=True)
     extra_info: Mapped[Optional[dict]] = mapped_column(Pydantic(UploadedFileExtraInfo), nullable=True)
-    uploader_id: Mapped[int] = mapped_column(ForeignKey("user.id"), comment="上传的用户id")
+    uploader_id: Mapped[int] = mapped_column(ForeignKey("user.id"), index=True, comment="上传的用户id")
     uploader: Mapped["User"] = relationship(back_populates="uploaded_files")
@@ -3,9 +3,10 @@ import uuid
 from typing import Optional, Any, Literal, Union, Annotated, Dict
 
 from beanie import Document, TimeSeriesConfig, Granularity
+from pymongo import IndexModel
 from pydantic import BaseModel, Field, field_serializer
 
-from api.enums import OpenaiWebChatModels, OpenaiApiChatModels
+from api.enums import OpenaiWebChatModels, OpenaiApiChatModels, OpenaiWebChatStatus
 from api.models.doc.openai_web_code_interpreter import OpenaiWebChatMessageMetadataAggregateResult, \
     OpenaiWebChatMessageMetadataAttachment
 from api.models.types import SourceTypeLiteral
@@ -239,16 +240,118 @@ class OpenaiWebConversationHistoryDocument(Document, BaseConversationHistory):
         validate_on_save = True
 
 
+class OpenaiApiConversationNode(BaseModel):
+    """
+    消息在对话树中的位置，提问时据此只读取上下文需要的消息
+    """
+    parent: Optional[str] = None
+    depth: int  # 根节点为 0
+
+
 class OpenaiApiConversationHistoryDocument(Document, BaseConversationHistory):
     id: uuid.UUID = Field(default_factory=uuid.uuid4, alias="_id")
     source: Literal["openai_api"]
     mapping: dict[str, OpenaiApiChatMessage]
+    # message id -> 位置；旧记录中没有，首次提问时补全
+    node_index: Optional[dict[str, OpenaiApiConversationNode]] = None
 
     class Settings:
         name = "openai_api_conversation_history"
         validate_on_save = True
 
 
+class OpenaiWebSyncStateDocument(Document):
+    """
+    每个 ChatGPT 账号的对话同步状态，_id 为账号的 source_id，默认账号为 "default"
+    watermark 为已同步的对话中最新的 update_time，增量同步时只获取在此之后更新的对话
+    """
+    id: str = Field(alias="_id")
+    watermark: Optional[datetime.datetime] = None
+    last_sync_time: Optional[datetime.datetime] = None
+    last_full_sync_time: Optional[datetime.datetime] = None
+
+    class Settings:
+        name = "openai_web_sync_state"
+
+
+class RateLimitLogDocument(Document):
+    """
+    多进程部署时共享的对话频率限制记录，_id 为限制的 key，times 为窗口内各次提问的时间戳
+    """
+    id: str = Field(alias="_id")
+    times: list[float] = []
+    expire_at: Optional[datetime.datetime] = None
+
+    class Settings:
+        name = "rate_limit_logs"
+        indexes = [
+            IndexModel([("expire_at", 1)], expireAfterSeconds=0),
+        ]
+
+
+class CoordinationWorkerDocument(Document):
+    """
+    使用共享协调状态的 worker 进程，expire_at 由心跳续期；过期的 worker 留下的对话状态和槽位会被回收
+    """
+    id: str = Field(alias="_id")
+    expire_at: datetime.datetime
+
+    class Settings:
+        name = "coordination_workers"
+        indexes = [
+            IndexModel([("expire_at", 1)], expireAfterSeconds=0),
+        ]
+
+
+class UserChatStatusDocument(Document):
+    """
+    用户的 OpenAI Web 对话状态，_id 为用户 id；空闲的用户没有记录
+    """
+    id: int = Field(alias="_id")
+    status: OpenaiWebChatStatus
+    worker_id: str
+    updated_at: datetime.datetime
+
+    class Settings:
+        name = "coordination_chat_status"
+        indexes = [
+            IndexModel([("status", 1)]),
+            IndexModel([("worker_id", 1)]),
+        ]
+
+
+class AccountSlotDocument(Document):
+    """
+    ChatGPT 账号正在使用的并发槽位，_id 为账号的 source_id，默认账号为 "default"
+    total 为各 worker 占用数之和
+    """
+    id: str = Field(alias="_id")
+    total: int = 0
+    workers: dict[str, int] = {}
+
+    class Settings:
+        name = "coordination_account_slots"
+
+
+class AskCountBucketDocument(Document):
+    """
+    多 worker 部署时共享的最近对话次数，每个来源、模型系列每分钟一条记录，_id 为 "{source}:{family}:{bucket}"
+    """
+    id: str = Field(alias="_id")
+    source: str
+    family: str  # 模型系列
+    bucket: int  # 分桶起始时间（秒）
+    ask_count: int = 0
+    expire_at: datetime.datetime
+
+    class Settings:
+        name = "ask_count_buckets"
+        indexes = [
+            IndexModel([("source", 1), ("family", 1), ("bucket", 1)]),
+            IndexModel([("expire_at", 1)], expireAfterSeconds=0),
+        ]
+
+
 class RequestLogMeta(BaseModel):
     route_path: str
     method: Literal['GET', 'POST', 'PUT', 'DELETE', 'PATCH'] | str
@@ -260,6 +363,7 @@ class RequestLogDocument(Document):
     user_id: Optional[int]
     elapsed_ms: float
     status: Optional[int]
+    sql_query_count: Optional[int] = None
 
     class Settings:
         name = "request_logs"
@@ -288,6 +392,9 @@ class AskLogDocument(Document):
     conversation_id: Optional[uuid.UUID] = None
     queueing_time: Optional[float]
     ask_time: Optional[float]
+    stream_frames_sent: Optional[int] = None
+    stream_frames_merged: Optional[int] = None
+    stream_bytes_saved: Optional[int] = None
 
     @field_serializer("time")
     def serialize_dt(self, time: Optional[datetime.datetime], _info):
@@ -303,3 +410,60 @@ class AskLogDocument(Document):
             granularity=Granularity.seconds,
             expire_after_seconds=config.stats.ask_stats_ttl
         )
+
+
+# 统计汇总：按分钟、小时、天三种粒度预先聚合的日志，由 api.stats_rollup 维护
+# user_hll 为 HyperLogLog 寄存器，用于估计去重后的用户数
+# 分钟粒度的汇总设置 expire_at，与原始日志同时过期
+
+class RequestStatsRollupDocument(Document):
+    granularity: int  # 60, 3600 或 86400 秒
+    start_time: datetime.datetime
+    route_path: str
+    method: str
+    request_count: int = 0
+    total_elapsed_ms: float = 0
+    user_hll: dict[str, int] = {}
+    expire_at: Optional[datetime.datetime] = None
+    backfilled: bool = False  # 回填已累加到该汇总（仅包含回填开始时间的汇总）
+
+    class Settings:
+        name = "request_stats_rollup"
+        indexes = [
+            IndexModel([("granularity", 1), ("start_time", 1), ("route_path", 1), ("method", 1)], unique=True),
+            IndexModel([("expire_at", 1)], expireAfterSeconds=0),
+        ]
+
+
+class StatsRollupBackfillDocument(Document):
+    """
+    根据已有日志生成统计汇总的进度，_id 为汇总集合名
+    before 为首次开始回填的时间，此后的日志由 LogSink 实时累加；done_until 之前的日志已经回填
+    """
+    id: str = Field(alias="_id")
+    before: datetime.datetime
+    done_until: Optional[datetime.datetime] = None
+    completed: bool = False
+
+    class Settings:
+        name = "stats_rollup_backfill"
+
+
+class AskStatsRollupDocument(Document):
+    granularity: int  # 60, 3600 或 86400 秒
+    start_time: datetime.datetime
+    source: str
+    model: str
+    ask_count: int = 0
+    total_ask_time: float = 0
+    total_queueing_time: float = 0
+    user_hll: dict[str, int] = {}
+    expire_at: Optional[datetime.datetime] = None
+    backfilled: bool = False  # 回填已累加到该汇总（仅包含回填开始时间的汇总）
+
+    class Settings:
+        name = "ask_stats_rollup"
+        indexes = [
+            IndexModel([("granularity", 1), ("start_time", 1), ("source", 1), ("model", 1)], unique=True),
+            IndexModel([("expire_at", 1)], expireAfterSeconds=0),
+        ]
@@ -44,6 +44,7 @@ class OpenaiApiPerModelAskCount(RootModel[dict[str, int]]):
 class TimeWindowRateLimit(BaseModel):
     window_seconds: int = Field(..., description="时间窗口大小，单位为秒")
     max_requests: int = Field(..., description="在给定时间窗口内最多的请求次数")
+    model: Optional[str] = Field(None, description="仅统计该模型的请求；为空时统计该对话类型下所有模型的请求")
 
 
 class DailyTimeSlot(BaseModel):
@@ -0,0 +1,282 @@
+import asyncio
+import time
+from abc import ABC, abstractmethod
+from collections import deque
+from datetime import datetime, timedelta
+from enum import Enum
+from typing import Optional
+
+from pymongo import ReturnDocument
+from sqlalchemy import select
+
+from api.conf import Config
+from api.database.sqlalchemy import get_async_read_session_context
+from api.enums import ChatSourceTypes
+from api.models.db import UserSetting
+from api.models.doc import AskLogDocument, RateLimitLogDocument
+from api.models.json import TimeWindowRateLimit
+from utils.common import SingletonMeta
+from utils.logger import get_logger
+
+logger = get_logger(__name__)
+config = Config()
+
+# 重建时最多读取的 ask_logs 时间范围，超过该长度的时间窗口只能部分重建
+REBUILD_MAX_SECONDS = 24 * 60 * 60
+IDLE_SWEEP_INTERVAL_SECONDS = 10 * 60
+
+
+class RateLimitExceededException(Exception):
+    def __init__(self, retry_after: float):
+        super().__init__(f"rate limited, retry after {retry_after:.1f} seconds")
+        self.retry_after = retry_after
+
+
+def _enum_value(value):
+    return value.value if isinstance(value, Enum) else value
+
+
+def _make_key(user_id: int, source: str, model: Optional[str] = None) -> str:
+    """
+    不指定模型的限制统计该来源下所有提问，指定模型的限制只统计该模型的提问，两者分别记录
+    """
+    return f"{user_id}:{source}" if model is None else f"{user_id}:{source}:{model}"
+
+
+def _group_limits(user_id: int, source: str, model: str,
+                  rate_limits: list[TimeWindowRateLimit]) -> dict[str, list[TimeWindowRateLimit]]:
+    groups: dict[str, list[TimeWindowRateLimit]] = {}
+    for limit in rate_limits:
+        if limit.window_seconds <= 0 or limit.max_requests < 0:
+            continue
+        if limit.model is not None and limit.model != model:
+            continue
+        groups.setdefault(_make_key(user_id, source, limit.model), []).append(limit)
+    return groups
+
+
+def _retry_after(times: list[float] | deque[float], limits: list[TimeWindowRateLimit], now: float) -> float:
+    """
+    times 按时间升序；窗口内已有 max_requests 次提问时，需要等到其中最早的一次移出窗口
+    返回 0 表示所有限制都允许本次提问
+    """
+    retry_after = 0.0
+    for limit in limits:
+        if limit.max_requests == 0:
+            return float(limit.window_seconds)
+        if len(times) >= limit.max_requests:
+            oldest = times[-limit.max_requests]
+            if oldest > now - limit.window_seconds:
+                retry_after = max(retry_after, oldest + limit.window_seconds - now)
+    return retry_after
+
+
+class RateLimiterBackend(ABC):
+    @abstractmethod
+    async def acquire(self, key: str, limits: list[TimeWindowRateLimit], now: float) -> float:
+        """
+        所有限制都允许时记录本次提问并返回 0，否则不记录并返回需要等待的秒数
+        """
+
+    @abstractmethod
+    async def release(self, key: str, now: float):
+        """
+        撤销 acquire 记录的提问，用于提问未成功的情况
+        """
+
+    async def rebuild(self):
+        pass
+
+
+class _KeyLog:
+    def __init__(self, max_requests: int, max_window: int):
+        # 判断是否超限只需要最近 max_requests 次提问的时间
+        self.times: deque[float] = deque(maxlen=max(max_requests, 1))
+        self.max_window = max_window
+
+    def resize(self, max_requests: int, max_window: int):
+        if self.times.maxlen != max(max_requests, 1):
+            self.times = deque(self.times, maxlen=max(max_requests, 1))
+        self.max_window = max_window
+
+    def append(self, timestamp: float):
+        # 重建时的时间不一定有序
+        if self.times and self.times[-1] > timestamp:
+            ordered = sorted([*self.times, timestamp])
+            self.times.clear()
+            self.times.extend(ordered)
+        else:
+            self.times.append(timestamp)
+
+
+class InProcessRateLimiterBackend(RateLimiterBackend):
+    """
+    单进程部署使用，每个 key 只保存最近 max_requests 次提问的时间，检查为 O(限制条数)
+    """
+
+    def __init__(self):
+        self._logs: dict[str, _KeyLog] = {}
+        self._last_sweep = time.time()
+
+    def _sweep(self, now: float):
+        if now - self._last_sweep < IDLE_SWEEP_INTERVAL_SECONDS:
+            return
+        self._last_sweep = now
+        for key in [key for key, log in self._logs.items()
+                    if not log.times or log.times[-1] <= now - log.max_window]:
+            del self._logs[key]
+
+    async def acquire(self, key: str, limits: list[TimeWindowRateLimit], now: float) -> float:
+        self._sweep(now)
+        max_requests = max(limit.max_requests for limit in limits)
+        max_window = max(limit.window_seconds for limit in limits)
+        log = self._logs.get(key)
+        if log is None:
+            log = self._logs[key] = _KeyLog(max_requests, max_window)
+        else:
+            log.resize(max_requests, max_window)
+        retry_after = _retry_after(log.times, limits, now)
+        if retry_after == 0:
+            log.append(now)
+        return retry_after
+
+    async def release(self, key: str, now: float):
+        log = self._logs.get(key)
+        if log is not None and now in log.times:
+            log.times.remove(now)
+
+    async def rebuild(self):
+        """
+        根据用户设置中的频率限制，从 ask_logs 中恢复各 key 最近的提问时间
+        """
+        now = time.time()
+        self._logs.clear()
+        self._last_sweep = now
+        async with get_async_read_session_context() as session:
+            r = await session.execute(select(UserSetting.user_id, UserSetting._openai_web, UserSetting._openai_api))
+            settings = r.tuples().all()
+
+        # user_id -> source -> rate_limits
+        user_limits: dict[int, dict[str, list[TimeWindowRateLimit]]] = {}
+        max_window = 0
+        for user_id, openai_web, openai_api in settings:
+            for source, setting in ((ChatSourceTypes.openai_web.value, openai_web),
+                                    (ChatSourceTypes.openai_api.value, openai_api)):
+                if setting is None or not setting.rate_limits:
+                    continue
+                user_limits.setdefault(user_id, {})[source] = setting.rate_limits
+                max_window = max([max_window, *(limit.window_seconds for limit in setting.rate_limits)])
+        if not user_limits:
+            return
+        max_window = min(max_window, REBUILD_MAX_SECONDS)
+
+        cursor = AskLogDocument.get_motor_collection().find(
+            {"time": {"$gte": datetime.utcnow() - timedelta(seconds=max_window)},
+             "user_id": {"$in": list(user_limits.keys())}},
+            {"_id": 0, "time": 1, "user_id": 1, "meta.source": 1, "meta.model": 1}
+        ).sort("time", 1)
+        total = 0
+        async for raw in cursor:
+            meta = raw.get("meta") or {}
+            source, model = meta.get("source"), meta.get("model")
+            rate_limits = user_limits.get(raw["user_id"], {}).get(source)
+            if not rate_limits:
+                continue
+            timestamp = raw["time"].timestamp() if raw["time"].tzinfo else \
+                (raw["time"] - datetime(1970, 1, 1)).total_seconds()
+            for key, limits in _group_limits(raw["user_id"], source, model, rate_limits).items():
+                if now - timestamp >= max(limit.window_seconds for limit in limits):
+                    continue
+                log = self._logs.get(key)
+                if log is None:
+                    log = self._logs[key] = _KeyLog(max(limit.max_requests for limit in limits),
+                                                    max(limit.window_seconds for limit in limits))
+                log.append(timestamp)
+            total += 1
+        logger.info(f"Rate limiter rebuilt from {total} ask logs of {len(user_limits)} users.")
+
+
+class MongoRateLimiterBackend(RateLimiterBackend):
+    """
+    多进程部署使用，记录保存在 rate_limit_logs 集合中
+    检查和记录在同一条管道更新中完成，多个进程并发提问时不会超限
+    """
+
+    async def acquire(self, key: str, limits: list[TimeWindowRateLimit], now: float) -> float:
+        max_window = max(limit.window_seconds for limit in limits)
+
+        def count_in_window(window_seconds: int):
+            return {"$size": {"$filter": {"input": "$times", "cond": {"$gt": ["$$this", now - window_seconds]}}}}
+
+        allowed = {"$and": [{"$lt": [count_in_window(limit.window_seconds), limit.max_requests]} for limit in limits]}
+        doc = await RateLimitLogDocument.get_motor_collection().find_one_and_update(
+            {"_id": key},
+            [
+                {"$set": {"times": {"$filter": {"input": {"$ifNull": ["$times", []]},
+                                                "cond": {"$gt": ["$$this", now - max_window]}}}}},
+                {"$set": {"times": {"$cond": [allowed, {"$concatArrays": ["$times", [now]]}, "$times"]},
+                          "expire_at": datetime.utcnow() + timedelta(seconds=max_window)}},
+            ],
+            upsert=True,
+            return_document=ReturnDocument.AFTER,
+        )
+        times = sorted(doc.get("times") or [])
+        if now in times:
+            return 0
+        return _retry_after(times, limits, now) or 1.0
+
+    async def release(self, key: str, now: float):
+        await RateLimitLogDocument.get_motor_collection().update_one({"_id": key}, {"$pull": {"times": now}})
+
+
+class RateLimitPermit:
+    """
+    已通过的频率限制记录，提问未成功时调用 release() 撤销
+    """
+
+    def __init__(self, backend: RateLimiterBackend, keys: list[str], now: float):
+        self._backend = backend
+        self._keys = keys
+        self._now = now
+
+    async def release(self):
+        keys, self._keys = self._keys, []
+        for key in keys:
+            try:
+                await self._backend.release(key, self._now)
+            except Exception as e:
+                logger.error(f"Failed to release rate limit record {key}: {e.__class__.__name__} {e}")
+
+
+class RateLimiter(metaclass=SingletonMeta):
+    """
+    对话时间窗口频率限制，对应用户设置中的 rate_limits
+    """
+
+    def __init__(self):
+        if config.common.rate_limit_backend == "mongodb":
+            self.backend: RateLimiterBackend = MongoRateLimiterBackend()
+        else:
+            self.backend = InProcessRateLimiterBackend()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self, user_id: int, source: ChatSourceTypes | str, model: Enum | str,
+                      rate_limits: list[TimeWindowRateLimit]) -> RateLimitPermit:
+        """
+        :raises RateLimitExceededException: 任一限制不允许本次提问时抛出，此时不会记录本次提问
+        """
+        now = time.time()
+        groups = _group_limits(user_id, _enum_value(source), _enum_value(model), rate_limits)
+        acquired = []
+        # 同一进程内串行检查多个 key，避免只记录了一部分
+        async with self._lock:
+            for key, limits in groups.items():
+                retry_after = await self.backend.acquire(key, limits, now)
+                if retry_after > 0:
+                    await RateLimitPermit(self.backend, acquired, now).release()
+                    raise RateLimitExceededException(retry_after)
+                acquired.append(key)
+        return RateLimitPermit(self.backend, acquired, now)
+
+    async def rebuild(self):
+        await self.backend.rebuild()
@@ -1,21 +1,28 @@
+import asyncio
 import json
 import typing
-from typing import Optional, Any, Generic, TypeVar, Dict
+from typing import Optional, Any, Generic, TypeVar, Dict, Iterable
 
 import httpx
 from fastapi import Response
+from fastapi.responses import StreamingResponse
 from fastapi.encoders import jsonable_encoder
 from fastapi.exceptions import RequestValidationError
 from fastapi_users.router import ErrorCode
 from pydantic import BaseModel, ValidationError
+from pydantic_core import to_json
 from starlette.background import BackgroundTask
+from starlette.concurrency import run_in_threadpool
 from starlette.exceptions import HTTPException as StarletteHTTPException
 
+from api.conf import Config
 from api.exceptions import SelfDefinedException, ArkoseForwardException
 from utils.common import desensitize
 
 T = TypeVar('T')
 
+config = Config()
+
 
 class ResponseWrapper(BaseModel, Generic[T]):
     """
@@ -33,8 +40,63 @@ class ResponseWrapper(BaseModel, Generic[T]):
     result: Optional[T | Any] = None
 
 
+def dumps_json(value: Any) -> bytes:
+    """
+    用 pydantic-core 直接编码，模型按 alias 序列化，不需要先经过 jsonable_encoder 转换
+    无法识别的类型交给 jsonable_encoder 处理
+    """
+    return to_json(value, by_alias=True, fallback=jsonable_encoder)
+
+
+def _dumps_wrapper_in_parts(content: ResponseWrapper) -> bytes:
+    """
+    在线程池中编码较大的返回值：to_json 执行期间不释放 GIL，
+    因此 result 为 list 或 dict 时逐项编码，每项之间事件循环所在线程都有机会运行
+    """
+    result = content.result
+    if isinstance(result, list):
+        body = b"[" + b",".join(dumps_json(item) for item in result) + b"]"
+    elif isinstance(result, dict):
+        body = b"{" + b",".join(dumps_json(str(key)) + b":" + dumps_json(value) for key, value in result.items()) + b"}"
+    else:
+        return dumps_json(content)
+    # head 以 "null}" 结尾
+    head = dumps_json(content.model_copy(update={"result": None}))
+    return head[:-5] + body + b"}"
+
+
+def _exceeds_size(content: Any, limit: int) -> bool:
+    """
+    粗略估计返回值的大小：遍历其中的元素，字符串按长度计入，超过 limit 时立即返回，因此开销有上限
+    """
+    stack = [content]
+    size = 0
+    while stack:
+        value = stack.pop()
+        size += 1
+        if isinstance(value, (str, bytes)):
+            size += len(value) // 64
+        elif isinstance(value, dict):
+            stack.extend(value.values())
+        elif isinstance(value, (list, tuple, set)):
+            stack.extend(value)
+        elif isinstance(value, BaseModel):
+            stack.extend(value.__dict__.values())
+        if size > limit:
+            return True
+    return False
+
+
 class CustomJSONResponse(Response):
+    """
+    渲染时记录 ResponseWrapper 中的 code，发送时写入 scope["response_code"]，
+    供 StatisticsMiddleware 统计，无需再解析响应体
+
+    估计大小超过 json_response_offload_threshold 的返回值不在创建时编码，而是在发送前放到线程池中编码，
+    避免阻塞同时进行的 websocket 对话
+    """
     media_type = "application/json"
+    response_code: Optional[int] = None
 
     def __init__(
             self,
@@ -44,13 +106,69 @@ class CustomJSONResponse(Response):
             media_type: Optional[str] = None,
             background: Optional[BackgroundTask] = None,
     ) -> None:
+        self._pending_content = None
+        self._is_pending = False
         super().__init__(content, status_code, headers, media_type, background)
 
     def render(self, content: typing.Any) -> bytes:
         if not isinstance(content, ResponseWrapper):
-            content = ResponseWrapper(code=self.status_code, message=get_http_message(self.status_code), result=content)
-        result = json.dumps(jsonable_encoder(content), ensure_ascii=False)
-        return result.encode("utf-8")
+            # 路由返回值已经由 FastAPI 转换为 JSON 兼容的类型，不需要再校验一遍
+            content = ResponseWrapper.model_construct(code=self.status_code,
+                                                      message=get_http_message(self.status_code), result=content)
+        self.response_code = content.code
+        if _exceeds_size(content, config.common.json_response_offload_threshold):
+            self._pending_content = content
+            self._is_pending = True
+            return b""
+        return dumps_json(content)
+
+    async def __call__(self, scope, receive, send) -> None:
+        if self._is_pending:
+            content, self._pending_content, self._is_pending = self._pending_content, None, False
+            self.body = await run_in_threadpool(_dumps_wrapper_in_parts, content)
+            self.headers["content-length"] = str(len(self.body))
+        scope["response_code"] = self.response_code
+        await super().__call__(scope, receive, send)
+
+
+class CustomJSONStreamingResponse(StreamingResponse):
+    """
+    以 ResponseWrapper 格式流式返回 result，其中 stream_key 对应的 dict 逐项编码写出，
+    避免一次性编码很大的返回值（例如包含代码解释器输出的对话历史）长时间阻塞事件循环
+    """
+    media_type = "application/json"
+    chunk_size = 64 * 1024
+
+    def __init__(
+            self,
+            result: dict[str, Any],
+            stream_key: str,
+            items: Iterable[tuple[str, Any]],
+            headers: Optional[Dict[str, str]] = None,
+    ) -> None:
+        super().__init__(self._render(result, stream_key, items), status_code=200, headers=headers)
+
+    async def _render(self, result: dict[str, Any], stream_key: str, items: Iterable[tuple[str, Any]]):
+        head = dumps_json({"code": 200, "message": get_http_message(200), "result": {**result, stream_key: {}}})
+        # head 以 "{}}}" 结尾，在最后一个 dict 中写入各项
+        buffer = [head[:-3]]
+        size = len(buffer[0])
+        separator = b""
+        for key, value in items:
+            part = separator + dumps_json(key) + b":" + dumps_json(value)
+            separator = b","
+            buffer.append(part)
+            size += len(part)
+            if size >= self.chunk_size:
+                yield b"".join(buffer)
+                buffer, size = [], 0
+                await asyncio.sleep(0)
+        buffer.append(b"}}}")
+        yield b"".join(buffer)
+
+    async def __call__(self, scope, receive, send) -> None:
+        scope["response_code"] = 200
+        await super().__call__(scope, receive, send)
 
 
 class PrettyJSONResponse(Response):
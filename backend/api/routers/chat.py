@@ -1,4 +1,6 @@
+import asyncio
 import json
+import math
 import os
 import time
 import uuid
@@ -11,24 +13,31 @@ from fastapi.encoders import jsonable_encoder
 from fastapi_cache.decorator import cache
 from httpx import HTTPError
 from pydantic import ValidationError, BaseModel
-from sqlalchemy import select, func, and_
-from starlette.websockets import WebSocket, WebSocketState
+from starlette.websockets import WebSocket
 from websockets.exceptions import ConnectionClosed
 
+from api.ask_counter import AskCounter
+from api.ask_quota import AskQuotaReservation, AskQuotaExhaustedException
+from api.ask_unit_of_work import AskUnitOfWork
+from api.ask_stream import AskStreamSender, AskStreamStalledException
 from api.conf import Config
+from api.conversation_history_cache import ConversationHistoryCache
+from api.coordination import Coordinator
+from api.database.log_sink import LogSink
 from api.database.sqlalchemy import get_async_session_context
 from api.enums import OpenaiWebChatStatus, ChatSourceTypes, OpenaiWebChatModels, OpenaiApiChatModels
 from api.exceptions import InternalException, InvalidParamsException, OpenaiException
 from api.models.db import User, BaseConversation
+from api.rate_limit import RateLimiter, RateLimitExceededException
 from api.models.doc import OpenaiApiChatMessage, OpenaiApiConversationHistoryDocument, OpenaiApiChatMessageTextContent, \
     AskLogDocument, OpenaiWebAskLogMeta, \
     OpenaiApiAskLogMeta
-from api.routers.conv import _get_conversation_by_id
 from api.schemas import AskRequest, AskResponse, AskResponseType, UserReadAdmin, \
     BaseConversationSchema
 from api.schemas.openai_schemas import OpenaiChatPlugin, OpenaiChatPluginUserSettings, OpenaiChatPluginListResponse
-from api.sources import OpenaiWebChatManager, convert_openai_web_message, OpenaiApiChatManager
-from api.users import websocket_auth, current_active_user, current_super_user
+from api.sources import OpenaiWebChatManager, OpenaiWebMessageConverter, OpenaiApiChatManager, OpenaiWebAccount, \
+    AskTicket, build_node_index, append_messages_to_history
+from api.users import websocket_auth_user_id, current_active_user, current_super_user, user_cache
 from utils.common import desensitize
 from utils.logger import get_logger, with_traceback
 
@@ -41,6 +50,7 @@ config = Config()
 INSTALLED_PLUGINS_CACHE_FILE_PATH = os.path.join(config.data.data_dir, "installed_plugin_manifests.json")
 INSTALLED_PLUGINS_TEAM_CACHE_FILE_PATH = os.path.join(config.data.data_dir, "installed_plugin_manifests_team.json")
 CACHE_EXPIRE_DURATION = 3600 * 24
+ACCOUNT_UNHEALTHY_ERROR_CODES = [401, 403, 429]
 
 
 # TODO: 优化插件缓存处理，隔离不同来源的插件
@@ -143,6 +153,8 @@ async def _predict_schema_types(_request: AskRequest):
 
 
 class WebsocketException(Exception):
+    retry_after_seconds: Optional[int] = None
+
     def __init__(self, code: int, tip: str, error_detail: Optional[Any] = None):
         self.code = code
         self.tip = tip
@@ -154,17 +166,16 @@ class WebsocketInvalidAskException(WebsocketException):
         super().__init__(1008, tip, error_detail)
 
 
-async def change_user_chat_status(user_id: int, status: OpenaiWebChatStatus):
-    async with get_async_session_context() as session:
-        user = await session.get(User, user_id)
-        user.setting.openai_web_chat_status = status
-        session.add(user.setting)
-        await session.commit()
-        await session.refresh(user)
-    return user
+class WebsocketRateLimitedException(WebsocketException):
+    def __init__(self, retry_after_seconds: int):
+        super().__init__(1013, "errors.rateLimited", f"retry after {retry_after_seconds} seconds")
+        self.retry_after_seconds = retry_after_seconds
 
 
-async def check_limits(user: UserReadAdmin, ask_request: AskRequest):
+async def check_limits(user: UserReadAdmin, ask_request: AskRequest, uow: AskUnitOfWork) -> AskQuotaReservation:
+    """
+    全部检查通过后预留一次对话次数，调用方需要在提问结束后 commit 或 refund
+    """
     source_setting = user.setting.openai_web if ask_request.source == ChatSourceTypes.openai_web else user.setting.openai_api
 
     # 是否允许使用当前提问类型
@@ -189,8 +200,6 @@ async def check_limits(user: UserReadAdmin, ask_request: AskRequest):
         if not any(time_slot.start_time <= now_time <= time_slot.end_time for time_slot in time_slots):
             raise WebsocketInvalidAskException("errors.userNotAllowToAskAtThisTime")
 
-    # TODO: 时间窗口频率限制
-
     # 判断是否能使用该模型
     if ask_request.source == ChatSourceTypes.openai_web and ask_request.model not in user.setting.openai_web.available_models or \
             ask_request.source == ChatSourceTypes.openai_api and ask_request.model not in user.setting.openai_api.available_models:
@@ -201,26 +210,9 @@ async def check_limits(user: UserReadAdmin, ask_request: AskRequest):
             ask_request.source == ChatSourceTypes.openai_api and ask_request.model not in config.openai_api.enabled_models:
         raise WebsocketInvalidAskException("errors.modelNotEnabled")
 
-    # 对话次数判断
-    model_ask_count = source_setting.per_model_ask_count.root.get(ask_request.model, 0)
-    total_ask_count = source_setting.total_ask_count
-    if total_ask_count != -1 and total_ask_count <= 0:
-        # await websocket.close(1008, "errors.noAvailableTotalAskCount")
-        raise WebsocketInvalidAskException("errors.noAvailableTotalAskCount")
-    if model_ask_count != -1 and model_ask_count <= 0:
-        # await websocket.close(1008, "errors.noAvailableModelAskCount")
-        raise WebsocketInvalidAskException("errors.noAvailableModelAskCount")
-
     # 判断是否能新建对话
-    async with get_async_session_context() as session:
-        conv_count = await session.execute(
-            select(func.count(BaseConversation.id)).filter(
-                and_(BaseConversation.user_id == user.id, BaseConversation.is_valid,
-                     BaseConversation.source == ask_request.source)))
-        conv_count = conv_count.scalar()
-
     max_conv_count = source_setting.max_conv_count
-    if ask_request.new_conversation and max_conv_count != -1 and conv_count >= max_conv_count:
+    if ask_request.new_conversation and max_conv_count != -1 and uow.conv_count >= max_conv_count:
         # await websocket.close(1008, "errors.maxConversationCountReached")
         raise WebsocketInvalidAskException("errors.maxConversationCountReached")
 
@@ -239,6 +231,70 @@ async def check_limits(user: UserReadAdmin, ask_request: AskRequest):
         if user.setting.openai_web.disable_uploading or config.openai_web.disable_uploading:
             raise WebsocketInvalidAskException("errors.uploadingNotAllowed", "uploading disabled")
 
+    # 时间窗口频率限制
+    try:
+        permit = await RateLimiter().acquire(user.id, ask_request.source, ask_request.model,
+                                             source_setting.rate_limits)
+    except RateLimitExceededException as e:
+        raise WebsocketRateLimitedException(math.ceil(e.retry_after))
+
+    # 预留对话次数
+    try:
+        reservation = await uow.reserve_ask_quota()
+    except AskQuotaExhaustedException as e:
+        await permit.release()
+        if e.is_total:
+            raise WebsocketInvalidAskException("errors.noAvailableTotalAskCount")
+        raise WebsocketInvalidAskException("errors.noAvailableModelAskCount")
+    reservation.on_refund(permit.release)
+    user_cache.invalidate(user.id)
+    return reservation
+
+
+def _get_queue_weight(user: UserReadAdmin) -> float:
+    weight = user.setting.openai_web.queue_weight
+    if user.is_superuser:
+        weight *= config.openai_web.queue_superuser_weight
+    return weight
+
+
+async def wait_in_queue(websocket: WebSocket, ticket: AskTicket, reply) -> OpenaiWebAccount | None:
+    """
+    等待调度器放行，期间推送排队位置与预计等待时间
+    websocket 断开时立即取消排队并返回 None
+    """
+    scheduler = openai_web_manager.scheduler
+    receive_task = asyncio.ensure_future(websocket.receive())
+    account = None
+    try:
+        while not ticket.future.done():
+            if ticket.position_changed.is_set():
+                ticket.position_changed.clear()
+                await reply(AskResponse(
+                    type=AskResponseType.queueing,
+                    tip="tips.queueing",
+                    queue_position=ticket.position,
+                    estimated_wait_seconds=scheduler.estimated_wait_seconds(ticket)
+                ))
+            position_changed_task = asyncio.ensure_future(ticket.position_changed.wait())
+            done, _ = await asyncio.wait([ticket.future, position_changed_task, receive_task],
+                                         return_when=asyncio.FIRST_COMPLETED)
+            position_changed_task.cancel()
+            if receive_task in done:
+                if receive_task.result()["type"] == "websocket.disconnect":
+                    return None
+                receive_task = asyncio.ensure_future(websocket.receive())
+        account = ticket.future.result()
+        return account
+    except Exception as e:
+        logger.debug(f"cancel queueing ticket because of {e.__class__.__name__}: {e}")
+        return None
+    finally:
+        receive_task.cancel()
+        # 未把账号交给调用方时（包括任务被取消）都要取消排队；已放行的 ticket 由 cancel 归还槽位
+        if account is None:
+            await scheduler.cancel(ticket)
+
 
 @router.websocket("/chat")
 async def chat(websocket: WebSocket):
@@ -252,24 +308,17 @@ async def chat(websocket: WebSocket):
         await websocket.send_json(jsonable_encoder(response))
 
     await websocket.accept()
-    user_db = await websocket_auth(websocket)
-    if user_db is None:
+    user_id = websocket_auth_user_id(websocket)
+    if user_id is None:
         await websocket.close(1008, "errors.unauthorized")
         return
 
-    logger.info(f"{user_db.username} connected to websocket")
-    websocket.scope["auth_user"] = user_db
-
-    user = UserReadAdmin.model_validate(user_db)
-
-    if user.setting.openai_web_chat_status != OpenaiWebChatStatus.idling:
+    if await Coordinator().get_chat_status(user_id) != OpenaiWebChatStatus.idling:
         await websocket.close(1008, "errors.cannotConnectMoreThanOneClient")
         return
 
     params = await websocket.receive_json()
 
-    use_team = user.setting.openai_web.use_team and config.openai_web.enable_team_subscription
-
     try:
         ask_request = AskRequest.model_validate(params)
     except ValidationError as e:
@@ -278,24 +327,53 @@ async def chat(websocket: WebSocket):
         await websocket.close(1007, "errors.invalidAskRequest")
         return
 
-    # 检查限制
+    # 读取用户、对话并检查限制，全部通过后才占用写连接预留对话次数
+    uow = AskUnitOfWork(user_id, ask_request)
     try:
-        await check_limits(user, ask_request)
+        user_db = await uow.load()
+        if user_db is None or not user_db.is_active:
+            await websocket.close(1008, "errors.unauthorized")
+            return
+
+        logger.info(f"{user_db.username} connected to websocket")
+        websocket.scope["auth_user"] = user_db
+        user = UserReadAdmin.model_validate(user_db)
+
+        # 如果并非新建对话，则检查对话是否存在以及是否属于该用户
+        conversation = None
+        conversation_id = None
+        if not ask_request.new_conversation:
+            assert ask_request.conversation_id is not None
+            conversation_id = ask_request.conversation_id
+            conversation = uow.conversation
+            if conversation is None:
+                raise WebsocketInvalidAskException("errors.conversationNotFound")
+            if not user.is_superuser and conversation.user_id != user.id:
+                raise WebsocketInvalidAskException("errors.authorityDeny")
+
+        reservation = await check_limits(user, ask_request, uow)
     except WebsocketException as e:
-        await reply(AskResponse(type=AskResponseType.error, tip=e.tip, error_detail=e.error_detail))
+        await reply(AskResponse(type=AskResponseType.error, tip=e.tip, error_detail=e.error_detail,
+                                retry_after_seconds=e.retry_after_seconds))
         await websocket.close(e.code, e.tip)
         return
 
-    # 如果并非新建对话，则获取对话
-    conversation = None
-    conversation_id = None
-    if not ask_request.new_conversation:
-        assert ask_request.conversation_id is not None
-        conversation_id = ask_request.conversation_id
-        conversation = await _get_conversation_by_id(ask_request.conversation_id, user_db)
+    use_team = user.setting.openai_web.use_team and config.openai_web.enable_team_subscription
+
+    # 已有对话只能使用其所属的 ChatGPT 账号；新对话由调度器在放行时选择负载最低的健康账号
+    account = None
+    if ask_request.source == ChatSourceTypes.openai_web and conversation is not None:
+        try:
+            account = openai_web_manager.get_account(conversation.source_id)
+        except InvalidParamsException as e:
+            await reservation.refund()
+            await reply(AskResponse(type=AskResponseType.error, tip=e.message))
+            await websocket.close(1008, e.message)
+            return
 
         # 是否可用 team 对话
-        if conversation is not None and conversation.source_id is not None and use_team == False:
+        if account.is_team and not use_team:
+            await reservation.refund()
             e = WebsocketException(1008, "errors.teamConversationNotAllowed")
             await reply(AskResponse(type=AskResponseType.error, tip=e.tip, error_detail=e.error_detail))
             await websocket.close(e.code, e.tip)
@@ -315,28 +393,43 @@ async def chat(websocket: WebSocket):
 
     # 排队
     if ask_request.source == ChatSourceTypes.openai_web:
-        if openai_web_manager.is_busy():
-            await reply(AskResponse(
-                type=AskResponseType.queueing,
-                tip="tips.queueing"
-            ))
-        await change_user_chat_status(user.id, OpenaiWebChatStatus.queueing)
+        # 同一用户同时只能有一个 OpenAI Web 提问，连接时的检查与此处之间可能有其它 worker 上的提问
+        if not await Coordinator().compare_and_set_chat_status(user.id, OpenaiWebChatStatus.idling,
+                                                               OpenaiWebChatStatus.queueing):
+            await reservation.refund()
+            await websocket.close(1008, "errors.cannotConnectMoreThanOneClient")
+            return
+        try:
+            ticket = await openai_web_manager.scheduler.submit(
+                user.id, ask_request.model,
+                use_team=use_team,
+                new_conversation=ask_request.new_conversation,
+                source_id=account.source_id if account is not None else None,
+                user_weight=_get_queue_weight(user)
+            )
+        except InvalidParamsException as e:
+            await reservation.refund()
+            await Coordinator().set_chat_status(user.id, OpenaiWebChatStatus.idling)
+            await reply(AskResponse(type=AskResponseType.error, tip=e.message))
+            await websocket.close(1008, e.message)
+            return
         queueing_start_time = time.time()
-        await openai_web_manager.semaphore.acquire()
+        account = await wait_in_queue(websocket, ticket, reply)
         queueing_end_time = time.time()
         # 如果 websocket 关闭了，则直接退出
-        if websocket.state == WebSocketState.DISCONNECTED:
-            await change_user_chat_status(user.id, OpenaiWebChatStatus.idling)
-            await openai_web_manager.semaphore.release()
+        if account is None:
+            await reservation.refund()
+            await Coordinator().set_chat_status(user.id, OpenaiWebChatStatus.idling)
             logger.debug(f"{user.username} websocket disconnected while queueing")
             return
 
     # 在此之前应当没有任何副作用
     message = None
+    stream: Optional[AskStreamSender] = None
 
     try:
         if ask_request.source == ChatSourceTypes.openai_web:
-            await change_user_chat_status(user.id, OpenaiWebChatStatus.asking)
+            await Coordinator().set_chat_status(user.id, OpenaiWebChatStatus.asking)
 
         await reply(AskResponse(
             type=AskResponseType.waiting,
@@ -353,45 +446,61 @@ async def chat(websocket: WebSocket):
         else:
             model = OpenaiApiChatModels(ask_request.model)
 
-        # stream 传输
-        async for data in manager.complete(model=model,
-                                           text_content=ask_request.text_content,
-                                           use_team=use_team,
-                                           conversation_id=ask_request.conversation_id,
-                                           parent_message_id=ask_request.parent,
-                                           plugin_ids=ask_request.openai_web_plugin_ids if ask_request.new_conversation else None,
-                                           attachments=ask_request.openai_web_attachments,
-                                           multimodal_image_parts=ask_request.openai_web_multimodal_image_parts,
-                                           arkose_token=ask_request.arkose_token,
-                                           ):
-            has_got_reply = True
+        # 合并更新后再发送，客户端支持时只发送增量
+        stream = AskStreamSender(websocket, accept_delta=ask_request.accept_delta)
+        converter = OpenaiWebMessageConverter()
 
-            try:
-                if ask_request.source == ChatSourceTypes.openai_web:
-                    message = convert_openai_web_message(data)
-                    if conversation_id is None:
-                        conversation_id = data["conversation_id"]
-                else:
-                    assert isinstance(data, OpenaiApiChatMessage)
-                    message = data
-                    if conversation_id is None:
-                        assert ask_request.new_conversation
-                        conversation_id = uuid.uuid4()
-            except Exception as e:
-                logger.warning(f"convert message error: {with_traceback((e))}")
-                continue
+        context_message_count = ask_request.api_context_message_count \
+            if ask_request.api_context_message_count is not None else -1
 
-            await reply(AskResponse(
-                type=AskResponseType.message,
-                conversation_id=conversation_id,
-                message=message
-            ))
+        try:
+            # stream 传输
+            async for data in manager.complete(model=model,
+                                               text_content=ask_request.text_content,
+                                               use_team=use_team,
+                                               account=account,
+                                               conversation_id=ask_request.conversation_id,
+                                               parent_message_id=ask_request.parent,
+                                               plugin_ids=ask_request.openai_web_plugin_ids if ask_request.new_conversation else None,
+                                               attachments=ask_request.openai_web_attachments,
+                                               multimodal_image_parts=ask_request.openai_web_multimodal_image_parts,
+                                               arkose_token=ask_request.arkose_token,
+                                               context_message_count=context_message_count,
+                                               ):
+                has_got_reply = True
+
+                try:
+                    if ask_request.source == ChatSourceTypes.openai_web:
+                        message = converter.convert(data)
+                        if conversation_id is None:
+                            conversation_id = data["conversation_id"]
+                    else:
+                        assert isinstance(data, OpenaiApiChatMessage)
+                        message = data
+                        if conversation_id is None:
+                            assert ask_request.new_conversation
+                            conversation_id = uuid.uuid4()
+                except Exception as e:
+                    logger.warning(f"convert message error: {with_traceback((e))}")
+                    continue
+
+                stream.put(conversation_id, message)
+            await stream.close()
+        finally:
+            stream.abort()
 
         is_completed = True
+        if account is not None:
+            account.mark_healthy()
     except ConnectionClosed as e:
         websocket_code = e.code
         websocket_reason = e.reason
         is_canceled = True
+    except AskStreamStalledException as e:
+        logger.warning(f"{user.username} stalled while receiving: {e}")
+        websocket_code = 1013
+        websocket_reason = "errors.clientStalled"
+        is_canceled = True
     except httpx.TimeoutException as e:
         logger.warning(str(e))
         await reply(AskResponse(
@@ -402,6 +511,8 @@ async def chat(websocket: WebSocket):
         websocket_reason = "errors.timout"
     except OpenaiException as e:
         logger.error(with_traceback(e))
+        if account is not None and e.code in ACCOUNT_UNHEALTHY_ERROR_CODES:
+            account.mark_unhealthy(f"{e.code} {e.message}")
         error_detail_map = {
             400: "errors.openai.400",
             401: "errors.openai.401",
@@ -449,8 +560,9 @@ async def chat(websocket: WebSocket):
 
     finally:
         if ask_request.source == ChatSourceTypes.openai_web:
-            openai_web_manager.semaphore.release()
-            await change_user_chat_status(user.id, OpenaiWebChatStatus.idling)
+            await openai_web_manager.scheduler.release(
+                account.source_id, time.time() - ask_start_time if is_completed else None)
+            await Coordinator().set_chat_status(user.id, OpenaiWebChatStatus.idling)
 
     ask_stop_time = time.time()
     queueing_time = 0
@@ -483,6 +595,13 @@ async def chat(websocket: WebSocket):
         logger.debug(
             f"terminated ask {conversation_id} ({ask_request.model}) because of error")
 
+    # 得到回复时才扣除对话次数，否则退回预留的次数
+    if has_got_reply:
+        reservation.commit()
+    else:
+        await reservation.refund()
+        user_cache.invalidate(user.id)
+
     if has_got_reply:
         assert message is not None, "has_got_reply but message is None"
 
@@ -516,50 +635,34 @@ async def chat(websocket: WebSocket):
                         str(message.id): message
                     },
                     current_node=message.id,
-                    current_model=message.model
+                    current_model=message.model,
+                    node_index=build_node_index({str(ask_message.id): ask_message, str(message.id): message})
                 )
 
                 await new_conv_history.save()
                 logger.debug(f"saved new api conversation history {conversation_id} to mongodb")
             else:
                 # 更新mongodb历史记录
-                conv_history = await OpenaiApiConversationHistoryDocument.get(conversation_id)
-                assert conv_history is not None, f"update api: conversation history {conversation_id} is None"
-                conv_history.update_time = datetime.now().astimezone(tz=timezone.utc)
-
-                conv_history.mapping[str(ask_message.id)] = ask_message
-                conv_history.mapping[str(message.id)] = message
-                conv_history.current_node = str(message.id)
-                conv_history.current_model = message.model
-
-                if ask_message.parent is not None:
-                    parent_message = conv_history.mapping.get(str(ask_message.parent))
-                    assert parent_message is not None, f"update api: parent message {ask_message.parent} is None"
-                    parent_message.children.append(message.id)
-                    conv_history.mapping[str(ask_message.parent)] = parent_message
-                await conv_history.save()
+                await append_messages_to_history(conversation_id, ask_message, message)
 
                 logger.debug(f"updated api conversation history {conversation_id} to mongodb")
 
         # TODO: 扣除 credits
 
+        # 设置默认标题需要请求 ChatGPT，在打开写 session 之前完成
+        if ask_request.new_conversation and ask_request.source == ChatSourceTypes.openai_web and \
+                ask_request.new_title is not None and ask_request.new_title.strip() != "":
+            try:
+                await openai_web_manager.set_conversation_title(str(conversation_id), ask_request.new_title,
+                                                                source_id=account.source_id)
+            except Exception as e:
+                logger.warning(f"set_conversation_title error {e.__class__.__name__}: {str(e)}")
+
         async with get_async_session_context() as session:
             # 若新建了对话，则添加到数据库
             if ask_request.new_conversation:
                 assert conversation_id is not None, "has_got_reply but conversation_id is None"
 
-                # 设置默认标题
-                if ask_request.source == ChatSourceTypes.openai_web and ask_request.new_title is not None and \
-                        ask_request.new_title.strip() != "":
-                    try:
-                        source_id = None
-                        if use_team:
-                            source_id = config.openai_web.team_account_id
-                        await openai_web_manager.set_conversation_title(str(conversation_id), ask_request.new_title,
-                                                                        source_id=source_id)
-                    except Exception as e:
-                        logger.warning(f"set_conversation_title error {e.__class__.__name__}: {str(e)}")
-
                 current_time = datetime.now().astimezone(tz=timezone.utc)
                 new_conv = BaseConversationSchema(
                     source=ask_request.source,
@@ -571,54 +674,47 @@ async def chat(websocket: WebSocket):
                     create_time=current_time,
                     update_time=current_time
                 )
-                if use_team:
-                    new_conv.source_id = config.openai_web.team_account_id
+                if account is not None:
+                    new_conv.source_id = account.source_id
                 conversation = BaseConversation(**new_conv.model_dump(exclude_unset=True))
                 session.add(conversation)
 
             else:
-                conversation = await session.get(BaseConversation, conversation.id)
+                # 对话已在 AskUnitOfWork.load() 中读取，重新加入 session 后直接 UPDATE，无需再次查询
                 conversation.update_time = datetime.now().astimezone(tz=timezone.utc)
                 # 更新当前模型
                 if conversation.current_model != ask_request.model:
                     conversation.current_model = ask_request.model
                 session.add(conversation)
 
-            # 扣除对话次数
-            source_setting = user.setting.openai_web if ask_request.source == ChatSourceTypes.openai_web else user.setting.openai_api
-
-            total_ask_count = source_setting.total_ask_count
-            model_ask_count = source_setting.per_model_ask_count.root.get(ask_request.model, -1)
-            assert model_ask_count, "model_ask_count is None"
-            if total_ask_count != -1 or model_ask_count != -1:
-
-                if total_ask_count != -1:
-                    assert total_ask_count > 0
-                    source_setting.total_ask_count -= 1
-                if model_ask_count != -1:
-                    assert model_ask_count > 0
-                    source_setting.per_model_ask_count.root[ask_request.model] = model_ask_count - 1
-
-                user_db = await session.get(User, user.id)
-                setattr(user_db.setting, ask_request.source, source_setting)
+            await session.commit()
 
-                session.add(user_db.setting)
+        if ask_request.source == ChatSourceTypes.openai_web:
+            meta = OpenaiWebAskLogMeta(source="openai_web", model=OpenaiWebChatModels(ask_request.model))
+        else:
+            meta = OpenaiApiAskLogMeta(source="openai_api", model=OpenaiApiChatModels(ask_request.model))
+
+        # 写入到 scope 中，供统计
+        LogSink().put(AskLogDocument(
+            meta=meta,
+            user_id=user.id,
+            queueing_time=queueing_time,
+            ask_time=ask_time,
+            conversation_id=conversation_id,
+            stream_frames_sent=stream.frames_sent if stream else None,
+            stream_frames_merged=stream.frames_merged if stream else None,
+            stream_bytes_saved=stream.bytes_saved if stream else None,
+        ), droppable=False)
 
-            await session.commit()
+        try:
+            await AskCounter().record(ask_request.source, ask_request.model)
+        except Exception as e:
+            logger.warning(f"Failed to record ask count: {e.__class__.__name__} {e}")
 
-            if ask_request.source == ChatSourceTypes.openai_web:
-                meta = OpenaiWebAskLogMeta(source="openai_web", model=OpenaiWebChatModels(ask_request.model))
-            else:
-                meta = OpenaiApiAskLogMeta(source="openai_api", model=OpenaiApiChatModels(ask_request.model))
-
-            # 写入到 scope 中，供统计
-            await AskLogDocument(
-                meta=meta,
-                user_id=user.id,
-                queueing_time=queueing_time,
-                ask_time=ask_time,
-                conversation_id=conversation_id,
-            ).create()
+        # 旧的对话历史缓存立即失效，再在后台刷新，下次打开对话时通常无需等待 ChatGPT
+        if ask_request.source == ChatSourceTypes.openai_web:
+            ConversationHistoryCache().expire(conversation.conversation_id)
+            ConversationHistoryCache().revalidate(conversation)
 
     websocket.scope["ask_websocket_close_code"] = websocket_code
     websocket.scope["ask_websocket_close_reason"] = websocket_reason
@@ -1,19 +1,23 @@
+import base64
+import json
 import uuid
-from typing import List, Union
+from datetime import datetime
+from typing import Optional
 
 import httpx
-from fastapi import APIRouter, Depends
+from fastapi import APIRouter, Depends, Query
 from fastapi.encoders import jsonable_encoder
-from sqlalchemy import select, and_, delete
+from sqlalchemy import select, and_, or_, delete
 
-from api.database.sqlalchemy import get_async_session_context
+from api.conversation_history_cache import ConversationHistoryCache
+from api.database.sqlalchemy import get_async_session_context, get_async_read_session_context
 from api.enums import ChatSourceTypes
 from api.exceptions import InvalidParamsException, AuthorityDenyException, InternalException, OpenaiWebException
 from api.models.db import User, OpenaiWebConversation, BaseConversation
 from api.models.doc import OpenaiApiConversationHistoryDocument, OpenaiWebConversationHistoryDocument, \
-    BaseConversationHistory
-from api.response import response
-from api.schemas import OpenaiWebConversationSchema, BaseConversationSchema, OpenaiApiConversationSchema
+    BaseConversationHistory, OpenaiWebChatMessageMetadata
+from api.response import response, CustomJSONStreamingResponse
+from api.schemas import BaseConversationSchema, ConversationListPage
 from api.schemas.openai_schemas import OpenaiChatInterpreterInfo
 from api.sources import OpenaiWebChatManager
 from api.users import current_active_user, current_super_user
@@ -22,10 +26,20 @@ from utils.logger import get_logger
 logger = get_logger(__name__)
 router = APIRouter()
 openai_web_manager = OpenaiWebChatManager()
+history_cache = ConversationHistoryCache()
+
+CONVERSATION_LIST_FIELDS = tuple(BaseConversationSchema.model_fields.keys())
+MAX_CONVERSATION_PAGE_SIZE = 1000
+# 消息 metadata 中可能很大的字段 -> 模型中的字段名
+HEAVY_MESSAGE_METADATA_FIELDS = {
+    "aggregate_result": "aggregate_result",
+    "citations": "citations",
+    "_cite_metadata": "cite_metadata",
+}
 
 
 async def _get_conversation_by_id(conversation_id: str | uuid.UUID, user: User = Depends(current_active_user)):
-    async with get_async_session_context() as session:
+    async with get_async_read_session_context() as session:
         r = await session.execute(
             select(BaseConversation).where(BaseConversation.conversation_id == str(conversation_id)))
         conversation = r.scalars().one_or_none()
@@ -36,62 +50,127 @@ async def _get_conversation_by_id(conversation_id: str | uuid.UUID, user: User =
         return conversation
 
 
-@router.get("/conv", tags=["conversation"],
-            response_model=List[
-                BaseConversationSchema | OpenaiWebConversationSchema | OpenaiApiConversationSchema])
-async def get_my_conversations(user: User = Depends(current_active_user)):
+def _encode_cursor(update_time: Optional[datetime], conversation_pk: int) -> str:
+    raw = json.dumps([update_time.isoformat() if update_time is not None else None, conversation_pk])
+    return base64.urlsafe_b64encode(raw.encode()).decode()
+
+
+def _decode_cursor(cursor: str) -> tuple[Optional[datetime], int]:
+    try:
+        update_time, conversation_pk = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        return (datetime.fromisoformat(update_time) if update_time is not None else None), int(conversation_pk)
+    except (ValueError, TypeError):
+        raise InvalidParamsException("errors.invalidCursor")
+
+
+def _after_cursor(update_time: Optional[datetime], conversation_pk: int, nulls_first: bool):
     """
-    返回自己的有效会话
+    按 update_time DESC, id DESC 排序时位于游标之后的行
+    update_time 为空的行在 PostgreSQL 中排在最前，在 SQLite 中排在最后
     """
-    async with get_async_session_context() as session:
-        r = await session.execute(select(BaseConversation).where(
-            and_(BaseConversation.user_id == user.id, BaseConversation.is_valid == True)
-        ))
-        results = r.scalars().all()
-        results = jsonable_encoder(results)
-        return results
+    table = BaseConversation.__table__
+    if update_time is None:
+        after = and_(table.c.update_time.is_(None), table.c.id < conversation_pk)
+        return or_(after, table.c.update_time.is_not(None)) if nulls_first else after
+    after = or_(table.c.update_time < update_time,
+                and_(table.c.update_time == update_time, table.c.id < conversation_pk))
+    return after if nulls_first else or_(after, table.c.update_time.is_(None))
 
 
-@router.get("/conv/all", tags=["conversation"],
-            response_model=List[BaseConversationSchema])
-async def get_all_conversations(_user: User = Depends(current_super_user), valid_only: bool = False):
-    async with get_async_session_context() as session:
-        stat = True
-        if valid_only:
-            stat = BaseConversation.is_valid == True
-        r = await session.execute(select(BaseConversation).where(stat))
-        results = r.scalars().all()
-        results = jsonable_encoder(results)
-        return results
+def _parse_fields(fields: Optional[str]) -> list[str]:
+    if not fields:
+        return list(CONVERSATION_LIST_FIELDS)
+    result = [field.strip() for field in fields.split(",") if field.strip()]
+    invalid = [field for field in result if field not in CONVERSATION_LIST_FIELDS]
+    if invalid:
+        raise InvalidParamsException(f"Invalid fields: {', '.join(invalid)}")
+    return result
 
 
-@router.get("/conv/{conversation_id}", tags=["conversation"],
-            response_model=OpenaiApiConversationHistoryDocument | OpenaiWebConversationHistoryDocument | BaseConversationHistory)
-async def get_conversation_history(conversation: BaseConversation = Depends(_get_conversation_by_id),
-                                   user: User = Depends(current_active_user)):
+async def _list_conversations(criteria: list, limit: int, cursor: Optional[str],
+                              fields: Optional[str]) -> ConversationListPage:
+    """
+    键集分页：只读取所需的列，不构造 ORM 对象
+    """
+    table = BaseConversation.__table__
+    output_fields = _parse_fields(fields)
+    # 生成游标需要 id 和 update_time
+    selected_fields = list(dict.fromkeys([*output_fields, "id", "update_time"]))
+    async with get_async_read_session_context() as session:
+        stmt = select(*[table.c[field] for field in selected_fields]).where(and_(True, *criteria))
+        if cursor:
+            update_time, conversation_pk = _decode_cursor(cursor)
+            stmt = stmt.where(_after_cursor(update_time, conversation_pk, session.bind.dialect.name == "postgresql"))
+        stmt = stmt.order_by(table.c.update_time.desc(), table.c.id.desc()).limit(limit + 1)
+        rows = (await session.execute(stmt)).mappings().all()
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = _encode_cursor(rows[-1]["update_time"], rows[-1]["id"])
+    # 只设置请求的字段，返回时由 response_model_exclude_unset 略去其余字段
+    items = [{field: row[field] for field in output_fields} for row in rows]
+    return ConversationListPage(items=items, next_cursor=next_cursor)
+
+
+@router.get("/conv", tags=["conversation"], response_model=ConversationListPage,
+            response_model_exclude_unset=True)
+async def get_my_conversations(user: User = Depends(current_active_user),
+                               limit: int = Query(100, ge=1, le=MAX_CONVERSATION_PAGE_SIZE),
+                               cursor: Optional[str] = None,
+                               source: Optional[ChatSourceTypes] = None,
+                               model: Optional[str] = None,
+                               fields: Optional[str] = None):
+    """
+    分页返回自己的有效会话，从最近更新的开始
+    :param cursor: 上一页返回的 next_cursor
+    :param fields: 逗号分隔的字段名，为空时返回全部字段
+    """
+    criteria = [BaseConversation.user_id == user.id, BaseConversation.is_valid == True]
+    if source is not None:
+        criteria.append(BaseConversation.source == source)
+    if model is not None:
+        criteria.append(BaseConversation.current_model == model)
+    return await _list_conversations(criteria, limit, cursor, fields)
+
+
+@router.get("/conv/all", tags=["conversation"], response_model=ConversationListPage,
+            response_model_exclude_unset=True)
+async def get_all_conversations(_user: User = Depends(current_super_user),
+                                limit: int = Query(100, ge=1, le=MAX_CONVERSATION_PAGE_SIZE),
+                                cursor: Optional[str] = None,
+                                is_valid: Optional[bool] = None,
+                                user_id: Optional[int] = None,
+                                source: Optional[ChatSourceTypes] = None,
+                                model: Optional[str] = None,
+                                fields: Optional[str] = None):
+    """
+    分页返回所有会话，参数同 GET /conv
+    """
+    criteria = []
+    if is_valid is not None:
+        criteria.append(BaseConversation.is_valid == is_valid)
+    if user_id is not None:
+        criteria.append(BaseConversation.user_id == user_id)
+    if source is not None:
+        criteria.append(BaseConversation.source == source)
+    if model is not None:
+        criteria.append(BaseConversation.current_model == model)
+    return await _list_conversations(criteria, limit, cursor, fields)
+
+
+async def _get_conversation_history(conversation: BaseConversation) -> BaseConversationHistory:
     if conversation.source == ChatSourceTypes.openai_web:
         try:
-            result = await openai_web_manager.get_conversation_history(conversation.conversation_id,
-                                                                       conversation.source_id)
-            if result.current_model != conversation.current_model or not conversation.is_valid:
-                async with get_async_session_context() as session:
-                    conversation = await session.get(BaseConversation, conversation.id)
-                    conversation.current_model = result.current_model
-                    conversation.is_valid = True
-                    await session.commit()
-            return result
+            # 已失效的对话直接从 ChatGPT 获取，以便确认其是否仍然存在
+            if not conversation.is_valid:
+                return await history_cache.refresh(conversation)
+            return await history_cache.get(conversation)
         except httpx.TimeoutException as e:
             logger.warning(
                 f"{conversation.conversation_id} get conversation history timeout: {e.__class__.__name__}")
             raise InternalException("errors.timeout")
-        except OpenaiWebException as e:
-            if e.code == 404:
-                if conversation.is_valid:
-                    async with get_async_session_context() as session:
-                        conversation = await session.get(BaseConversation, conversation.id)
-                        conversation.is_valid = False
-                        await session.commit()
-            raise e
+        except OpenaiWebException:
+            raise
         except Exception as e:
             logger.warning(
                 f"{conversation.conversation_id} get conversation history failed: {e.__class__.__name__} {e}")
@@ -103,9 +182,69 @@ async def get_conversation_history(conversation: BaseConversation = Depends(_get
         return doc
 
 
+def _get_current_branch(mapping: dict, current_node: uuid.UUID) -> dict:
+    """
+    从 current_node 沿 parent 回溯到根节点，按从根到 current_node 的顺序返回
+    """
+    branch = []
+    node_id = str(current_node)
+    while node_id is not None and node_id in mapping and len(branch) < len(mapping):
+        branch.append(node_id)
+        parent = mapping[node_id].parent
+        node_id = str(parent) if parent is not None else None
+    return {node_id: mapping[node_id] for node_id in reversed(branch)}
+
+
+def _project_message(message, excluded_metadata_fields: list[str]):
+    if not excluded_metadata_fields or not isinstance(message.metadata, OpenaiWebChatMessageMetadata):
+        return message
+    metadata = message.metadata.model_copy(update=dict.fromkeys(excluded_metadata_fields))
+    return message.model_copy(update={"metadata": metadata})
+
+
+def _history_response(doc: BaseConversationHistory, stream: bool, current_branch_only: bool, fields: Optional[str]):
+    excluded_metadata_fields = []
+    if fields is not None:
+        included = {field.strip() for field in fields.split(",") if field.strip()}
+        invalid = included - HEAVY_MESSAGE_METADATA_FIELDS.keys()
+        if invalid:
+            raise InvalidParamsException(f"Invalid fields: {', '.join(sorted(invalid))}")
+        excluded_metadata_fields = [field_name for field, field_name in HEAVY_MESSAGE_METADATA_FIELDS.items()
+                                    if field not in included]
+    if not stream and not current_branch_only and not excluded_metadata_fields:
+        return doc
+
+    mapping = _get_current_branch(doc.mapping, doc.current_node) if current_branch_only else doc.mapping
+    items = ((node_id, _project_message(message, excluded_metadata_fields)) for node_id, message in mapping.items())
+    if stream:
+        return CustomJSONStreamingResponse(doc.model_dump(by_alias=True, exclude={"mapping", "node_index"}), "mapping", items)
+    return doc.model_copy(update={"mapping": dict(items)})
+
+
+@router.get("/conv/{conversation_id}", tags=["conversation"],
+            response_model=OpenaiApiConversationHistoryDocument | OpenaiWebConversationHistoryDocument | BaseConversationHistory,
+            response_model_exclude={"node_index"})
+async def get_conversation_history(conversation: BaseConversation = Depends(_get_conversation_by_id),
+                                   user: User = Depends(current_active_user),
+                                   stream: bool = False, current_branch_only: bool = False,
+                                   fields: Optional[str] = None):
+    """
+    返回对话历史，可只返回当前分支、省略消息 metadata 中的大字段
+    :param stream: 流式返回，mapping 中的消息逐条编码后写出
+    :param current_branch_only: 只返回从根节点到 current_node 的消息
+    :param fields: 逗号分隔，指定时消息 metadata 中只保留列出的大字段（aggregate_result、citations、_cite_metadata），
+                   其余大字段返回 null；不指定时返回完整记录
+    """
+    doc = await _get_conversation_history(conversation)
+    return _history_response(doc, stream, current_branch_only, fields)
+
+
 @router.get("/conv/{conversation_id}/cache", tags=["conversation"],
-            response_model=OpenaiApiConversationHistoryDocument | OpenaiWebConversationHistoryDocument | BaseConversationHistory)
-async def get_conversation_history_from_cache(conversation_id, user: User = Depends(current_super_user)):
+            response_model=OpenaiApiConversationHistoryDocument | OpenaiWebConversationHistoryDocument | BaseConversationHistory,
+            response_model_exclude={"node_index"})
+async def get_conversation_history_from_cache(conversation_id, user: User = Depends(current_super_user),
+                                              stream: bool = False, current_branch_only: bool = False,
+                                              fields: Optional[str] = None):
     conversation = await _get_conversation_by_id(conversation_id, user=user)
     if conversation.source == ChatSourceTypes.openai_web:
         doc = await OpenaiWebConversationHistoryDocument.get(conversation.conversation_id)
@@ -113,7 +252,7 @@ async def get_conversation_history_from_cache(conversation_id, user: User = Depe
         doc = await OpenaiApiConversationHistoryDocument.get(conversation.conversation_id)
     if doc is None:
         raise InvalidParamsException("errors.conversationNotFound")
-    return doc
+    return _history_response(doc, stream, current_branch_only, fields)
 
 
 @router.delete("/conv/{conversation_id}", tags=["conversation"])
@@ -153,6 +292,7 @@ async def vanish_conversation(conversation: BaseConversation = Depends(_get_conv
         doc = await OpenaiApiConversationHistoryDocument.get(conversation.conversation_id)
     if doc is not None:
         await doc.delete()
+    history_cache.remove(conversation.conversation_id)
     async with get_async_session_context() as session:
         await session.execute(
             delete(BaseConversation).where(BaseConversation.conversation_id == conversation.conversation_id))
@@ -198,8 +338,8 @@ async def assign_conversation(username: str, conversation: BaseConversation = De
 
 @router.delete("/conv", tags=["conversation"])
 async def delete_all_conversation(_user: User = Depends(current_super_user)):
-    await openai_web_manager.clear_conversations()
-    await openai_web_manager.clear_conversations(use_team=True)
+    for account in openai_web_manager.accounts.values():
+        await openai_web_manager.clear_conversations(account=account)
     async with get_async_session_context() as session:
         await session.execute(delete(OpenaiWebConversation))
         await session.commit()
@@ -210,17 +350,18 @@ async def delete_all_conversation(_user: User = Depends(current_super_user)):
 async def generate_conversation_title(message_id: str,
                                       conversation: OpenaiWebConversation = Depends(_get_conversation_by_id),
                                       _user: User = Depends(current_active_user)):
+    # 请求 ChatGPT 期间不占用数据库连接
+    title = await openai_web_manager.generate_conversation_title(conversation.conversation_id, message_id,
+                                                                 conversation.source_id)
+    if not title:
+        raise InternalException("errors.generateTitleFailed")
     async with get_async_session_context() as session:
-        title = await openai_web_manager.generate_conversation_title(conversation.conversation_id, message_id,
-                                                                     conversation.source_id)
-        if title:
-            conversation.title = title
-            session.add(conversation)
-            await session.commit()
-            await session.refresh(conversation)
-        else:
-            raise InternalException("errors.generateTitleFailed")
-        return title
+        conversation.title = title
+        session.add(conversation)
+        await session.commit()
+        await session.refresh(conversation)
+    history_cache.invalidate(conversation.conversation_id)
+    return title
 
 
 @router.get("/conv/{conversation_id}/interpreter", tags=["conversation"], response_model=OpenaiChatInterpreterInfo)
@@ -7,7 +7,7 @@ from fastapi_cache.decorator import cache
 from starlette.responses import FileResponse
 
 from api.conf import Config
-from api.database.sqlalchemy import get_async_session_context
+from api.database.sqlalchemy import get_async_session_context, get_async_read_session_context
 from api.enums.options import OpenaiWebFileUploadStrategyOption
 from api.exceptions import InvalidRequestException, ResourceNotFoundException, AuthorityDenyException, InternalException
 from api.file_provider import FileProvider
@@ -47,15 +47,14 @@ async def upload_file_to_local(file: UploadFile = File(...), user: User = Depend
     if file.size > config.data.max_file_upload_size:
         raise InvalidRequestException(f"File too large! Max size: {config.data.max_file_upload_size}")
 
-    async with get_async_session_context() as session:
-        file_info = await file_provider.save_file(file, user.id, session)
+    file_info = await file_provider.save_file(file, user.id)
 
     return UploadedFileInfoSchema.model_validate(file_info)
 
 
 @router.get("/files/local/download/{file_id}", tags=["files"])
 async def download_file_from_local(file_id: uuid.UUID, user: User = Depends(current_active_user)):
-    async with get_async_session_context() as session:
+    async with get_async_read_session_context() as session:
         file_info = await file_provider.get_file_info(file_id, session)
     if not file_info:
         raise ResourceNotFoundException(f"No such file: {file_id}")
@@ -136,31 +135,33 @@ async def __browser_upload_schema__():
 
 @router.post("/files/openai-web/upload-complete/{file_id}", tags=["files"], response_model=UploadedFileInfoSchema)
 async def complete_upload_to_openai(file_id: uuid.UUID, user: User = Depends(current_active_user)):
-    async with get_async_session_context() as session:
+    async with get_async_read_session_context() as session:
         file_info = await file_provider.get_file_info(file_id, session)
-        if not file_info:
-            raise ResourceNotFoundException(f"No such file: {file_id}")
-        if file_info.openai_web_info is None or file_info.openai_web_info.file_id is None:
-            raise InvalidRequestException(f"File {file_id} not uploaded to OpenAI Web")
-        if file_info.openai_web_info.download_url is not None:
-            raise InvalidRequestException(f"File {file_id} already uploaded to server")
-        if not user.is_superuser and file_info.uploader_id != user.id:
-            raise AuthorityDenyException(f"File {file_id} not uploaded by you")
-        if file_info.storage_path is not None:
-            raise InvalidRequestException(f"File {file_id} already uploaded to server")
-
-        file_info_schema = UploadedFileInfoSchema.model_validate(file_info)
-        openai_web_info = file_info_schema.openai_web_info
-        download_url = await openai_web_manager.check_file_uploaded(file_info.openai_web_info.file_id,
-                                                                    user.setting.openai_web.use_team)
-        openai_web_info.download_url = download_url
-        openai_web_info.upload_url = None
-        file_info.openai_web_info = openai_web_info
+    if not file_info:
+        raise ResourceNotFoundException(f"No such file: {file_id}")
+    if file_info.openai_web_info is None or file_info.openai_web_info.file_id is None:
+        raise InvalidRequestException(f"File {file_id} not uploaded to OpenAI Web")
+    if file_info.openai_web_info.download_url is not None:
+        raise InvalidRequestException(f"File {file_id} already uploaded to server")
+    if not user.is_superuser and file_info.uploader_id != user.id:
+        raise AuthorityDenyException(f"File {file_id} not uploaded by you")
+    if file_info.storage_path is not None:
+        raise InvalidRequestException(f"File {file_id} already uploaded to server")
+
+    # 请求 OpenAI 期间不占用数据库连接
+    file_info_schema = UploadedFileInfoSchema.model_validate(file_info)
+    openai_web_info = file_info_schema.openai_web_info
+    download_url = await openai_web_manager.check_file_uploaded(file_info.openai_web_info.file_id,
+                                                                user.setting.openai_web.use_team)
+    openai_web_info.download_url = download_url
+    openai_web_info.upload_url = None
+    file_info.openai_web_info = openai_web_info
 
+    async with get_async_session_context() as session:
         session.add(file_info)
         await session.commit()
 
-        return UploadedFileInfoSchema.model_validate(file_info)
+    return UploadedFileInfoSchema.model_validate(file_info)
 
 
 @router.post("/files/local/upload-to-openai-web/{file_id}", tags=["files"], response_model=UploadedFileInfoSchema)
@@ -168,17 +169,20 @@ async def upload_local_file_to_openai_web(file_id: uuid.UUID, user: User = Depen
     """
     将服务器上已有的文件上传到 OpenAI Web（Azure blob）
     """
-    async with get_async_session_context() as session:
+    async with get_async_read_session_context() as session:
         file_info = await file_provider.get_file_info(file_id, session)
-        if not file_info:
-            raise ResourceNotFoundException(f"No such file: {file_id}")
-        if file_info.openai_web_info is not None:
-            raise InvalidRequestException(f"File {file_id} already uploaded to OpenAI Web")
-        if not user.is_superuser and file_info.uploader_id != user.id:
-            raise AuthorityDenyException(f"File {file_id} not uploaded by you")
-
-        openai_web_file_info = await openai_web_manager.upload_file_in_server(file_info, user.setting.openai_web.use_team)
-        file_info.openai_web_info = openai_web_file_info
+    if not file_info:
+        raise ResourceNotFoundException(f"No such file: {file_id}")
+    if file_info.openai_web_info is not None:
+        raise InvalidRequestException(f"File {file_id} already uploaded to OpenAI Web")
+    if not user.is_superuser and file_info.uploader_id != user.id:
+        raise AuthorityDenyException(f"File {file_id} not uploaded by you")
+
+    # 上传期间不占用数据库连接
+    openai_web_file_info = await openai_web_manager.upload_file_in_server(file_info, user.setting.openai_web.use_team)
+    file_info.openai_web_info = openai_web_file_info
+    async with get_async_session_context() as session:
+        session.add(file_info)
         await session.commit()
 
-        return UploadedFileInfoSchema.model_validate(file_info)
+    return UploadedFileInfoSchema.model_validate(file_info)
@@ -1,24 +1,27 @@
 import random
 from datetime import datetime, timedelta, timezone
+from typing import Optional
+
 import httpx
 from fastapi import APIRouter, Depends
 from fastapi_cache.decorator import cache
-from sqlalchemy import select
+from sqlalchemy import select, func, case, and_
 
 import api.enums
 import api.globals as g
 from api.conf import Config, Credentials
 from api.conf.config import ConfigModel
 from api.conf.credentials import CredentialsModel
-from api.database.sqlalchemy import get_async_session_context, get_user_db_context
-from api.enums import OpenaiWebChatStatus
-from api.exceptions import InvalidParamsException, OpenaiWebException
-from api.models.db import User, OpenaiWebConversation
-from api.models.doc import RequestLogDocument, AskLogDocument
+from api.coordination import Coordinator
+from api.database.sqlalchemy import get_async_read_session_context, get_user_db_context
+from api.enums import OpenaiWebChatStatus, ChatSourceTypes
+from api.exceptions import OpenaiWebException
+from api.models.db import User, BaseConversation
 from api.schemas import LogFilterOptions, SystemInfo, UserCreate, UserSettingSchema, OpenaiWebSourceSettingSchema, \
     OpenaiApiSourceSettingSchema, RequestLogAggregation, AskLogAggregation
 from api.schemas.openai_schemas import OpenaiWebAccountsCheckResponse
 from api.sources import OpenaiWebChatManager, OpenaiApiChatManager
+from api.stats_rollup import query_request_stats, query_ask_stats
 from api.users import current_super_user, get_user_manager_context
 from utils.admin import sync_conversations
 from utils.logger import get_logger
@@ -31,28 +34,26 @@ router = APIRouter()
 
 
 async def count_active_users():
-    async with get_async_session_context() as session:
-        users = await session.execute(select(User))
-        users = users.scalars().all()
-    queueing_count = 0
-    active_user_in_5m = 0
-    active_user_in_1h = 0
-    active_user_in_1d = 0
+    """
+    直接在数据库中聚合计数，不加载 User 对象
+    :return: (5 分钟内活跃, 1 小时内活跃, 1 天内活跃, 排队中, 用户总数)
+    """
     current_time = datetime.now().astimezone(tz=timezone.utc)
-    for user in users:
-        if not user.last_active_time:
-            continue
-        if user.setting.openai_web_chat_status == OpenaiWebChatStatus.queueing:
-            queueing_count += 1
-        if user.is_superuser:  # 管理员不计入在线人数
-            continue
-        if user.last_active_time > current_time - timedelta(minutes=5):
-            active_user_in_5m += 1
-        if user.last_active_time > current_time - timedelta(hours=1):
-            active_user_in_1h += 1
-        if user.last_active_time > current_time - timedelta(days=1):
-            active_user_in_1d += 1
-    return active_user_in_5m, active_user_in_1h, active_user_in_1d, queueing_count, users
+
+    def _count_active_since(delta: timedelta):
+        # 管理员不计入在线人数
+        return func.count(case((and_(User.is_superuser == False, User.last_active_time > current_time - delta), 1)))
+
+    async with get_async_read_session_context() as session:
+        r = await session.execute(select(
+            _count_active_since(timedelta(minutes=5)),
+            _count_active_since(timedelta(hours=1)),
+            _count_active_since(timedelta(days=1)),
+            func.count(User.id),
+        ))
+        active_user_in_5m, active_user_in_1h, active_user_in_1d, total_user_count = r.one()
+    queueing_count = await Coordinator().count_chat_status(OpenaiWebChatStatus.queueing)
+    return active_user_in_5m, active_user_in_1h, active_user_in_1d, queueing_count, total_user_count
 
 
 @cache(expire=60)
@@ -63,15 +64,18 @@ async def count_active_users_cached():
 
 @router.get("/system/info", tags=["system"], response_model=SystemInfo)
 async def get_system_info(_user: User = Depends(current_super_user)):
-    active_user_in_5m, active_user_in_1h, active_user_in_1d, queueing_count, users = await count_active_users()
-    async with get_async_session_context() as session:
-        conversations = await session.execute(select(OpenaiWebConversation))
-        conversations = conversations.scalars().all()
+    _, _, _, _, total_user_count = await count_active_users()
+    async with get_async_read_session_context() as session:
+        r = await session.execute(
+            select(func.count(), func.count(case((BaseConversation.is_valid == True, 1))))
+            .where(BaseConversation.source == ChatSourceTypes.openai_web)
+        )
+        total_conversation_count, valid_conversation_count = r.one()
     result = SystemInfo(
         startup_time=g.startup_time,
-        total_user_count=len(users),
-        total_conversation_count=len(conversations),
-        valid_conversation_count=len([c for c in conversations if c.is_valid]),
+        total_user_count=total_user_count,
+        total_conversation_count=total_conversation_count,
+        valid_conversation_count=valid_conversation_count,
     )
     return result
 
@@ -79,101 +83,25 @@ async def get_system_info(_user: User = Depends(current_super_user)):
 @router.get("/system/stats/request", tags=["system"], response_model=list[RequestLogAggregation])
 @cache(expire=30)
 async def get_request_statistics(
-        # TODO: add filter options
-        # start_query_time: Optional[datetime] = None,
-        # end_query_time: Optional[datetime] = None,
-        granularity: int = 1800, _user: User = Depends(current_super_user)
+        start_time: Optional[datetime] = None,
+        end_time: Optional[datetime] = None,
+        granularity: int = 1800, group_by_route: bool = True, _user: User = Depends(current_super_user)
 ):
-    if granularity <= 0 or granularity % 60 != 0:
-        raise InvalidParamsException("Invalid granularity")
-
-    # TODO: round float to 2 decimal places
-    pipeline = [
-        {
-            "$project": {
-                # 对齐时间到整点
-                "start_time": {
-                    "$toDate": {
-                        "$subtract": [{"$toLong": "$time"}, {"$mod": [{"$toLong": "$time"}, granularity * 1000]}]
-                    }
-                },
-                "route_path": "$meta.route_path",
-                "method": "$meta.method",
-                "user_id": 1,
-                "elapsed_ms": 1
-            }
-        },
-        {
-            "$group": {
-                "_id": {
-                    "start_time": "$start_time",
-                    "route_path": "$route_path",
-                    "method": "$method"
-                },
-                "count": {"$sum": 1},
-                "user_ids": {"$addToSet": "$user_id"},
-                "avg_elapsed_ms": {"$avg": "$elapsed_ms"}
-            }
-        },
-        {
-            "$sort": {"_id": 1}
-        }
-    ]
-
-    result = await RequestLogDocument.aggregate(
-        pipeline
-    ).to_list()
-
-    return result
+    """
+    从预先聚合的统计汇总中读取，user_count 为估计的去重用户数
+    group_by_route 为 False 时将同一时间段内的所有路由合并
+    """
+    return await query_request_stats(granularity, start_time, end_time, group_by_route)
 
 
 @router.get("/system/stats/ask", tags=["system"], response_model=list[AskLogAggregation])
 @cache(expire=30)
 async def get_ask_statistics(
-        # start_query_time: Optional[datetime] = None,
-        # end_query_time: Optional[datetime] = None,
+        start_time: Optional[datetime] = None,
+        end_time: Optional[datetime] = None,
         granularity: int = 1800, _user: User = Depends(current_super_user)
 ):
-    if granularity <= 0 or granularity % 60 != 0:
-        raise InvalidParamsException("Invalid granularity")
-
-    pipeline = [
-        {
-            "$project": {
-                # 对齐时间到整点
-                "start_time": {
-                    "$toDate": {
-                        "$subtract": [{"$toLong": "$time"}, {"$mod": [{"$toLong": "$time"}, granularity * 1000]}]
-                    }
-                },
-                "meta": 1,
-                "user_id": 1,
-                "ask_time": 1,
-                "queueing_time": 1
-            }
-        },
-        {
-            "$group": {
-                "_id": {
-                    "start_time": "$start_time",
-                    "meta": "$meta"
-                },
-                "count": {"$sum": 1},
-                "user_ids": {"$addToSet": "$user_id"},
-                "total_ask_time": {"$sum": "$ask_time"},
-                "total_queueing_time": {"$sum": "$queueing_time"},
-            }
-        },
-        {
-            "$sort": {"_id": 1}
-        }
-    ]
-
-    result = await AskLogDocument.aggregate(
-        pipeline
-    ).to_list()
-
-    return result
+    return await query_ask_stats(granularity, start_time, end_time)
 
 
 @router.get("/system/config", tags=["system"], response_model=ConfigModel)
@@ -208,8 +136,11 @@ async def update_credentials(credentials_model: CredentialsModel, _user: User =
 
 
 @router.post("/system/action/sync-openai-web-conv", tags=["system"])
-async def sync_openai_web_conversations(_user: User = Depends(current_super_user)):
-    exception = await sync_conversations()
+async def sync_openai_web_conversations(full: bool = False, _user: User = Depends(current_super_user)):
+    """
+    full 为 True 时全量同步，并将 ChatGPT 中已不存在的对话标记为无效；否则只同步上次同步后更新的对话
+    """
+    exception = await sync_conversations(full=full)
     if exception:
         if isinstance(exception, httpx.ConnectError):
             raise OpenaiWebException("Failed to connect to ChatGPT server. Did you set the correct chatgpt_base_url?")
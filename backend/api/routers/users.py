@@ -8,13 +8,15 @@ from sqlalchemy.future import select
 from starlette.requests import Request
 
 from api.conf import Config
-from api.database.sqlalchemy import get_async_session_context, get_user_db_context
+from api.coordination import Coordinator
+from api.database.sqlalchemy import get_async_session_context, get_async_read_session_context, get_user_db_context
+from api.enums import OpenaiWebChatStatus
 from api.exceptions import UserNotExistException, AuthenticationFailedException
 from api.models.db import User
 from api.response import response
 from api.schemas import UserRead, UserUpdate, UserCreate, UserUpdateAdmin, UserReadAdmin, UserSettingSchema
 from api.users import auth_backend, fastapi_users, current_active_user, get_user_manager_context, current_super_user, \
-    get_user_manager, UserManager
+    get_user_manager, UserManager, user_cache
 
 router = APIRouter()
 config = Config()
@@ -69,7 +71,7 @@ async def register(
         _user: User = Depends(current_super_user),
 ):
     """注册时不能指定setting，使用默认setting"""
-    async with get_async_session_context() as session:
+    async with get_async_read_session_context() as session:
         async with get_user_db_context(session) as user_db:
             async with get_user_manager_context(user_db) as user_manager:
                 user = await user_manager.create(user_create, safe=False, request=request)
@@ -78,10 +80,14 @@ async def register(
 
 @router.get("/user", tags=["user"])
 async def get_all_users(_user: User = Depends(current_super_user)):
-    async with get_async_session_context() as session:
+    async with get_async_read_session_context() as session:
         r = await session.execute(select(User))
-        results = r.scalars().all()
-        return results
+        results = [UserReadAdmin.model_validate(user) for user in r.scalars().all()]
+    # 对话状态由 Coordinator 维护，数据库中的 openai_web_chat_status 不再更新
+    chat_statuses = await Coordinator().get_chat_statuses()
+    for user in results:
+        user.setting.openai_web_chat_status = chat_statuses.get(user.id, OpenaiWebChatStatus.idling)
+    return results
 
 
 # router.include_router(
@@ -118,7 +124,7 @@ async def update_me(
         user_update: UserUpdate,  # type: ignore
         _user: User = Depends(current_active_user),
 ):
-    async with get_async_session_context() as session:
+    async with get_async_read_session_context() as session:
         async with get_user_db_context(session) as user_db:
             async with get_user_manager_context(user_db) as user_manager:
                 user = await session.get(User, _user.id)
@@ -130,7 +136,7 @@ async def update_me(
 
 @router.get("/user/{user_id}", response_model=UserReadAdmin, tags=["user"])
 async def admin_get_user(user_id: int, _user: User = Depends(current_super_user)):
-    async with get_async_session_context() as session:
+    async with get_async_read_session_context() as session:
         user = await session.get(User, user_id)
         if user is None:
             raise UserNotExistException()
@@ -141,7 +147,7 @@ async def admin_get_user(user_id: int, _user: User = Depends(current_super_user)
 @router.patch("/user/{user_id}", tags=["user"])
 async def admin_update_user(user_update_admin: UserUpdateAdmin, request: Request,
                             user_id: int, _user: User = Depends(current_super_user)):
-    async with get_async_session_context() as session:
+    async with get_async_read_session_context() as session:
         async with get_user_db_context(session) as user_db:
             async with get_user_manager_context(user_db) as user_manager:
                 user = await session.get(User, user_id)
@@ -157,6 +163,7 @@ async def admin_delete_user(user_id: int, _user: User = Depends(current_super_us
         user = await session.get(User, user_id)
         await session.delete(user)
         await session.commit()
+        user_cache.invalidate(user_id)
         return None
 
 
@@ -171,4 +178,5 @@ async def admin_update_user_setting(user_id: int, user_setting: UserSettingSchem
             setattr(user.setting, key, value)
         await session.commit()
         await session.refresh(user)
+        user_cache.invalidate(user_id)
         return UserReadAdmin.model_validate(user)
@@ -1,7 +1,7 @@
 import datetime
 import uuid
 from enum import auto
-from typing import Literal, Optional, Annotated, Union
+from typing import Literal, Optional, Annotated, Union, Any
 
 from pydantic import ConfigDict, BaseModel, root_validator, validator, Field, model_validator
 from strenum import StrEnum
@@ -42,6 +42,7 @@ class AskRequest(BaseModel):
     openai_web_attachments: Optional[list[OpenaiWebChatMessageMetadataAttachment]] = None
     openai_web_multimodal_image_parts: Optional[list[OpenaiWebChatMessageMultimodalTextContentImagePart]] = None
     arkose_token: Optional[str] = None
+    accept_delta: bool = False  # 客户端是否支持 delta 帧；为 False 时每帧都发送完整消息
 
     @model_validator(mode='before')
     @classmethod
@@ -61,16 +62,32 @@ class AskResponseType(StrEnum):
     waiting = auto()
     queueing = auto()
     message = auto()
+    delta = auto()
     error = auto()
 
 
+class AskMessageDelta(BaseModel):
+    """
+    相对于同一 id 的上一帧消息的变化
+    text_append: 追加到正文末尾的文本（content.parts 的最后一项，或 content.text）
+    changed: 其余发生变化的顶层字段，整体替换
+    """
+    id: uuid.UUID
+    text_append: Optional[str] = None
+    changed: Optional[dict[str, Any]] = None
+
+
 class AskResponse(BaseModel):
     type: AskResponseType
     tip: str = None
     conversation_id: uuid.UUID = None
     message: Optional[
         Annotated[Union[OpenaiWebChatMessage, OpenaiApiChatMessage], Field(discriminator='source')]] = None
+    delta: Optional[AskMessageDelta] = None
     error_detail: str | None = None
+    queue_position: Optional[int] = None
+    estimated_wait_seconds: Optional[float] = None
+    retry_after_seconds: Optional[int] = None
 
 
 class BaseConversationSchema(BaseModel):
@@ -100,3 +117,27 @@ class OpenaiWebConversationSchema(BaseConversationSchema):
 
 class OpenaiApiConversationSchema(BaseConversationSchema):
     source: Literal["openai_api"]
+
+
+class ConversationListItemSchema(BaseModel):
+    """
+    对话列表中的一项，字段与 BaseConversationSchema 相同；只返回请求的字段，因此均为可选
+    """
+    id: Optional[int] = None
+    source: Optional[ChatSourceTypes] = None
+    conversation_id: uuid.UUID | None = None
+    source_id: Optional[str] = None
+    title: str | None = None
+    user_id: int | None = None
+    is_valid: Optional[bool] = None
+    current_model: str | None = None
+    create_time: datetime.datetime | None = None
+    update_time: datetime.datetime | None = None
+
+
+class ConversationListPage(BaseModel):
+    """
+    按 update_time、id 从新到旧排序的一页对话；items 只包含请求的字段（fields），next_cursor 为空表示没有下一页
+    """
+    items: list[ConversationListItemSchema]
+    next_cursor: Optional[str] = None
@@ -40,7 +40,8 @@ class RequestLogAggregationID(BaseModel):
 class RequestLogAggregation(BaseModel):
     id: RequestLogAggregationID = Field(alias="_id")  # 起始时间
     count: int  # 时间间隔内的请求数量
-    user_ids: list[Optional[int]] = []  # 用户ID列表
+    user_ids: list[Optional[int]] = []  # 已弃用，始终为空，使用 user_count
+    user_count: int = 0  # 去重用户数（HyperLogLog 估计值）
     avg_elapsed_ms: Optional[float] = None
 
 
@@ -58,6 +59,7 @@ class AskLogAggregationID(BaseModel):
 class AskLogAggregation(BaseModel):
     id: Optional[AskLogAggregationID] = Field(None, alias="_id")  # 起始时间
     count: int  # 时间间隔内的请求数量
-    user_ids: list[Optional[int]] = None  # 用户ID列表
+    user_ids: list[Optional[int]] = None  # 已弃用，始终为空，使用 user_count
+    user_count: int = 0  # 去重用户数（HyperLogLog 估计值）
     total_queueing_time: Optional[float] = None
     total_ask_time: Optional[float] = None
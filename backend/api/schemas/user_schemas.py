@@ -2,7 +2,7 @@ import datetime
 from typing import Optional
 
 from fastapi_users import schemas
-from pydantic import model_validator, ConfigDict, BaseModel, EmailStr
+from pydantic import model_validator, ConfigDict, BaseModel, EmailStr, Field
 
 from api.conf import Config
 from api.enums import OpenaiWebChatStatus, OpenaiWebChatModels, OpenaiApiChatModels
@@ -50,6 +50,7 @@ class OpenaiWebSourceSettingSchema(BaseSourceSettingSchema):
     per_model_ask_count: OpenaiWebPerModelAskCount
     disable_uploading: bool
     use_team: bool
+    queue_weight: float = Field(1.0, gt=0, description="排队权重，越大越优先")
 
     model_config = ConfigDict(from_attributes=True)
 
@@ -1,2 +1,3 @@
 from .openai_web import *
 from .openai_api import *
+from .ask_scheduler import *
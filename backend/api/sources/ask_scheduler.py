@@ -0,0 +1,203 @@
+import asyncio
+import bisect
+import itertools
+import math
+from typing import TYPE_CHECKING, Optional
+
+from api.conf import Config
+from api.coordination import Coordinator
+from api.exceptions import InvalidParamsException
+from utils.logger import get_logger
+
+if TYPE_CHECKING:
+    from api.sources.openai_web import OpenaiWebChatManager, OpenaiWebAccount
+
+config = Config()
+logger = get_logger(__name__)
+
+ASK_TIME_EMA_ALPHA = 0.2
+SHARED_SLOT_POLL_INTERVAL_SECONDS = 1
+
+
+class AskTicket:
+    """
+    一次排队中的提问
+    source_id 为 None 且 new_conversation 为 True 时，由调度器在放行时选择账号
+    """
+
+    def __init__(self, user_id: int, model: str, use_team: bool, new_conversation: bool,
+                 source_id: Optional[str], start_tag: float, seq: int):
+        self.user_id = user_id
+        self.model = model
+        self.use_team = use_team
+        self.new_conversation = new_conversation
+        self.source_id = source_id
+        self.start_tag = start_tag
+        self.seq = seq
+        self.position = 0
+        self.future: asyncio.Future["OpenaiWebAccount"] = asyncio.get_event_loop().create_future()
+        self.position_changed = asyncio.Event()
+
+    @property
+    def sort_key(self):
+        return self.start_tag, self.seq
+
+
+class AskScheduler:
+    """
+    OpenAI Web 提问调度器，取代原先全局的 asyncio.Semaphore
+
+    使用 Start-time Fair Queueing：每个用户、每个模型各是一条流，提问的虚拟开始时间
+    取全局虚拟时间与所属用户流、模型流上一次完成时间的最大值，按其从小到大放行（相同时按到达顺序）。
+    因此某个用户或某个模型的突发请求只会推后自身，而不会阻塞其他用户/模型的提问。
+    用户权重越大（例如管理员），其流推进得越慢，获得的份额越多。
+
+    账号的并发槽位通过 Coordinator 占用和归还。多 worker 共享槽位时，排队顺序只在本 worker 内公平，
+    并且其它 worker 归还槽位不会通知本 worker，因此有排队的提问时会定期重新尝试放行。
+    """
+
+    def __init__(self, manager: "OpenaiWebChatManager"):
+        self.manager = manager
+        self._waiters: list[AskTicket] = []
+        self._seq = itertools.count()
+        self._virtual_time = 0.0
+        self._user_finish_tags: dict[int, float] = {}
+        self._model_finish_tags: dict[str, float] = {}
+        self._avg_ask_time: Optional[float] = None
+        self._dispatch_lock = asyncio.Lock()
+        self._poll_task: Optional[asyncio.Task] = None
+
+    @property
+    def queueing_count(self) -> int:
+        return len(self._waiters)
+
+    def _candidate_accounts(self, ticket: AskTicket) -> list["OpenaiWebAccount"]:
+        if not ticket.new_conversation:
+            account = self.manager.accounts.get(ticket.source_id)
+            return [account] if account is not None else []
+        return [account for account in self.manager.accounts.values() if account.is_team == ticket.use_team]
+
+    async def submit(self, user_id: int, model: str, use_team: bool = False, new_conversation: bool = True,
+                     source_id: Optional[str] = None, user_weight: float = 1.0) -> AskTicket:
+        """
+        加入队列。若有空闲账号，返回的 ticket.future 会立即完成
+        """
+        model_weight = config.openai_web.queue_model_weights.get(model, 1.0)
+        start_tag = max(self._virtual_time,
+                        self._user_finish_tags.get(user_id, 0.0),
+                        self._model_finish_tags.get(model, 0.0))
+        self._user_finish_tags[user_id] = start_tag + 1.0 / user_weight
+        self._model_finish_tags[model] = start_tag + 1.0 / model_weight
+
+        ticket = AskTicket(user_id, model, use_team, new_conversation, source_id, start_tag, next(self._seq))
+        if not self._candidate_accounts(ticket):
+            raise InvalidParamsException("errors.openaiWebAccountNotFound")
+        bisect.insort(self._waiters, ticket, key=lambda t: t.sort_key)
+        await self._dispatch()
+        return ticket
+
+    async def cancel(self, ticket: AskTicket):
+        """
+        取消排队；若已被放行，则归还占用的槽位
+        """
+        if not ticket.future.done():
+            if ticket in self._waiters:
+                self._waiters.remove(ticket)
+            ticket.future.cancel()
+            await self._dispatch()
+        elif not ticket.future.cancelled():
+            await self.release(ticket.future.result().source_id)
+
+    async def release(self, source_id: Optional[str], ask_time: Optional[float] = None):
+        await Coordinator().release_slot(source_id)
+        account = self.manager.accounts.get(source_id)
+        if account is not None and account.active_count > 0:
+            account.active_count -= 1
+        if ask_time:
+            if self._avg_ask_time is None:
+                self._avg_ask_time = ask_time
+            else:
+                self._avg_ask_time = ASK_TIME_EMA_ALPHA * ask_time + (1 - ASK_TIME_EMA_ALPHA) * self._avg_ask_time
+        await self._dispatch()
+
+    async def refresh_slot_counts(self):
+        """
+        从 Coordinator 读取各账号已占用的槽位数（包括其它 worker 占用的）
+        """
+        counts = await Coordinator().get_slot_counts()
+        for source_id, account in self.manager.accounts.items():
+            account.active_count = counts.get(source_id, 0)
+
+    async def is_busy(self) -> bool:
+        """
+        所有账号的槽位是否都已占满
+        共享协调状态时读取 Coordinator 中的快照，不修改账号上的计数，计数只在调度时持有 _dispatch_lock 刷新
+        """
+        if not Coordinator().shared:
+            return self.manager.is_busy()
+        counts = await Coordinator().get_slot_counts()
+        return all(counts.get(source_id, 0) >= account.max_completion_concurrency
+                   for source_id, account in self.manager.accounts.items())
+
+    def estimated_wait_seconds(self, ticket: AskTicket) -> Optional[float]:
+        if self._avg_ask_time is None or ticket.position <= 0:
+            return None
+        capacity = sum(account.max_completion_concurrency for account in self._candidate_accounts(ticket)) or 1
+        return round(math.ceil(ticket.position / capacity) * self._avg_ask_time, 1)
+
+    def _select_account(self, ticket: AskTicket) -> Optional["OpenaiWebAccount"]:
+        if ticket.new_conversation:
+            return self.manager.pick_account(ticket.use_team, available_only=True)
+        account = self.manager.accounts.get(ticket.source_id)
+        if account is None or account.is_busy():
+            return None
+        return account
+
+    async def _dispatch(self):
+        async with self._dispatch_lock:
+            await self._dispatch_locked()
+
+    async def _dispatch_locked(self):
+        coordinator = Coordinator()
+        if coordinator.shared and self._waiters:
+            await self.refresh_slot_counts()
+        for ticket in list(self._waiters):
+            if ticket.future.done():
+                continue
+            account = self._select_account(ticket)
+            if account is None:
+                continue
+            if not await coordinator.try_acquire_slot(account.source_id, account.max_completion_concurrency):
+                # 槽位已被其它 worker 占用
+                account.active_count = max(account.active_count, account.max_completion_concurrency)
+                continue
+            account.active_count += 1
+            if ticket.future.done():
+                # 占用槽位期间已被取消
+                await coordinator.release_slot(account.source_id)
+                account.active_count -= 1
+                continue
+            self._virtual_time = max(self._virtual_time, ticket.start_tag)
+            ticket.future.set_result(account)
+        self._waiters = [ticket for ticket in self._waiters if not ticket.future.done()]
+
+        if not self._waiters:
+            # 队列为空时重置各条流，避免状态无限增长
+            self._user_finish_tags.clear()
+            self._model_finish_tags.clear()
+
+        for position, ticket in enumerate(self._waiters, start=1):
+            if ticket.position != position:
+                ticket.position = position
+                ticket.position_changed.set()
+
+        if coordinator.shared and self._waiters and (self._poll_task is None or self._poll_task.done()):
+            self._poll_task = asyncio.create_task(self._poll())
+
+    async def _poll(self):
+        while self._waiters:
+            await asyncio.sleep(SHARED_SLOT_POLL_INTERVAL_SECONDS)
+            try:
+                await self._dispatch()
+            except Exception as e:
+                logger.warning(f"Failed to dispatch queueing asks: {e.__class__.__name__} {e}")
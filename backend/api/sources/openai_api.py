@@ -4,13 +4,15 @@ from datetime import datetime, timezone
 from typing import Optional
 
 import httpx
+from beanie.odm.utils.encoder import Encoder
+from bson import Binary
 from pydantic import ValidationError
 
 from api.conf import Config, Credentials
 from api.enums import OpenaiApiChatModels, ChatSourceTypes
 from api.exceptions import OpenaiApiException
 from api.models.doc import OpenaiApiChatMessage, OpenaiApiConversationHistoryDocument, OpenaiApiChatMessageMetadata, \
-    OpenaiApiChatMessageTextContent
+    OpenaiApiChatMessageTextContent, OpenaiApiConversationNode
 from api.schemas.openai_schemas import OpenaiChatResponse
 from utils.common import SingletonMeta
 from utils.logger import get_logger
@@ -36,6 +38,116 @@ async def _check_response(response: httpx.Response) -> None:
         raise error from ex
 
 
+def _as_uuid(value) -> uuid.UUID:
+    # mongodb 中的 uuid 以 Binary 保存
+    return value.as_uuid() if isinstance(value, Binary) else uuid.UUID(str(value))
+
+
+def build_node_index(mapping: dict[str, OpenaiApiChatMessage]) -> dict[str, OpenaiApiConversationNode]:
+    """
+    根据 mapping 中的 parent 计算每条消息的深度；parent 不在 mapping 中的消息视为根节点
+    """
+    index: dict[str, OpenaiApiConversationNode] = {}
+    for node_id in mapping:
+        path = []
+        current = node_id
+        while current is not None and current in mapping and current not in index and len(path) <= len(mapping):
+            path.append(current)
+            parent = mapping[current].parent
+            current = str(parent) if parent is not None else None
+        depth = index[current].depth + 1 if current in index else 0
+        for current in reversed(path):
+            parent = mapping[current].parent
+            index[current] = OpenaiApiConversationNode(parent=str(parent) if parent is not None else None, depth=depth)
+            depth += 1
+    return index
+
+
+async def _rebuild_node_index(conversation_id: uuid.UUID) -> dict[str, dict]:
+    """
+    旧记录没有 node_index，读取完整记录补全一次
+    """
+    conv_history = await OpenaiApiConversationHistoryDocument.get(conversation_id)
+    if not conv_history:
+        raise ValueError("conversation_id not found")
+    node_index = {key: node.model_dump() for key, node in build_node_index(conv_history.mapping).items()}
+    await OpenaiApiConversationHistoryDocument.get_motor_collection().update_one(
+        {"_id": Binary.from_uuid(conversation_id)}, {"$set": {"node_index": node_index}})
+    logger.debug(f"built node index of api conversation {conversation_id}")
+    return node_index
+
+
+async def load_context_messages(conversation_id: uuid.UUID, parent_message_id: uuid.UUID,
+                                context_message_count: int = -1) -> list[OpenaiApiChatMessage]:
+    """
+    从 current_node 开始往前找 context_message_count 个 message（-1 表示直到根节点），按时间顺序返回
+    先读取 node_index 确定需要哪些消息，再只读取这些消息，不读取完整的历史记录
+    """
+    collection = OpenaiApiConversationHistoryDocument.get_motor_collection()
+    doc_id = Binary.from_uuid(conversation_id)
+    raw = await collection.find_one({"_id": doc_id}, {"source": 1, "current_node": 1, "node_index": 1})
+    if not raw:
+        raise ValueError("conversation_id not found")
+    if raw.get("source") != ChatSourceTypes.openai_api:
+        raise ValueError(f"{conversation_id} is not api conversation")
+    node_index = raw.get("node_index") or await _rebuild_node_index(conversation_id)
+    if str(parent_message_id) not in node_index:
+        raise ValueError(f"{parent_message_id} is not a valid parent of {conversation_id}")
+    if not raw.get("current_node"):
+        raise ValueError(f"{conversation_id} current_node is None")
+
+    node_id = str(_as_uuid(raw["current_node"]))
+    assert node_id in node_index, f"{conversation_id} current_node({node_id}) not found in mapping"
+    path_length = node_index[node_id]["depth"] + 1
+    count = path_length if context_message_count == -1 else min(max(context_message_count, 1), path_length)
+    if count > MAX_CONTEXT_MESSAGE_COUNT:
+        raise ValueError(f"too many messages to iterate, conversation_id={conversation_id}")
+
+    node_ids = []
+    while node_id is not None and node_id in node_index and len(node_ids) < count:
+        node_ids.append(node_id)
+        node_id = node_index[node_id]["parent"]
+    raw = await collection.find_one({"_id": doc_id}, {f"mapping.{node_id}": 1 for node_id in node_ids})
+    mapping = raw.get("mapping") or {}
+    return [OpenaiApiChatMessage.model_validate(mapping[node_id]) for node_id in reversed(node_ids) if node_id in mapping]
+
+
+async def append_messages_to_history(conversation_id: uuid.UUID, ask_message: OpenaiApiChatMessage,
+                                     reply_message: OpenaiApiChatMessage):
+    """
+    将一轮问答写入已有的历史记录，只更新相关的字段，不读取和重写完整的记录
+    """
+    collection = OpenaiApiConversationHistoryDocument.get_motor_collection()
+    doc_id = Binary.from_uuid(conversation_id)
+    parent_id = str(ask_message.parent) if ask_message.parent is not None else None
+    projection = {f"node_index.{parent_id}": 1, f"mapping.{parent_id}.id": 1} if parent_id is not None else {"_id": 1}
+    # node_index 为 null 时无法 $set 其中的字段，需要先补全
+    raw = await collection.find_one({"_id": doc_id, "node_index": {"$type": "object"}}, projection)
+    if raw is None or parent_id is not None and parent_id not in raw["node_index"]:
+        await _rebuild_node_index(conversation_id)
+        raw = await collection.find_one({"_id": doc_id}, projection)
+    depth = 0
+    if parent_id is not None:
+        assert parent_id in (raw.get("mapping") or {}), f"update api: parent message {parent_id} is None"
+        depth = raw["node_index"][parent_id]["depth"] + 1
+
+    update = {
+        "$set": Encoder().encode({
+            "update_time": datetime.now().astimezone(tz=timezone.utc),
+            f"mapping.{ask_message.id}": ask_message,
+            f"mapping.{reply_message.id}": reply_message,
+            "current_node": reply_message.id,
+            "current_model": reply_message.model,
+            f"node_index.{ask_message.id}": OpenaiApiConversationNode(parent=parent_id, depth=depth),
+            f"node_index.{reply_message.id}": OpenaiApiConversationNode(parent=str(ask_message.id), depth=depth + 1),
+        })
+    }
+    if parent_id is not None:
+        update["$push"] = {f"mapping.{parent_id}.children": Binary.from_uuid(reply_message.id)}
+    r = await collection.update_one({"_id": doc_id}, update)
+    assert r.matched_count == 1, f"update api: conversation history {conversation_id} is None"
+
+
 def make_session() -> httpx.AsyncClient:
     if config.openai_api.proxy is not None:
         proxies = {
@@ -86,35 +198,7 @@ class OpenaiApiChatManager(metaclass=SingletonMeta):
             assert parent_message_id is None, "parent_id must be None when conversation_id is None"
             messages = [new_message]
         else:
-            conv_history = await OpenaiApiConversationHistoryDocument.get(conversation_id)
-            if not conv_history:
-                raise ValueError("conversation_id not found")
-            if conv_history.source != ChatSourceTypes.openai_api:
-                raise ValueError(f"{conversation_id} is not api conversation")
-            if not conv_history.mapping.get(str(parent_message_id)):
-                raise ValueError(f"{parent_message_id} is not a valid parent of {conversation_id}")
-
-            # 从 current_node 开始往前找 context_message_count 个 message
-            if not conv_history.current_node:
-                raise ValueError(f"{conversation_id} current_node is None")
-
-            msg = conv_history.mapping.get(str(conv_history.current_node))
-            assert msg, f"{conv_history.id} current_node({conv_history.current_node}) not found in mapping"
-
-            count = 0
-            iter_count = 0
-
-            while msg:
-                count += 1
-                messages.append(msg)
-                if context_message_count != -1 and count >= context_message_count:
-                    break
-                iter_count += 1
-                if iter_count > MAX_CONTEXT_MESSAGE_COUNT:
-                    raise ValueError(f"too many messages to iterate, conversation_id={conversation_id}")
-                msg = conv_history.mapping.get(str(msg.parent))
-
-            messages.reverse()
+            messages = await load_context_messages(conversation_id, parent_message_id, context_message_count)
             messages.append(new_message)
 
         # TODO: credits 判断
@@ -1,6 +1,11 @@
 import asyncio
+import contextlib
+import datetime
+import itertools
 import json
+import time
 import uuid
+from collections import deque
 from mimetypes import guess_type
 
 import websockets
@@ -12,7 +17,7 @@ from aiohttp import WSMessage
 from fastapi.encoders import jsonable_encoder
 import aiohttp
 from httpx import AsyncClient
-from pydantic import ValidationError
+from pydantic import ValidationError, TypeAdapter
 
 from api.conf import Config, Credentials
 from api.enums import OpenaiWebChatModels
@@ -30,6 +35,7 @@ from api.schemas.file_schemas import UploadedFileInfoSchema
 from api.schemas.openai_schemas import OpenaiChatPlugin, OpenaiChatPluginUserSettings, OpenaiChatFileUploadUrlRequest, \
     OpenaiChatFileUploadUrlResponse, OpenaiWebCompleteRequest, \
     OpenaiWebCompleteRequestConversationMode, OpenaiChatPluginListResponse, OpenaiWebAccountsCheckResponse
+from api.sources.ask_scheduler import AskScheduler
 from utils.common import SingletonMeta
 from utils.logger import get_logger
 
@@ -38,77 +44,127 @@ credentials = Credentials()
 logger = get_logger(__name__)
 
 
-def convert_openai_web_message(item: dict, message_id: str = None) -> OpenaiWebChatMessage | None:
-    if item.get("type") == "title_generation":
-        result = OpenaiWebChatMessage(
-            id='3aa263a5-6acf-4975-b7e8-7a8c85bf5167',
-            source="openai_web",
-            children=[],
-            title=item.get("title"),
-        )
-        return result
-    if not item.get("message"):
-        return None
-    if not item["message"].get("author"):
-        logger.debug(f"Parse message {message_id}: Unknown author")
-
-    content = None
-    fallback_content = None
-    if item["message"].get("content"):
-        content_type = item["message"]["content"].get("content_type")
-        content_map = {
-            "text": OpenaiWebChatMessageTextContent,
-            "multimodal_text": OpenaiWebChatMessageMultimodalTextContent,
-            "code": OpenaiWebChatMessageCodeContent,
-            "execution_output": OpenaiWebChatMessageExecutionOutputContent,
-            "stderr": OpenaiWebChatMessageStderrContent,
-            "tether_browsing_display": OpenaiWebChatMessageTetherBrowsingDisplayContent,
-            "tether_quote": OpenaiWebChatMessageTetherQuoteContent,
-            "system_error": OpenaiWebChatMessageSystemErrorContent
-        }
-        if content_type not in content_map:
+OPENAI_WEB_CONTENT_TYPES = {
+    "text": OpenaiWebChatMessageTextContent,
+    "multimodal_text": OpenaiWebChatMessageMultimodalTextContent,
+    "code": OpenaiWebChatMessageCodeContent,
+    "execution_output": OpenaiWebChatMessageExecutionOutputContent,
+    "stderr": OpenaiWebChatMessageStderrContent,
+    "tether_browsing_display": OpenaiWebChatMessageTetherBrowsingDisplayContent,
+    "tether_quote": OpenaiWebChatMessageTetherQuoteContent,
+    "system_error": OpenaiWebChatMessageSystemErrorContent
+}
+
+
+def _to_uuid(value) -> uuid.UUID | None:
+    if value is None or isinstance(value, uuid.UUID):
+        return value
+    return uuid.UUID(value)
+
+
+def _to_datetime(value) -> datetime.datetime | None:
+    if isinstance(value, (int, float)):
+        return datetime.datetime.fromtimestamp(value, tz=datetime.timezone.utc)
+    if value is None or isinstance(value, datetime.datetime):
+        return value
+    return TypeAdapter(datetime.datetime).validate_python(value)
+
+
+class OpenaiWebMessageConverter:
+    """
+    将 ChatGPT 返回的消息转换为 OpenaiWebChatMessage
+
+    ChatGPT 返回的数据视为可信，消息和大部分 content 直接构造而不做校验；
+    multimodal_text 的 parts 和 metadata 含有嵌套模型，仍需校验，
+    但同一条消息连续的多个 chunk 中 metadata 通常不变，此时复用上一次的结果
+    流式回复时每次提问使用一个实例
+    """
+
+    def __init__(self):
+        self._metadata_key = None
+        self._metadata: OpenaiWebChatMessageMetadata | None = None
+        self._model: str | None = None
+
+    def _convert_content(self, raw_content: dict):
+        content_type = raw_content.get("content_type")
+        content_cls = OPENAI_WEB_CONTENT_TYPES.get(content_type)
+        if content_cls is None:
             logger.debug(f"Parse message: Unknown content type {content_type}")
-            fallback_content = item["message"]["content"]
-        else:
-            content = content_map[content_type](**item["message"]["content"])
-
-    message_id = message_id or item["message"]["id"]
-    result = OpenaiWebChatMessage(
-        source="openai_web",
-        id=message_id,  # 这里观察到message_id和mapping中的id不一样，暂时先使用mapping中的id
-        role=item["message"]["author"]["role"],
-        author_name=item["message"]["author"].get("name"),
-        model=None,
-        create_time=item["message"].get("create_time"),
-        parent=item.get("parent"),
-        children=item.get("children", []),
-        content=content
-    )
-    metadata_dict = OpenaiWebChatMessageMetadata(
-        source="openai_web",
-        weight=item["message"].get("weight"),
-        end_turn=item["message"].get("end_turn"),
-        recipient=item["message"].get("recipient"),
-        message_status=item["message"].get("status"),
-        fallback_content=fallback_content,
-    ).model_dump(exclude_unset=True, exclude_none=True)
-    if "metadata" in item["message"] and item["message"]["metadata"] != {}:
-        metadata_dict.update(item["message"]["metadata"])
+            return None, raw_content
+        if content_cls is OpenaiWebChatMessageMultimodalTextContent:
+            return content_cls.model_validate(raw_content), None
+        return content_cls.model_construct(**{k: v for k, v in raw_content.items() if k in content_cls.model_fields}), None
+
+    def _convert_metadata(self, message_id: str, raw_message: dict, fallback_content):
+        raw_metadata = raw_message.get("metadata") or {}
+        fields = (raw_message.get("weight"), raw_message.get("end_turn"), raw_message.get("recipient"),
+                  raw_message.get("status"), fallback_content)
+        key = (message_id, fields, raw_metadata)
+        if key == self._metadata_key:
+            return self._metadata, self._model
+
+        metadata_dict = {"source": "openai_web"}
+        for name, value in zip(("weight", "end_turn", "recipient", "message_status", "fallback_content"), fields):
+            if value is not None:
+                metadata_dict[name] = value
+        metadata_dict.update(raw_metadata)
         metadata = OpenaiWebChatMessageMetadata.model_validate(metadata_dict)
-        result.metadata = metadata
-        model_code = item["message"]["metadata"].get("model_slug")
-        result.model = OpenaiWebChatModels.from_code(model_code) or model_code
-    else:
-        result.metadata = OpenaiWebChatMessageMetadata.model_validate(metadata_dict)
-    return result
+        model = None
+        if raw_metadata:
+            model_code = raw_metadata.get("model_slug")
+            model = OpenaiWebChatModels.from_code(model_code) or model_code
+
+        self._metadata_key, self._metadata, self._model = key, metadata, model
+        return metadata, model
+
+    def convert(self, item: dict, message_id: str = None) -> OpenaiWebChatMessage | None:
+        if item.get("type") == "title_generation":
+            result = OpenaiWebChatMessage(
+                id='3aa263a5-6acf-4975-b7e8-7a8c85bf5167',
+                source="openai_web",
+                children=[],
+                title=item.get("title"),
+            )
+            return result
+        raw_message = item.get("message")
+        if not raw_message:
+            return None
+        author = raw_message.get("author")
+        if not author:
+            logger.debug(f"Parse message {message_id}: Unknown author")
+
+        content = None
+        fallback_content = None
+        if raw_message.get("content"):
+            content, fallback_content = self._convert_content(raw_message["content"])
+
+        message_id = message_id or raw_message["id"]
+        metadata, model = self._convert_metadata(message_id, raw_message, fallback_content)
+        return OpenaiWebChatMessage.model_construct(
+            source="openai_web",
+            id=_to_uuid(message_id),  # 这里观察到message_id和mapping中的id不一样，暂时先使用mapping中的id
+            role=author["role"],
+            author_name=author.get("name"),
+            model=model,
+            create_time=_to_datetime(raw_message.get("create_time")),
+            parent=_to_uuid(item.get("parent")),
+            children=[_to_uuid(child) for child in item.get("children", [])],
+            content=content,
+            metadata=metadata,
+        )
+
+
+def convert_openai_web_message(item: dict, message_id: str = None) -> OpenaiWebChatMessage | None:
+    return OpenaiWebMessageConverter().convert(item, message_id)
 
 
 def convert_mapping(mapping: dict[uuid.UUID, dict]) -> dict[str, OpenaiWebChatMessage]:
     result = {}
     if not mapping:
         return result
+    converter = OpenaiWebMessageConverter()
     for key, item in mapping.items():
-        message = convert_openai_web_message(item, str(key))
+        message = converter.convert(item, str(key))
         if message:
             result[key] = message
     return {str(key): value for key, value in result.items()}
@@ -153,10 +209,10 @@ async def _check_response(response: httpx.Response) -> None:
         raise error from ex
 
 
-def default_header():
+def default_header(access_token: str | None = None):
     return {
         # "Accept": "text/event-stream",
-        "Authorization": f"Bearer {credentials.openai_web_access_token}",
+        "Authorization": f"Bearer {access_token or credentials.openai_web_access_token}",
         "Content-Type": "application/json",
         # "X-Openai-Assistant-App-Id": "",
         # "Connection": "close",
@@ -185,7 +241,7 @@ def team_headers(chatgpt_account_id: str = None):
     }
 
 
-def make_session() -> httpx.AsyncClient:
+def make_session(access_token: str | None = None) -> httpx.AsyncClient:
     if config.openai_web.proxy is not None and config.openai_web.proxy != "":
         proxies = {
             "http://": config.openai_web.proxy,
@@ -195,7 +251,7 @@ def make_session() -> httpx.AsyncClient:
     else:
         session = httpx.AsyncClient(timeout=config.openai_web.common_timeout)
     session.headers.clear()
-    session.headers.update(default_header())
+    session.headers.update(default_header(access_token))
     return session
 
 
@@ -254,17 +310,160 @@ async def _receive_from_websocket(wss_url, conversation_id):
     logger.debug("Connection closed.")
 
 
+ACCOUNT_UNHEALTHY_COOLDOWN = 60  # 账号出错后暂停调度的秒数
+RETIRED_SESSION_CLOSE_DELAY = 60  # 被替换的会话在流式请求结束后再等待的秒数，留给其它短请求完成
+
+
+class OpenaiWebAccount:
+    """
+    账号池中的一个 ChatGPT 账号，拥有独立的凭证、并发限制和健康状态
+    source_id 与其对话在数据库中的 source_id 一致；默认账号（个人）为 None
+    并发槽位由 AskScheduler 分配
+    """
+
+    def __init__(self, source_id: str | None, access_token: str | None, chatgpt_account_id: str | None = None,
+                 is_team: bool = False, max_completion_concurrency: int = 1):
+        self.source_id = source_id
+        self.chatgpt_account_id = chatgpt_account_id
+        self.is_team = is_team
+        self.max_completion_concurrency = max_completion_concurrency
+        self.session = make_session(access_token)
+        self.active_count = 0  # 正在提问的请求数
+        self.open_streams = 0  # 正在使用 self.session 的流式请求数，用于决定何时关闭被替换的会话
+        self.unhealthy_until = 0.0
+
+    @property
+    def headers(self) -> dict:
+        return team_headers(self.chatgpt_account_id)
+
+    @property
+    def load(self) -> float:
+        return self.active_count / self.max_completion_concurrency
+
+    def is_busy(self):
+        return self.active_count >= self.max_completion_concurrency
+
+    def is_healthy(self):
+        return time.time() >= self.unhealthy_until
+
+    def mark_unhealthy(self, reason: str = "", cooldown: int = ACCOUNT_UNHEALTHY_COOLDOWN):
+        self.unhealthy_until = time.time() + cooldown
+        logger.warning(f"ChatGPT account {self.source_id or 'default'} marked unhealthy for {cooldown}s: {reason}")
+
+    def mark_healthy(self):
+        self.unhealthy_until = 0.0
+
+    @contextlib.asynccontextmanager
+    async def track_stream(self):
+        self.open_streams += 1
+        try:
+            yield
+        finally:
+            self.open_streams -= 1
+
+
+def _load_accounts() -> dict[str | None, OpenaiWebAccount]:
+    accounts = {None: OpenaiWebAccount(
+        source_id=None,
+        access_token=credentials.openai_web_access_token,
+        max_completion_concurrency=config.openai_web.max_completion_concurrency
+    )}
+    if config.openai_web.enable_team_subscription and config.openai_web.team_account_id:
+        team_account_id = config.openai_web.team_account_id
+        accounts[team_account_id] = OpenaiWebAccount(
+            source_id=team_account_id,
+            access_token=credentials.openai_web_access_token,
+            chatgpt_account_id=team_account_id,
+            is_team=True,
+            max_completion_concurrency=config.openai_web.max_completion_concurrency
+        )
+    for account in credentials.openai_web_extra_accounts:
+        if account.source_id in accounts:
+            logger.warning(f"Duplicated ChatGPT account source_id {account.source_id}, ignored")
+            continue
+        accounts[account.source_id] = OpenaiWebAccount(
+            source_id=account.source_id,
+            access_token=account.access_token,
+            chatgpt_account_id=account.chatgpt_account_id,
+            is_team=account.is_team,
+            max_completion_concurrency=account.max_completion_concurrency
+        )
+    return accounts
+
+
 class OpenaiWebChatManager(metaclass=SingletonMeta):
     def __init__(self):
-        self.semaphore = asyncio.Semaphore(config.openai_web.max_completion_concurrency)
+        self.accounts: dict[str | None, OpenaiWebAccount] = {}
         self.session: AsyncClient | None = None
+        self._retiring_tasks: set[asyncio.Task] = set()
         self.reset_session()
+        self.scheduler = AskScheduler(self)
 
     def is_busy(self):
-        return self.semaphore.locked()
+        return all(account.is_busy() for account in self.accounts.values())
 
     def reset_session(self):
-        self.session = make_session()
+        old_accounts = self.accounts
+        self.accounts = _load_accounts()
+        # 保留正在进行的提问占用的槽位
+        for source_id, account in self.accounts.items():
+            if source_id in old_accounts:
+                account.active_count = old_accounts[source_id].active_count
+                account.unhealthy_until = old_accounts[source_id].unhealthy_until
+        self.session = self.accounts[None].session
+        self._retire_accounts(old_accounts.values())
+
+    def _retire_accounts(self, accounts):
+        """
+        关闭被替换的账号会话；正在进行的提问仍持有旧账号，因此等其流式请求结束后再关闭
+        """
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return
+        for account in accounts:
+            task = loop.create_task(self._close_retired_session(account))
+            self._retiring_tasks.add(task)
+            task.add_done_callback(self._retiring_tasks.discard)
+
+    @staticmethod
+    async def _close_retired_session(account: OpenaiWebAccount):
+        while account.open_streams > 0:
+            await asyncio.sleep(1)
+        await asyncio.sleep(RETIRED_SESSION_CLOSE_DELAY)
+        try:
+            await account.session.aclose()
+        except Exception as e:
+            logger.warning(f"Failed to close retired session of account {account.source_id or 'default'}: {e}")
+
+    def get_account(self, source_id: str | None) -> OpenaiWebAccount:
+        account = self.accounts.get(source_id)
+        if account is None:
+            raise InvalidParamsException(f"errors.openaiWebAccountNotFound")
+        return account
+
+    def get_default_account(self, use_team: bool = False) -> OpenaiWebAccount:
+        if not use_team:
+            return self.accounts[None]
+        if not config.openai_web.team_account_id:
+            raise InvalidParamsException(
+                "ChatGPT account id is not set in setting. Please set it before using team subscription.")
+        return self.get_account(config.openai_web.team_account_id)
+
+    def pick_account(self, use_team: bool = False, available_only: bool = False) -> OpenaiWebAccount | None:
+        """
+        为新对话选择负载最低的健康账号；若没有健康账号，则退化为选择负载最低的账号
+        :param available_only: 仅从还有空闲槽位的账号中选择，没有时返回 None
+        """
+        candidates = [account for account in self.accounts.values() if account.is_team == use_team]
+        if not candidates:
+            return self.get_default_account(use_team)
+        if available_only:
+            candidates = [account for account in candidates if not account.is_busy()]
+            if not candidates:
+                return None
+        healthy = [account for account in candidates if account.is_healthy()]
+        return min(healthy or candidates, key=lambda account: account.load)
 
     async def check_accounts(self) -> OpenaiWebAccountsCheckResponse:
         url = f"{config.openai_web.chatgpt_base_url}accounts/check/v4-2023-04-27"
@@ -273,31 +472,82 @@ class OpenaiWebChatManager(metaclass=SingletonMeta):
         result = OpenaiWebAccountsCheckResponse(**result)
         return result
 
-    async def get_conversations(self, timeout=None, use_team: bool = False) -> list[dict]:
+    async def _fetch_conversation_page(self, account: OpenaiWebAccount, offset: int, limit: int, timeout) -> dict:
+        retries = config.openai_web.conversation_list_retries
+        url = f"{config.openai_web.chatgpt_base_url}conversations?offset={offset}&limit={limit}&order=updated"
+        for attempt in range(retries + 1):
+            try:
+                response = await account.session.get(url, timeout=timeout, headers=account.headers)
+                await _check_response(response)
+                return json.loads(response.text)
+            except (httpx.TransportError, OpenaiWebException) as e:
+                # 只重试网络错误、429 和 5xx
+                if attempt >= retries or isinstance(e, OpenaiWebException) and e.code != 429 and e.code < 500:
+                    raise e
+                delay = 2 ** attempt
+                logger.warning(f"Failed to fetch conversations at offset {offset} ({e.__class__.__name__}), "
+                               f"retry in {delay}s")
+                await asyncio.sleep(delay)
+
+    async def iter_conversation_pages(self, account: OpenaiWebAccount, timeout=None):
+        """
+        按 update_time 从新到旧逐页获取对话列表
+        第一页返回 total 后，后续页面以 conversation_list_fan_out 的并发度预取，但仍按顺序产出，
+        因此调用方可以随时停止（例如增量同步到达水位线），最多浪费 fan_out - 1 个请求
+        """
         if timeout is None:
             timeout = httpx.Timeout(config.openai_web.common_timeout)
-
-        offset = 0
-        limit = 80
+        limit = config.openai_web.conversation_list_page_size
+        fan_out = config.openai_web.conversation_list_fan_out
+
+        data = await self._fetch_conversation_page(account, 0, limit, timeout)
+        if not data["items"]:
+            return
+        yield data["items"]
+
+        total = data.get("total")
+        if total is None:
+            # 未返回 total 时逐页获取直到为空
+            offset = limit
+            while True:
+                data = await self._fetch_conversation_page(account, offset, limit, timeout)
+                if not data["items"]:
+                    return
+                yield data["items"]
+                offset += limit
+
+        offsets = iter(range(limit, total, limit))
+        pending: deque[asyncio.Task] = deque()
+        try:
+            for offset in itertools.islice(offsets, fan_out):
+                pending.append(asyncio.create_task(self._fetch_conversation_page(account, offset, limit, timeout)))
+            while pending:
+                data = await pending.popleft()
+                next_offset = next(offsets, None)
+                if next_offset is not None:
+                    pending.append(
+                        asyncio.create_task(self._fetch_conversation_page(account, next_offset, limit, timeout)))
+                if data["items"]:
+                    yield data["items"]
+        finally:
+            for task in pending:
+                task.cancel()
+            # 等待取消完成，避免任务仍在运行或异常未被获取
+            await asyncio.gather(*pending, return_exceptions=True)
+
+    async def get_conversations(self, timeout=None, use_team: bool = False,
+                                account: OpenaiWebAccount = None) -> list[dict]:
+        account = account or self.get_default_account(use_team)
         _results = []
-        while True:
-            url = f"{config.openai_web.chatgpt_base_url}conversations?offset={offset}&limit={limit}"
-            response = await self.session.get(url, timeout=timeout, headers=req_headers(use_team))
-            await _check_response(response)
-            data = json.loads(response.text)
-            conversations = data["items"]
-            if len(conversations):
-                _results.extend(conversations)
-            else:
-                break
-            offset += 80
-
+        async for conversations in self.iter_conversation_pages(account, timeout=timeout):
+            _results.extend(conversations)
         return _results
 
-    async def get_conversation_history(self, conversation_id: uuid.UUID | str,
-                                       source_id: str = None) -> OpenaiWebConversationHistoryDocument:
+    async def get_conversation_history(self, conversation_id: uuid.UUID | str, source_id: str = None,
+                                       save: bool = True) -> OpenaiWebConversationHistoryDocument:
+        account = self.get_account(source_id)
         url = f"{config.openai_web.chatgpt_base_url}conversation/{conversation_id}"
-        response = await self.session.get(url, timeout=None, headers=team_headers(source_id))
+        response = await account.session.get(url, timeout=None, headers=account.headers)
         response.encoding = 'utf-8'
         await _check_response(response)
         result = json.loads(response.text)
@@ -326,15 +576,18 @@ class OpenaiWebChatManager(metaclass=SingletonMeta):
                 conversation_template_id=result.get("conversation_template_id"),
             )
         )
-        await doc.save()
+        if save:
+            await doc.save()
         return doc
 
-    async def clear_conversations(self, use_team: bool = False):
+    async def clear_conversations(self, use_team: bool = False, account: OpenaiWebAccount = None):
+        account = account or self.get_default_account(use_team)
         url = f"{config.openai_web.chatgpt_base_url}conversations"
-        response = await self.session.patch(url, json={"is_visible": False}, headers=req_headers(use_team))
+        response = await account.session.patch(url, json={"is_visible": False}, headers=account.headers)
         await _check_response(response)
 
-    async def complete(self, model: OpenaiWebChatModels, text_content: str, use_team: bool,
+    async def complete(self, model: OpenaiWebChatModels, text_content: str, use_team: bool = False,
+                       account: OpenaiWebAccount = None,
                        conversation_id: uuid.UUID = None,
                        parent_message_id: uuid.UUID = None,
                        plugin_ids: list[str] = None,
@@ -345,6 +598,7 @@ class OpenaiWebChatManager(metaclass=SingletonMeta):
 
         assert config.openai_web.enabled, "OpenAI Web is not enabled"
 
+        account = account or self.get_default_account(use_team)
         model = model or OpenaiWebChatModels.gpt_3_5
 
         if plugin_ids is not None and len(plugin_ids) > 0 and model != OpenaiWebChatModels.gpt_4_plugins:
@@ -401,12 +655,13 @@ class OpenaiWebChatManager(metaclass=SingletonMeta):
             completion_request_dict["arkose_token"] = None
         data_json = json.dumps(jsonable_encoder(completion_request))
 
-        headers = req_headers(use_team) | {
+        headers = account.headers | {
             "referer": "https://chat.openai.com/" + (f"c/{conversation_id}" if conversation_id else "")}
         if arkose_token is not None:
             headers["Openai-Sentinel-Arkose-Token"] = arkose_token
 
-        async with self.session.stream(method="POST", url=f"{config.openai_web.chatgpt_base_url}conversation",
+        async with account.track_stream(), \
+                account.session.stream(method="POST", url=f"{config.openai_web.chatgpt_base_url}conversation",
                                        data=data_json, timeout=timeout,
                                        headers=headers) as response:
             await _check_response(response)
@@ -451,23 +706,24 @@ class OpenaiWebChatManager(metaclass=SingletonMeta):
 
     async def delete_conversation(self, conversation_id: str, source_id: str = None):
         # await self.chatbot.delete_conversation(conversation_id)
+        account = self.get_account(source_id)
         url = f"{config.openai_web.chatgpt_base_url}conversation/{conversation_id}"
-        response = await self.session.patch(url, json={"is_visible": False},
-                                            headers=team_headers(source_id))
+        response = await account.session.patch(url, json={"is_visible": False}, headers=account.headers)
         await _check_response(response)
 
     async def set_conversation_title(self, conversation_id: str, title: str, source_id: str = None):
+        account = self.get_account(source_id)
         url = f"{config.openai_web.chatgpt_base_url}conversation/{conversation_id}"
-        response = await self.session.patch(url, json={"title": title},
-                                            headers=team_headers(source_id))
+        response = await account.session.patch(url, json={"title": title}, headers=account.headers)
         await _check_response(response)
 
-    async def generate_conversation_title(self, conversation_id: str, message_id: str, use_team: bool):
+    async def generate_conversation_title(self, conversation_id: str, message_id: str, source_id: str = None):
+        account = self.get_account(source_id)
         url = f"{config.openai_web.chatgpt_base_url}conversation/gen_title/{conversation_id}"
-        response = await self.session.post(
+        response = await account.session.post(
             url,
             json={"message_id": message_id},
-            headers=req_headers(use_team)
+            headers=account.headers
         )
         await _check_response(response)
         result = response.json()
@@ -537,9 +793,10 @@ class OpenaiWebChatManager(metaclass=SingletonMeta):
             raise e
 
     async def get_interpreter_info(self, conversation_id: str, source_id: str | None):
-        response = await self.session.get(
+        account = self.get_account(source_id)
+        response = await account.session.get(
             url=f"{config.openai_web.chatgpt_base_url}conversation/{conversation_id}/interpreter",
-            headers=team_headers(source_id)
+            headers=account.headers
         )
         await _check_response(response)
         return response.json()
@@ -559,10 +816,11 @@ class OpenaiWebChatManager(metaclass=SingletonMeta):
 
     async def get_interpreter_file_download_url(self, conversation_id: str, message_id: str, sandbox_path: str,
                                                 source_id: str | None):
-        response = await self.session.get(
+        account = self.get_account(source_id)
+        response = await account.session.get(
             url=f"{config.openai_web.chatgpt_base_url}conversation/{conversation_id}/interpreter/download",
             params={"message_id": message_id, "sandbox_path": sandbox_path},
-            headers=team_headers(source_id)
+            headers=account.headers
         )
         await _check_response(response)
         result = response.json()
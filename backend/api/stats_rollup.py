@@ -0,0 +1,354 @@
+import asyncio
+import datetime
+from enum import Enum
+from typing import Iterable, Optional, Type
+
+from beanie import Document
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
+
+from api.conf import Config
+from api.exceptions import InvalidParamsException
+from api.models.doc import RequestLogDocument, AskLogDocument, RequestStatsRollupDocument, AskStatsRollupDocument, \
+    StatsRollupBackfillDocument
+from utils.hyperloglog import hll_add, hll_merge, hll_count
+from utils.logger import get_logger
+
+logger = get_logger(__name__)
+config = Config()
+
+# 汇总粒度：分钟、小时、天
+ROLLUP_GRANULARITIES = (60, 3600, 86400)
+BACKFILL_BATCH_SIZE = 10000
+DUPLICATE_KEY_ERROR = 11000
+
+
+def _to_timestamp(time: datetime.datetime) -> float:
+    # mongodb 中的时间不带时区，均为 UTC
+    if time.tzinfo is None:
+        time = time.replace(tzinfo=datetime.timezone.utc)
+    return time.timestamp()
+
+
+def _as_naive_utc(time: datetime.datetime) -> datetime.datetime:
+    if time.tzinfo is not None:
+        time = time.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+    return time
+
+
+def _align(time: datetime.datetime, granularity: int) -> datetime.datetime:
+    ts = int(_to_timestamp(time))
+    return datetime.datetime.utcfromtimestamp(ts - ts % granularity)
+
+
+def _enum_value(value):
+    return value.value if isinstance(value, Enum) else value
+
+
+class _RollupBucket:
+    def __init__(self):
+        self.count = 0
+        self.sums: dict[str, float] = {}
+        self.user_hll: dict[str, int] = {}
+
+    def add(self, user_id: Optional[int], sums: dict[str, Optional[float]]):
+        self.count += 1
+        for name, value in sums.items():
+            if value is not None:
+                self.sums[name] = self.sums.get(name, 0) + value
+        if user_id is not None:
+            hll_add(self.user_hll, user_id)
+
+
+class _RollupSpec:
+    def __init__(self, log_type: Type[Document], rollup_type: Type[Document], count_field: str,
+                 key_fields: tuple[str, ...], sum_fields: tuple[str, ...], ttl: int):
+        self.log_type = log_type
+        self.rollup_type = rollup_type
+        self.count_field = count_field
+        self.key_fields = key_fields
+        self.sum_fields = sum_fields
+        self.ttl = ttl
+
+
+_REQUEST_SPEC = _RollupSpec(RequestLogDocument, RequestStatsRollupDocument, "request_count", ("route_path", "method"),
+                            ("total_elapsed_ms",), config.stats.request_stats_ttl)
+_ASK_SPEC = _RollupSpec(AskLogDocument, AskStatsRollupDocument, "ask_count", ("source", "model"),
+                        ("total_ask_time", "total_queueing_time"), config.stats.ask_stats_ttl)
+
+
+def _request_entry(time, meta: dict, user_id, elapsed_ms):
+    return time, (meta["route_path"], meta["method"]), user_id, {"total_elapsed_ms": elapsed_ms}
+
+
+def _ask_entry(time, meta: dict, user_id, ask_time, queueing_time):
+    return time, (_enum_value(meta["source"]), _enum_value(meta["model"])), user_id, \
+        {"total_ask_time": ask_time, "total_queueing_time": queueing_time}
+
+
+def _add_entries(buckets: dict[tuple, _RollupBucket], entries: Iterable[tuple]):
+    """
+    entries: (time, key, user_id, sums)，key 与 spec.key_fields 对应
+    按 (粒度, 起始时间, key) 在内存中合并
+    """
+    for time, key, user_id, sums in entries:
+        for granularity in ROLLUP_GRANULARITIES:
+            bucket_key = (granularity, _align(time, granularity), *key)
+            bucket = buckets.get(bucket_key)
+            if bucket is None:
+                bucket = buckets[bucket_key] = _RollupBucket()
+            bucket.add(user_id, sums)
+
+
+async def _write_buckets(spec: _RollupSpec, buckets: dict[tuple, _RollupBucket],
+                         complete_before: Optional[datetime.datetime] = None):
+    """
+    对每个 (粒度, 起始时间, key) 执行一次 upsert，默认累加到已有的汇总中
+    :param complete_before: 回填时使用，结束时间不晚于该时间的汇总已由 buckets 完整计算，直接覆盖；
+        包含该时间的汇总同时有实时累加的数据，仍然累加，并标记 backfilled，重复回填时跳过。因此重复回填结果不变
+    """
+    if not buckets:
+        return
+    operations = []
+    for (granularity, start_time, *key), bucket in buckets.items():
+        expire_at = None
+        if granularity == ROLLUP_GRANULARITIES[0] and spec.ttl != -1:
+            expire_at = start_time + datetime.timedelta(seconds=spec.ttl)
+        if complete_before is not None and start_time + datetime.timedelta(seconds=granularity) <= complete_before:
+            update = {"$set": {
+                spec.count_field: bucket.count,
+                **{name: bucket.sums.get(name, 0) for name in spec.sum_fields},
+                "user_hll": {str(index): rank for index, rank in bucket.user_hll.items()},
+                "expire_at": expire_at,
+            }}
+        else:
+            update = {"$inc": {spec.count_field: bucket.count, **bucket.sums}}
+            if bucket.user_hll:
+                update["$max"] = {f"user_hll.{index}": rank for index, rank in bucket.user_hll.items()}
+            if expire_at is not None:
+                update["$setOnInsert"] = {"expire_at": expire_at}
+        query = {"granularity": granularity, "start_time": start_time, **dict(zip(spec.key_fields, key))}
+        if complete_before is not None and "$inc" in update:
+            query["backfilled"] = {"$ne": True}
+            update["$set"] = {"backfilled": True}
+        operations.append(UpdateOne(query, update, upsert=True))
+    try:
+        await spec.rollup_type.get_motor_collection().bulk_write(operations, ordered=False)
+    except BulkWriteError as e:
+        # 已回填过的汇总不匹配查询条件，upsert 时与唯一索引冲突
+        if complete_before is None or any(error["code"] != DUPLICATE_KEY_ERROR
+                                          for error in e.details.get("writeErrors", [])):
+            raise
+
+
+async def _write_rollups(spec: _RollupSpec, entries: Iterable[tuple]):
+    buckets: dict[tuple, _RollupBucket] = {}
+    _add_entries(buckets, entries)
+    await _write_buckets(spec, buckets)
+
+
+async def rollup_logs(docs: list[Document]):
+    """
+    将刚写入的日志累加到汇总中，由 LogSink 在写入日志后调用
+    """
+    request_entries = []
+    ask_entries = []
+    for doc in docs:
+        if isinstance(doc, RequestLogDocument):
+            request_entries.append(_request_entry(doc.time, doc.meta.model_dump(), doc.user_id, doc.elapsed_ms))
+        elif isinstance(doc, AskLogDocument):
+            ask_entries.append(_ask_entry(doc.time, doc.meta.model_dump(), doc.user_id, doc.ask_time,
+                                          doc.queueing_time))
+    if request_entries:
+        await _write_rollups(_REQUEST_SPEC, request_entries)
+    if ask_entries:
+        await _write_rollups(_ASK_SPEC, ask_entries)
+
+
+async def _backfill(spec: _RollupSpec, state: StatsRollupBackfillDocument):
+    """
+    按天回填 state.before 之前的日志，每天完成后记录进度，中断后从 done_until 继续
+    每天的汇总在内存中完整计算后再写入，重复回填同一天不会重复计数
+    """
+    name = spec.rollup_type.get_collection_name()
+    if spec is _REQUEST_SPEC:
+        projection = {"_id": 0, "time": 1, "meta": 1, "user_id": 1, "elapsed_ms": 1}
+
+        def to_entry(raw):
+            return _request_entry(raw["time"], raw["meta"], raw.get("user_id"), raw.get("elapsed_ms"))
+    else:
+        projection = {"_id": 0, "time": 1, "meta": 1, "user_id": 1, "ask_time": 1, "queueing_time": 1}
+
+        def to_entry(raw):
+            return _ask_entry(raw["time"], raw["meta"], raw.get("user_id"), raw.get("ask_time"),
+                              raw.get("queueing_time"))
+
+    collection = spec.log_type.get_motor_collection()
+    day = datetime.timedelta(seconds=ROLLUP_GRANULARITIES[-1])
+    window = state.done_until
+    if window is None:
+        first = await collection.find_one({"time": {"$lt": state.before}}, {"_id": 0, "time": 1},
+                                          sort=[("time", 1)])
+        window = _align(first["time"], ROLLUP_GRANULARITIES[-1]) if first is not None else state.before
+    if window < state.before:
+        logger.info(f"Building {name} from logs since {window}...")
+    total = 0
+    while window < state.before:
+        window_end = min(window + day, state.before)
+        buckets: dict[tuple, _RollupBucket] = {}
+        async for raw in collection.find({"time": {"$gte": window, "$lt": window_end}}, projection,
+                                         batch_size=BACKFILL_BATCH_SIZE):
+            _add_entries(buckets, (to_entry(raw),))
+            total += 1
+        await _write_buckets(spec, buckets, complete_before=state.before)
+        window = state.done_until = window_end
+        await state.save()
+    state.completed = True
+    await state.save()
+    logger.info(f"Built {name} from {total} logs.")
+
+
+_backfill_tasks: set[asyncio.Task] = set()
+
+
+async def start_rollup_backfill():
+    """
+    在后台根据已有的日志生成汇总，进度记录在 StatsRollupBackfillDocument 中，重启后继续未完成的回填
+    需要在 LogSink 启动之前调用，此后写入的日志由 rollup_logs 累加
+    """
+    now = datetime.datetime.utcnow()
+    for spec in (_REQUEST_SPEC, _ASK_SPEC):
+        name = spec.rollup_type.get_collection_name()
+        state = await StatsRollupBackfillDocument.get(name)
+        if state is None:
+            # 已有汇总但没有进度记录时，汇总是在记录进度之前生成的
+            completed = await spec.rollup_type.get_motor_collection().find_one({}, {"_id": 1}) is not None or \
+                await spec.log_type.get_motor_collection().find_one({}, {"_id": 1}) is None
+            state = StatsRollupBackfillDocument(id=name, before=now, completed=completed)
+            await state.insert()
+        if state.completed:
+            continue
+
+        async def backfill(spec=spec, state=state):
+            try:
+                await _backfill(spec, state)
+            except Exception as e:
+                logger.error(f"Failed to build {spec.rollup_type.get_collection_name()}: {e.__class__.__name__} {e}")
+
+        task = asyncio.create_task(backfill())
+        _backfill_tasks.add(task)
+        task.add_done_callback(_backfill_tasks.discard)
+
+
+async def stop_rollup_backfill():
+    """
+    取消未完成的回填，下次启动时从记录的进度继续
+    """
+    tasks = list(_backfill_tasks)
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+
+def _choose_rollup_granularity(granularity: int) -> int:
+    """
+    选择能整除查询粒度的最粗的汇总粒度
+    """
+    if granularity <= 0 or granularity % ROLLUP_GRANULARITIES[0] != 0:
+        raise InvalidParamsException("Invalid granularity")
+    return max(g for g in ROLLUP_GRANULARITIES if granularity % g == 0)
+
+
+def _align_up(time: datetime.datetime, granularity: int) -> datetime.datetime:
+    aligned = _align(time, granularity)
+    return aligned if aligned == time else aligned + datetime.timedelta(seconds=granularity)
+
+
+def _split_time_range(rollup_granularity: int, start_time: Optional[datetime.datetime],
+                      end_time: Optional[datetime.datetime]) -> list[tuple[int, dict]]:
+    """
+    将 [start_time, end_time) 拆分为 [(汇总粒度, start_time 过滤条件)]：
+    中间完整的时间段使用 rollup_granularity 的汇总，两端不完整的时间段使用分钟汇总，不返回范围外的数据
+    """
+    minute = ROLLUP_GRANULARITIES[0]
+    start = _as_naive_utc(start_time) if start_time is not None else None
+    end = _as_naive_utc(end_time) if end_time is not None else None
+    for time in (start, end):
+        if time is not None and _align(time, minute) != time:
+            raise InvalidParamsException("start_time and end_time must be whole minutes")
+
+    inner_start = _align_up(start, rollup_granularity) if start is not None else None
+    inner_end = _align(end, rollup_granularity) if end is not None else None
+    if inner_start is not None and inner_end is not None and inner_start >= inner_end:
+        # 整个范围都在同一个汇总时间段内
+        return [(minute, {"$gte": start, "$lt": end})] if start < end else []
+
+    inner_filter = {}
+    if inner_start is not None:
+        inner_filter["$gte"] = inner_start
+    if inner_end is not None:
+        inner_filter["$lt"] = inner_end
+    ranges = [(rollup_granularity, inner_filter)]
+    if start is not None and start < inner_start:
+        ranges.append((minute, {"$gte": start, "$lt": inner_start}))
+    if end is not None and inner_end < end:
+        ranges.append((minute, {"$gte": inner_end, "$lt": end}))
+    return ranges
+
+
+async def _query(spec: _RollupSpec, granularity: int, start_time: Optional[datetime.datetime],
+                 end_time: Optional[datetime.datetime], group_by_key: bool = True) -> list[tuple]:
+    """
+    :return: [(起始时间, key, count, 各项求和, 用户数)]，按起始时间和 key 排序
+    """
+    rollup_granularity = _choose_rollup_granularity(granularity)
+    projection = {"_id": 0, "start_time": 1, spec.count_field: 1, "user_hll": 1,
+                  **{name: 1 for name in spec.key_fields + spec.sum_fields}}
+
+    merged: dict[tuple, _RollupBucket] = {}
+    for range_granularity, time_filter in _split_time_range(rollup_granularity, start_time, end_time):
+        query = {"granularity": range_granularity}
+        if time_filter:
+            query["start_time"] = time_filter
+        async for raw in spec.rollup_type.get_motor_collection().find(query, projection):
+            key = tuple(raw.get(name) for name in spec.key_fields) if group_by_key else ()
+            bucket_key = (_align(raw["start_time"], granularity), key)
+            bucket = merged.get(bucket_key)
+            if bucket is None:
+                bucket = merged[bucket_key] = _RollupBucket()
+            bucket.count += raw.get(spec.count_field, 0)
+            for name in spec.sum_fields:
+                bucket.sums[name] = bucket.sums.get(name, 0) + (raw.get(name) or 0)
+            hll_merge(bucket.user_hll, raw.get("user_hll") or {})
+
+    return [
+        (start, key, bucket.count, bucket.sums, hll_count(bucket.user_hll))
+        for (start, key), bucket in sorted(merged.items(), key=lambda item: (item[0][0], *map(str, item[0][1])))
+    ]
+
+
+async def query_request_stats(granularity: int, start_time: Optional[datetime.datetime] = None,
+                              end_time: Optional[datetime.datetime] = None, group_by_route: bool = True) -> list[dict]:
+    rows = await _query(_REQUEST_SPEC, granularity, start_time, end_time, group_by_route)
+    result = []
+    for start, key, count, sums, user_count in rows:
+        route_path, method = key if key else (None, None)
+        result.append({
+            "_id": {"start_time": start, "route_path": route_path, "method": method},
+            "count": count,
+            "user_count": user_count,
+            "avg_elapsed_ms": sums["total_elapsed_ms"] / count if count else None,
+        })
+    return result
+
+
+async def query_ask_stats(granularity: int, start_time: Optional[datetime.datetime] = None,
+                          end_time: Optional[datetime.datetime] = None) -> list[dict]:
+    rows = await _query(_ASK_SPEC, granularity, start_time, end_time)
+    return [{
+        "_id": {"start_time": start, "meta": {"source": source, "model": model}},
+        "count": count,
+        "user_count": user_count,
+        "total_ask_time": sums["total_ask_time"],
+        "total_queueing_time": sums["total_queueing_time"],
+    } for start, (source, model), count, sums, user_count in rows]
@@ -0,0 +1,76 @@
+import asyncio
+from datetime import datetime, timezone
+
+from sqlalchemy import update
+
+from api.conf import Config
+from api.database.sqlalchemy import get_async_session_context
+from api.models.db import User
+from utils.common import SingletonMeta
+from utils.logger import get_logger
+
+logger = get_logger(__name__)
+config = Config()
+
+
+class UserActivityTracker(metaclass=SingletonMeta):
+    """
+    用户最后活跃时间的内存记录
+
+    - record() 只更新内存，同一用户在一个周期内的多次请求合并为一次
+    - 每隔 last_active_flush_interval_seconds 秒用一条批量 UPDATE 写入数据库
+    - stop() 在关闭时写入剩余的记录
+    """
+
+    def __init__(self):
+        self.flush_interval = config.auth.last_active_flush_interval_seconds
+        self._pending: dict[int, datetime] = {}
+        self._stop_event = asyncio.Event()
+        self._flush_task: asyncio.Task | None = None
+        self._stopping = False
+
+    def record(self, user_id: int):
+        self._pending[user_id] = datetime.now().astimezone(tz=timezone.utc)
+
+    def get_last_active_time(self, user_id: int) -> datetime | None:
+        """
+        尚未写入数据库的最后活跃时间
+        """
+        return self._pending.get(user_id)
+
+    async def flush(self):
+        if not self._pending:
+            return
+        pending, self._pending = self._pending, {}
+        try:
+            async with get_async_session_context() as session:
+                await session.execute(
+                    update(User),
+                    [{"id": user_id, "last_active_time": active_time} for user_id, active_time in pending.items()]
+                )
+                await session.commit()
+        except Exception as e:
+            logger.error(f"Failed to update last_active_time of {len(pending)} users: {e.__class__.__name__} {e}")
+            # 写入失败时放回，保留较新的时间
+            for user_id, active_time in pending.items():
+                self._pending.setdefault(user_id, active_time)
+
+    async def _flush_loop(self):
+        while not self._stopping:
+            try:
+                await asyncio.wait_for(self._stop_event.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            await self.flush()
+
+    def start(self):
+        if self._flush_task is None:
+            self._flush_task = asyncio.create_task(self._flush_loop())
+
+    async def stop(self):
+        self._stopping = True
+        if self._flush_task is not None:
+            self._stop_event.set()
+            await self._flush_task
+            self._flush_task = None
+        await self.flush()
@@ -1,21 +1,29 @@
 import contextlib
+import copy
 import re
-from datetime import datetime, timezone
+import time
 from typing import Any, Optional, Union
 
+import jwt
 from fastapi import Depends, Request
 from fastapi.security import OAuth2PasswordRequestForm
 from fastapi_users import BaseUserManager, FastAPIUsers, models, IntegerIDMixin, InvalidID
 from fastapi_users.authentication import CookieTransport, AuthenticationBackend, JWTStrategy
+from fastapi_users.jwt import decode_jwt
 from fastapi_users.models import UP
-from sqlalchemy import select, Integer, inspect
+from pydantic import BaseModel
+from sqlalchemy import select, update, Integer, inspect
+from sqlalchemy.orm import make_transient_to_detached
+from sqlalchemy.orm.attributes import set_committed_value
 from starlette.websockets import WebSocket
 
 import api.exceptions
 from api.conf import Config
-from api.database.sqlalchemy import get_user_db, get_async_session_context, get_user_db_context
+from api.database.sqlalchemy import get_user_db, get_async_session_context, get_async_read_session_context, \
+    get_user_db_context
 from api.models.db import User, UserSetting
 from api.schemas import UserCreate, UserSettingSchema, UserUpdate, UserUpdateAdmin
+from api.user_activity import UserActivityTracker
 from utils.logger import get_logger
 
 logger = get_logger(__name__)
@@ -34,16 +42,129 @@ cookie_transport = CookieTransport(
 )
 
 
+# 缓存 JWT 对应的用户，避免每个请求都查询数据库
+
+def _copy_value(value):
+    if isinstance(value, BaseModel):
+        return value.model_copy(deep=True)
+    if isinstance(value, (dict, list, set)):
+        return copy.deepcopy(value)
+    return value
+
+
+def _copy_detached(obj):
+    """
+    复制已加载的列属性，得到一个新的 detached 对象；未加载的关系与原对象一样不可访问
+    """
+    mapper = inspect(obj).mapper
+    loaded = obj.__dict__
+    new_obj = mapper.class_manager.new_instance()
+    new_obj.__dict__.update({attr.key: _copy_value(loaded[attr.key])
+                             for attr in mapper.column_attrs if attr.key in loaded})
+    make_transient_to_detached(new_obj)
+    return new_obj
+
+
+def _copy_user(user: User) -> User:
+    new_user = _copy_detached(user)
+    setting = user.__dict__.get("setting")
+    if setting is not None:
+        new_setting = _copy_detached(setting)
+        if "ask_quotas" in setting.__dict__:
+            set_committed_value(new_setting, "ask_quotas", [_copy_detached(quota) for quota in setting.ask_quotas])
+        set_committed_value(new_setting, "user", new_user)
+        set_committed_value(new_user, "setting", new_setting)
+    return new_user
+
+
+class UserCache:
+    """
+    token -> User 的短时缓存，用户信息变更时需要调用 invalidate 使其失效
+    每次读取返回一份副本，避免并发请求修改同一个对象
+    invalidate 只对当前进程生效，多进程部署时其它进程最多在 user_cache_ttl_seconds 内读到旧的用户信息
+    """
+
+    PRUNE_SIZE = 1000
+
+    def __init__(self):
+        self._cache: dict[str, tuple[float, User]] = {}
+        self._tokens_by_user: dict[int, set[str]] = {}
+
+    def get(self, token: str) -> Optional[User]:
+        item = self._cache.get(token)
+        if item is None:
+            return None
+        expire_at, user = item
+        if expire_at < time.monotonic():
+            self.pop(token)
+            return None
+        return _copy_user(user)
+
+    def set(self, token: str, user: User):
+        ttl = config.auth.user_cache_ttl_seconds
+        if ttl <= 0:
+            return
+        now = time.monotonic()
+        if len(self._cache) >= self.PRUNE_SIZE:
+            for k in [k for k, v in self._cache.items() if v[0] < now]:
+                self.pop(k)
+        self.pop(token)
+        self._cache[token] = (now + ttl, _copy_user(user))
+        self._tokens_by_user.setdefault(user.id, set()).add(token)
+
+    def pop(self, token: str):
+        item = self._cache.pop(token, None)
+        if item is None:
+            return
+        tokens = self._tokens_by_user.get(item[1].id)
+        if tokens is not None:
+            tokens.discard(token)
+            if not tokens:
+                del self._tokens_by_user[item[1].id]
+
+    def invalidate(self, user_id: int):
+        for token in self._tokens_by_user.pop(user_id, ()):
+            self._cache.pop(token, None)
+
+    def clear(self):
+        self._cache.clear()
+        self._tokens_by_user.clear()
+
+
+user_cache = UserCache()
+
+
+class CachedJWTStrategy(JWTStrategy):
+    async def read_token(self, token: Optional[str], user_manager: BaseUserManager[User, Integer]) -> Optional[User]:
+        if token is None:
+            return None
+        user = user_cache.get(token)
+        if user is not None:
+            return user
+        user = await super().read_token(token, user_manager)
+        if user is not None:
+            user_cache.set(token, user)
+        return user
+
+    async def destroy_token(self, token: str, user: User) -> None:
+        user_cache.pop(token)
+        await super().destroy_token(token, user)
+
+
 # auth backend
 
 def get_jwt_strategy() -> JWTStrategy:
     return JWTStrategy(secret=config.auth.jwt_secret, lifetime_seconds=config.auth.jwt_lifetime_seconds)
 
 
+def get_cached_jwt_strategy() -> JWTStrategy:
+    return CachedJWTStrategy(secret=config.auth.jwt_secret, lifetime_seconds=config.auth.jwt_lifetime_seconds)
+
+
 auth_backend = AuthenticationBackend(
     name="jwt",
     transport=cookie_transport,
-    get_strategy=get_jwt_strategy,
+    get_strategy=get_cached_jwt_strategy,
 )
 
 # UserManager
@@ -52,7 +173,7 @@ SECRET = config.auth.user_secret
 
 
 async def get_by_username(username: str) -> Optional[UP]:
-    async with get_async_session_context() as session:
+    async with get_async_read_session_context() as session:
         user = await session.execute(select(User).filter(User.username == username))
         return user.scalar_one_or_none()
 
@@ -72,7 +193,7 @@ class UserManager(IntegerIDMixin, BaseUserManager[User, Integer]):
     async def _check_username_unique(self, username, exclude_username=None):
         if not username:
             return
-        async with get_async_session_context() as session:
+        async with get_async_read_session_context() as session:
             user = (await session.execute(select(User).filter(User.username == username))).scalar_one_or_none()
             if user and user.username != exclude_username:
                 raise api.exceptions.UserAlreadyExists("Username already exists")
@@ -131,6 +252,7 @@ class UserManager(IntegerIDMixin, BaseUserManager[User, Integer]):
             session.add(user)
             await session.commit()
             await session.refresh(user)
+            user_cache.invalidate(user.id)
             return user
 
     reset_password_token_secret = SECRET
@@ -166,27 +288,30 @@ class UserManager(IntegerIDMixin, BaseUserManager[User, Integer]):
             return None
         # Update password hash to a more robust one if needed
         if updated_password_hash is not None:
-            await self.user_db.update(user, {"hashed_password": updated_password_hash})
+            # user_db 使用只读 session
+            async with get_async_session_context() as session:
+                await session.execute(
+                    update(User).where(User.id == user.id).values(hashed_password=updated_password_hash))
+                await session.commit()
+            user.hashed_password = updated_password_hash
 
         return user
 
 
-async def websocket_auth(websocket: WebSocket) -> User | None:
-    user_db = None
+def websocket_auth_user_id(websocket: WebSocket) -> int | None:
+    """
+    只校验 cookie 中的 JWT 并返回用户 id
+    对话前需要读取最新的设置和额度，用户由 AskUnitOfWork 与对话数据一起读取，因此不使用 user_cache
+    """
+    token = websocket.cookies.get(COOKIE_NAME)
+    if token is None:
+        return None
+    strategy = get_jwt_strategy()
     try:
-        cookie = websocket._cookies[COOKIE_NAME]
-        async with get_async_session_context() as session:
-            async with get_user_db_context(session) as user_db:
-                async with get_user_manager_context(user_db) as user_manager:
-                    # user = await get_jwt_strategy().read_token(cookie, user_manager)
-                    user_db, _ = await fastapi_users.authenticator._authenticate(
-                        active=True,
-                        user_manager=user_manager,
-                        jwt=cookie,
-                        strategy_jwt=get_jwt_strategy(),
-                    )
-    finally:
-        return user_db
+        data = decode_jwt(token, strategy.decode_key, strategy.token_audience, algorithms=[strategy.algorithm])
+        return int(data["sub"])
+    except (jwt.PyJWTError, KeyError, TypeError, ValueError):
+        return None
 
 
 async def get_user_manager(user_db=Depends(get_user_db)):
@@ -202,17 +327,10 @@ __current_active_user = fastapi_users.current_user(active=True)
 
 
 async def current_active_user(request: Request, user: User = Depends(__current_active_user)):
-    try:
-        async with get_async_session_context() as session:
-            user_update = await session.get(User, user.id)
-            user_update.last_active_time = datetime.now().astimezone(tz=timezone.utc)
-            session.add(user_update)
-            await session.commit()
-        request.scope["auth_user"] = user
-    except Exception as e:
-        raise e
-    finally:
-        return user
+    # 最后活跃时间由 UserActivityTracker 定期批量写入
+    UserActivityTracker().record(user.id)
+    request.scope["auth_user"] = user
+    return user
 
 
 # current_super_user = fastapi_users.current_user(active=True, superuser=True)
@@ -12,20 +12,23 @@ from fastapi.middleware.cors import CORSMiddleware
 from fastapi_cache import FastAPICache
 from fastapi_cache.backends.inmemory import InMemoryBackend
 from pydantic import EmailStr
-from sqlalchemy import select
 from starlette.exceptions import HTTPException as StarletteHTTPException
 
 import api.globals as g
-from api.database.sqlalchemy import initialize_db, get_async_session_context, get_user_db_context
+from api.database.sqlalchemy import initialize_db, get_async_read_session_context, get_user_db_context
+from api.database.log_sink import LogSink
 from api.database.mongodb import init_mongodb
-from api.enums import OpenaiWebChatStatus
 from api.exceptions import SelfDefinedException, UserAlreadyExists, ArkoseForwardException
 from api.middlewares import AccessLoggerMiddleware, StatisticsMiddleware
-from api.models.db import User
 from api.response import CustomJSONResponse, handle_exception_response, handle_arkose_forward_exception
 from api.routers import users, conv, chat, system, status, files, logs, arkose
 from api.schemas import UserCreate, UserSettingSchema
 from api.sources import OpenaiWebChatManager
+from api.stats_rollup import start_rollup_backfill, stop_rollup_backfill
+from api.ask_counter import AskCounter
+from api.coordination import Coordinator
+from api.rate_limit import RateLimiter
+from api.user_activity import UserActivityTracker
 from api.users import get_user_manager_context
 from utils.admin import sync_conversations
 from utils.logger import setup_logger, get_log_config, get_logger
@@ -46,6 +49,12 @@ if config.log.console_log_level != "DEBUG":
 async def startup():
     await initialize_db()
     await init_mongodb()
+    await start_rollup_backfill()
+    await AskCounter().rebuild()
+    await RateLimiter().rebuild()
+    await Coordinator().start()
+    LogSink().start()
+    UserActivityTracker().start()
 
     FastAPICache.init(InMemoryBackend())
 
@@ -56,7 +65,7 @@ async def startup():
 
     if config.common.create_initial_admin_user:
         try:
-            async with get_async_session_context() as session:
+            async with get_async_read_session_context() as session:
                 async with get_user_db_context(session) as user_db:
                     async with get_user_manager_context(user_db) as user_manager:
                         user = await user_manager.create(UserCreate(
@@ -74,15 +83,6 @@ async def startup():
         except Exception as e:
             raise e
 
-    # 重置所有用户 chat_status
-    async with get_async_session_context() as session:
-        r = await session.execute(select(User))
-        results = r.scalars().all()
-        for user in results:
-            user.setting.openai_web_chat_status = OpenaiWebChatStatus.idling
-            session.add(user.setting)
-        await session.commit()
-
     if config.openai_web.chatgpt_base_url is None:
         logger.error("chatgpt_base_url is not set in config!")
         exit(1)
@@ -95,7 +95,8 @@ async def startup():
         logger.info("Sync conversations on startup disabled.")
         return
     else:
-        await sync_conversations()
+        # 在后台同步，不阻塞启动；保留任务引用，避免被垃圾回收，并在关闭时取消
+        g.sync_conversations_task = asyncio.create_task(sync_conversations())
 
     if config.openai_web.sync_conversations_schedule:
         logger.info("Sync conversations regularly enabled, will sync conversations every 12 hours.")
@@ -107,10 +108,21 @@ async def startup():
             await sync_conversations()
 
 
+async def shutdown():
+    if g.sync_conversations_task is not None:
+        g.sync_conversations_task.cancel()
+        await asyncio.gather(g.sync_conversations_task, return_exceptions=True)
+    await stop_rollup_backfill()
+    await Coordinator().stop()
+    await UserActivityTracker().stop()
+    await LogSink().stop()
+
+
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     await startup()
     yield
+    await shutdown()
 
 
 app = FastAPI(
@@ -0,0 +1,57 @@
+import os
+import tempfile
+
+import pytest
+
+# api 中的模块在导入时就会读取配置，因此需要在导入任何 api 模块之前准备好测试用的配置目录
+_data_dir = tempfile.mkdtemp(prefix="cws-test-")
+os.environ["CWS_CONFIG_DIR"] = os.path.join(_data_dir, "config")
+
+
+def _write_test_config():
+    from fastapi.encoders import jsonable_encoder
+    from ruamel.yaml import YAML
+
+    from api.conf.config import ConfigModel
+    from api.conf.credentials import CredentialsModel
+
+    config = ConfigModel()
+    config.data.data_dir = _data_dir
+    config.data.database_url = f"sqlite+aiosqlite:///{os.path.join(_data_dir, 'database.db')}"
+    config.log.console_log_level = "WARNING"
+
+    config_dir = os.environ["CWS_CONFIG_DIR"]
+    os.makedirs(config_dir, exist_ok=True)
+    for filename, model in (("config.yaml", config), ("credentials.yaml", CredentialsModel())):
+        with open(os.path.join(config_dir, filename), mode="w", encoding="utf-8") as f:
+            YAML().dump(jsonable_encoder(model.model_dump()), f)
+
+
+_write_test_config()
+
+# api.models.doc 与 api.schemas 相互导入，与应用启动时一样先导入 api.schemas
+import api.schemas  # noqa: E402,F401
+
+
+@pytest.fixture
+def anyio_backend():
+    return "asyncio"
+
+
+@pytest.fixture
+async def mongodb():
+    """
+    每个测试使用独立的 mongomock 数据库，不需要运行 MongoDB
+    """
+    from beanie import init_beanie
+    from mongomock_motor import AsyncMongoMockClient
+
+    from api.models.doc import CoordinationWorkerDocument, UserChatStatusDocument, AccountSlotDocument, \
+        AskCountBucketDocument, RequestStatsRollupDocument, AskStatsRollupDocument, StatsRollupBackfillDocument
+
+    database = AsyncMongoMockClient()["cws_test"]
+    await init_beanie(database=database, document_models=[CoordinationWorkerDocument, UserChatStatusDocument,
+                                                          AccountSlotDocument, AskCountBucketDocument,
+                                                          RequestStatsRollupDocument, AskStatsRollupDocument,
+                                                          StatsRollupBackfillDocument])
+    yield database
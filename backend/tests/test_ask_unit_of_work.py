@@ -0,0 +1,142 @@
+import uuid
+
+import pytest
+from sqlalchemy import select, and_
+
+from api.ask_quota import AskQuotaExhaustedException
+from api.ask_unit_of_work import AskUnitOfWork
+from api.database.sqlalchemy import initialize_db, get_async_session_context, get_user_db_context, \
+    count_sql_queries
+from api.models.db import User, OpenaiApiConversation, UserAskQuota, TOTAL_ASK_COUNT_KEY
+from api.schemas import UserCreate, UserSettingSchema, AskRequest
+from api.users import get_user_manager_context
+
+pytestmark = pytest.mark.anyio
+
+
+async def _create_user(total_ask_count: int = 5, model_ask_count: int = 3):
+    await initialize_db()
+    setting = UserSettingSchema.default()
+    setting.openai_api.allow_to_use = True
+    setting.openai_api.total_ask_count = total_ask_count
+    setting.openai_api.per_model_ask_count.root["gpt_3_5"] = model_ask_count
+    username = f"user_{uuid.uuid4().hex[:8]}"
+    async with get_async_session_context() as session:
+        async with get_user_db_context(session) as user_db:
+            async with get_user_manager_context(user_db) as user_manager:
+                return await user_manager.create(
+                    UserCreate(username=username, nickname=username, email=f"{username}@example.com",
+                               password="12345678", is_active=True, is_verified=True, is_superuser=False),
+                    user_setting=setting, safe=False)
+
+
+async def _create_conversations(user_id: int, count: int) -> list[uuid.UUID]:
+    conversation_ids = [uuid.uuid4() for _ in range(count)]
+    async with get_async_session_context() as session:
+        for conversation_id in conversation_ids:
+            session.add(OpenaiApiConversation(source="openai_api", conversation_id=conversation_id, user_id=user_id,
+                                              is_valid=True, current_model="gpt_3_5", title="title"))
+        await session.commit()
+    return conversation_ids
+
+
+async def _get_remaining(user_setting_id: int) -> dict[str, int]:
+    async with get_async_session_context() as session:
+        r = await session.execute(
+            select(UserAskQuota.model, UserAskQuota.remaining)
+            .where(and_(UserAskQuota.user_setting_id == user_setting_id, UserAskQuota.source == "openai_api",
+                        UserAskQuota.model.in_([TOTAL_ASK_COUNT_KEY, "gpt_3_5"])))
+        )
+        return dict(r.tuples().all())
+
+
+def _continue_request(conversation_id: uuid.UUID) -> AskRequest:
+    return AskRequest(source="openai_api", model="gpt_3_5", new_conversation=False, conversation_id=conversation_id,
+                      parent=uuid.uuid4(), text_content="hello")
+
+
+async def test_load_in_one_query():
+    user = await _create_user()
+    conversation_ids = await _create_conversations(user.id, 2)
+
+    uow = AskUnitOfWork(user.id, _continue_request(conversation_ids[0]))
+    with count_sql_queries() as counter:
+        user_db = await uow.load()
+    assert counter.count == 1
+    assert user_db.id == user.id
+    assert {quota.model for quota in user_db.setting.ask_quotas if quota.source == "openai_api"} >= \
+           {TOTAL_ASK_COUNT_KEY, "gpt_3_5"}
+    assert uow.conv_count == 2
+    assert uow.conversation.conversation_id == conversation_ids[0]
+
+
+async def test_load_missing_user_or_conversation():
+    user = await _create_user()
+
+    uow = AskUnitOfWork(user.id, _continue_request(uuid.uuid4()))
+    assert (await uow.load()).id == user.id
+    assert uow.conversation is None
+    assert uow.conv_count == 0
+
+    assert await AskUnitOfWork(-1, _continue_request(uuid.uuid4())).load() is None
+
+
+async def test_ask_loads_and_reserves_in_three_queries():
+    user = await _create_user(total_ask_count=5, model_ask_count=3)
+    conversation_ids = await _create_conversations(user.id, 1)
+
+    with count_sql_queries() as counter:
+        uow = AskUnitOfWork(user.id, _continue_request(conversation_ids[0]))
+        await uow.load()
+        reservation = await uow.reserve_ask_quota()
+    # 一条查询读取，总次数和模型次数各一条 UPDATE
+    assert counter.count == 3
+    assert reservation.models == [TOTAL_ASK_COUNT_KEY, "gpt_3_5"]
+    assert await _get_remaining(user.setting.id) == {TOTAL_ASK_COUNT_KEY: 4, "gpt_3_5": 2}
+
+
+async def test_unlimited_quota_is_not_updated():
+    user = await _create_user(total_ask_count=-1, model_ask_count=3)
+
+    uow = AskUnitOfWork(user.id, AskRequest(source="openai_api", model="gpt_3_5", new_conversation=True,
+                                            text_content="hello"))
+    await uow.load()
+    with count_sql_queries() as counter:
+        reservation = await uow.reserve_ask_quota()
+    assert counter.count == 1
+    assert reservation.models == ["gpt_3_5"]
+    assert await _get_remaining(user.setting.id) == {TOTAL_ASK_COUNT_KEY: -1, "gpt_3_5": 2}
+
+
+async def test_exhausted_quota_is_not_reserved():
+    user = await _create_user(total_ask_count=5, model_ask_count=0)
+
+    uow = AskUnitOfWork(user.id, AskRequest(source="openai_api", model="gpt_3_5", new_conversation=True,
+                                            text_content="hello"))
+    await uow.load()
+    with pytest.raises(AskQuotaExhaustedException) as e:
+        await uow.reserve_ask_quota()
+    assert e.value.model == "gpt_3_5"
+    # 总次数的扣减随事务回滚
+    assert await _get_remaining(user.setting.id) == {TOTAL_ASK_COUNT_KEY: 5, "gpt_3_5": 0}
+
+
+async def test_removed_model_quota_is_not_reserved():
+    user = await _create_user(total_ask_count=5, model_ask_count=3)
+
+    async with get_async_session_context() as session:
+        setting = (await session.get(User, user.id)).setting
+        openai_api = setting.openai_api.model_copy(deep=True)
+        del openai_api.per_model_ask_count.root["gpt_3_5"]
+        setting.openai_api = openai_api
+        await session.commit()
+    assert await _get_remaining(user.setting.id) == {TOTAL_ASK_COUNT_KEY: 5}
+
+    uow = AskUnitOfWork(user.id, AskRequest(source="openai_api", model="gpt_3_5", new_conversation=True,
+                                            text_content="hello"))
+    await uow.load()
+    assert uow.user.setting.openai_api.per_model_ask_count.root.get("gpt_3_5", 0) == 0
+    with pytest.raises(AskQuotaExhaustedException) as e:
+        await uow.reserve_ask_quota()
+    assert e.value.model == "gpt_3_5"
+    assert await _get_remaining(user.setting.id) == {TOTAL_ASK_COUNT_KEY: 5}
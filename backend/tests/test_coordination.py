@@ -0,0 +1,159 @@
+import asyncio
+from datetime import datetime, timedelta
+
+import pytest
+
+from api.coordination import InProcessCoordinationBackend, MongoCoordinationBackend, WORKER_LEASE_SECONDS
+from api.enums import OpenaiWebChatStatus
+from api.models.doc import CoordinationWorkerDocument, UserChatStatusDocument, AccountSlotDocument
+
+pytestmark = pytest.mark.anyio
+
+
+@pytest.fixture
+async def mongo_workers(mongodb):
+    """
+    两个共享同一数据库的 worker
+    """
+    workers = [MongoCoordinationBackend(), MongoCoordinationBackend()]
+    for worker in workers:
+        await worker.start()
+    yield workers
+    for worker in workers:
+        if worker._heartbeat_task is not None:
+            worker._heartbeat_task.cancel()
+
+
+@pytest.fixture(params=["memory", "mongodb"])
+async def backend(request, mongodb):
+    if request.param == "memory":
+        yield InProcessCoordinationBackend()
+        return
+    worker = MongoCoordinationBackend()
+    await worker.start()
+    yield worker
+    worker._heartbeat_task.cancel()
+
+
+async def _expire_lease(worker: MongoCoordinationBackend):
+    worker._heartbeat_task.cancel()
+    worker._heartbeat_task = None
+    await CoordinationWorkerDocument.get_motor_collection().update_one(
+        {"_id": worker.worker_id}, {"$set": {"expire_at": datetime.utcnow() - timedelta(seconds=1)}})
+
+
+async def test_chat_status(backend):
+    assert await backend.get_chat_status(1) == OpenaiWebChatStatus.idling
+
+    await backend.set_chat_status(1, OpenaiWebChatStatus.queueing)
+    await backend.set_chat_status(2, OpenaiWebChatStatus.asking)
+    await backend.set_chat_status(3, OpenaiWebChatStatus.queueing)
+    assert await backend.get_chat_status(1) == OpenaiWebChatStatus.queueing
+    assert await backend.count_chat_status(OpenaiWebChatStatus.queueing) == 2
+    assert await backend.get_chat_statuses() == {1: OpenaiWebChatStatus.queueing, 2: OpenaiWebChatStatus.asking,
+                                                 3: OpenaiWebChatStatus.queueing}
+
+    # 空闲的用户不保留记录
+    await backend.set_chat_status(1, OpenaiWebChatStatus.idling)
+    assert await backend.get_chat_status(1) == OpenaiWebChatStatus.idling
+    assert 1 not in await backend.get_chat_statuses()
+
+
+async def test_compare_and_set_chat_status(backend):
+    assert await backend.compare_and_set_chat_status(1, OpenaiWebChatStatus.idling, OpenaiWebChatStatus.queueing)
+    assert not await backend.compare_and_set_chat_status(1, OpenaiWebChatStatus.idling, OpenaiWebChatStatus.queueing)
+    assert not await backend.compare_and_set_chat_status(1, OpenaiWebChatStatus.asking, OpenaiWebChatStatus.idling)
+    assert await backend.get_chat_status(1) == OpenaiWebChatStatus.queueing
+
+    assert await backend.compare_and_set_chat_status(1, OpenaiWebChatStatus.queueing, OpenaiWebChatStatus.asking)
+    assert await backend.compare_and_set_chat_status(1, OpenaiWebChatStatus.asking, OpenaiWebChatStatus.asking)
+    assert await backend.compare_and_set_chat_status(1, OpenaiWebChatStatus.asking, OpenaiWebChatStatus.idling)
+    assert await backend.get_chat_status(1) == OpenaiWebChatStatus.idling
+
+
+async def test_slots(backend):
+    assert [await backend.try_acquire_slot("default", 2) for _ in range(3)] == [True, True, False]
+    assert await backend.try_acquire_slot("team", 1)
+    assert await backend.get_slot_counts() == {"default": 2, "team": 1}
+
+    await backend.release_slot("default")
+    assert await backend.try_acquire_slot("default", 2)
+
+    # 释放次数多于占用次数时不会变为负数
+    for _ in range(3):
+        await backend.release_slot("team")
+    assert (await backend.get_slot_counts())["team"] == 0
+
+
+async def test_compare_and_set_is_exclusive_across_workers(mongo_workers):
+    results = await asyncio.gather(*(
+        worker.compare_and_set_chat_status(1, OpenaiWebChatStatus.idling, OpenaiWebChatStatus.queueing)
+        for worker in mongo_workers * 3
+    ))
+    assert results.count(True) == 1
+
+
+async def test_slot_limit_is_shared_across_workers(mongo_workers):
+    a, b = mongo_workers
+    assert await a.try_acquire_slot("default", 2)
+    assert await b.try_acquire_slot("default", 2)
+    assert not await a.try_acquire_slot("default", 2)
+    assert not await b.try_acquire_slot("default", 2)
+
+    # 只能释放本 worker 占用的槽位
+    await a.release_slot("default")
+    await a.release_slot("default")
+    doc = await AccountSlotDocument.get_motor_collection().find_one({"_id": "default"})
+    assert doc["total"] == 1
+    assert doc["workers"] == {a.worker_id: 0, b.worker_id: 1}
+
+
+async def test_heartbeat_renews_lease(mongo_workers):
+    worker = mongo_workers[0]
+    collection = CoordinationWorkerDocument.get_motor_collection()
+    doc = await collection.find_one({"_id": worker.worker_id})
+    assert doc["expire_at"] > datetime.utcnow()
+
+    await _expire_lease(worker)
+    await worker._heartbeat()
+    doc = await collection.find_one({"_id": worker.worker_id})
+    assert doc["expire_at"] > datetime.utcnow() + timedelta(seconds=WORKER_LEASE_SECONDS - 5)
+
+
+async def test_reap_releases_state_of_expired_worker(mongo_workers):
+    a, b = mongo_workers
+    await a.set_chat_status(1, OpenaiWebChatStatus.asking)
+    await a.set_chat_status(2, OpenaiWebChatStatus.queueing)
+    await b.set_chat_status(3, OpenaiWebChatStatus.asking)
+    assert await a.try_acquire_slot("default", 3)
+    assert await a.try_acquire_slot("default", 3)
+    assert await b.try_acquire_slot("default", 3)
+
+    # 租约未过期时不回收
+    await b._reap()
+    assert await b.get_slot_counts() == {"default": 3}
+
+    await _expire_lease(a)
+    await b._reap()
+    assert await b.get_chat_statuses() == {3: OpenaiWebChatStatus.asking}
+    assert await b.get_slot_counts() == {"default": 1}
+    doc = await AccountSlotDocument.get_motor_collection().find_one({"_id": "default"})
+    assert doc["workers"] == {b.worker_id: 1}
+
+    # 回收后其它 worker 可以使用释放的槽位
+    assert await b.try_acquire_slot("default", 3)
+    assert await b.try_acquire_slot("default", 3)
+    assert not await b.try_acquire_slot("default", 3)
+
+
+async def test_stop_releases_own_state(mongo_workers):
+    a, b = mongo_workers
+    await a.set_chat_status(1, OpenaiWebChatStatus.asking)
+    assert await a.try_acquire_slot("default", 2)
+    await b.set_chat_status(2, OpenaiWebChatStatus.asking)
+
+    await a.stop()
+    assert await CoordinationWorkerDocument.get_motor_collection().find_one({"_id": a.worker_id}) is None
+    assert await UserChatStatusDocument.get_motor_collection().count_documents({"worker_id": a.worker_id}) == 0
+    assert await b.get_chat_statuses() == {2: OpenaiWebChatStatus.asking}
+    assert await b.get_slot_counts() == {"default": 0}
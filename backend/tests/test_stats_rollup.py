@@ -0,0 +1,127 @@
+import asyncio
+from datetime import datetime, timedelta
+
+import pytest
+
+from api.exceptions import InvalidParamsException
+from api.models.doc import RequestLogDocument, AskLogDocument, StatsRollupBackfillDocument
+from api.stats_rollup import _REQUEST_SPEC, _request_entry, _write_rollups, _backfill, query_request_stats, \
+    start_rollup_backfill, stop_rollup_backfill, _backfill_tasks
+
+pytestmark = pytest.mark.anyio
+
+# 分钟汇总与日志同时过期，因此使用最近的时间
+DAY = datetime.combine(datetime.utcnow().date() - timedelta(days=1), datetime.min.time())
+
+
+def _at(hour: int, minute: int = 0, second: int = 0) -> datetime:
+    return DAY + timedelta(hours=hour, minutes=minute, seconds=second)
+
+
+def _entry(time: datetime, user_id: int = 1, elapsed_ms: float = 10):
+    return _request_entry(time, {"route_path": "/conv", "method": "GET"}, user_id, elapsed_ms)
+
+
+async def _write_requests(*times: datetime):
+    await _write_rollups(_REQUEST_SPEC, [_entry(time, user_id=i) for i, time in enumerate(times)])
+
+
+def _counts(rows: list[dict]) -> dict[datetime, int]:
+    return {row["_id"]["start_time"]: row["count"] for row in rows}
+
+
+async def test_query_merges_rollups(mongodb):
+    await _write_requests(_at(10, 10), _at(10, 40), _at(11, 20))
+
+    rows = await query_request_stats(3600)
+    assert _counts(rows) == {_at(10): 2, _at(11): 1}
+    assert rows[0]["user_count"] == 2
+    assert rows[0]["avg_elapsed_ms"] == 10
+    assert _counts(await query_request_stats(1800, group_by_route=False)) == {
+        _at(10): 1, _at(10, 30): 1, _at(11): 1}
+
+
+async def test_query_does_not_return_data_outside_range(mongodb):
+    await _write_requests(_at(10, 10), _at(10, 40), _at(11, 20), _at(11, 50))
+
+    rows = await query_request_stats(3600, _at(10, 30), _at(11, 30))
+    assert _counts(rows) == {_at(10): 1, _at(11): 1}
+
+    # 范围在同一个汇总时间段内
+    rows = await query_request_stats(86400, _at(10, 30), _at(11, 30))
+    assert _counts(rows) == {DAY: 2}
+
+    rows = await query_request_stats(3600, _at(11), None)
+    assert _counts(rows) == {_at(11): 2}
+
+
+async def test_query_rejects_invalid_params(mongodb):
+    with pytest.raises(InvalidParamsException):
+        await query_request_stats(90)
+    with pytest.raises(InvalidParamsException):
+        await query_request_stats(3600, _at(10, 30, 15))
+
+
+@pytest.fixture
+async def log_collections(mongodb, monkeypatch):
+    """
+    mongomock 不支持时序集合，日志使用普通集合
+    """
+    collections = {}
+    for document_type in (RequestLogDocument, AskLogDocument):
+        collection = mongodb[document_type.Settings.name]
+        collections[document_type] = collection
+        monkeypatch.setattr(document_type, "get_motor_collection", classmethod(lambda cls, c=collection: c))
+    return collections
+
+
+async def _insert_request_logs(collection, *times: datetime):
+    await collection.insert_many([{"time": time, "meta": {"route_path": "/conv", "method": "GET"}, "user_id": 1,
+                                   "elapsed_ms": 10} for time in times])
+
+
+async def test_backfill_can_be_resumed(log_collections):
+    await _insert_request_logs(log_collections[RequestLogDocument], DAY - timedelta(days=2), DAY - timedelta(days=1),
+                               _at(10), _at(11, 30))
+    name = _REQUEST_SPEC.rollup_type.get_collection_name()
+    state = StatsRollupBackfillDocument(id=name, before=_at(12))
+    await state.insert()
+    await _backfill(_REQUEST_SPEC, state)
+    state = await StatsRollupBackfillDocument.get(name)
+    assert state.completed and state.done_until == _at(12)
+    expected = {DAY - timedelta(days=2): 1, DAY - timedelta(days=1): 1, DAY: 2}
+    assert _counts(await query_request_stats(86400, group_by_route=False)) == expected
+
+    # 中断后从记录的进度继续，已完成的天不会重复计数
+    state.completed = False
+    state.done_until = DAY - timedelta(days=1)
+    await state.save()
+    await _backfill(_REQUEST_SPEC, state)
+    assert _counts(await query_request_stats(86400, group_by_route=False)) == expected
+
+
+async def test_backfill_keeps_live_rollups(log_collections):
+    await _insert_request_logs(log_collections[RequestLogDocument], _at(10), _at(11, 30))
+    state = StatsRollupBackfillDocument(id=_REQUEST_SPEC.rollup_type.get_collection_name(), before=_at(11, 45))
+    await state.insert()
+    # 回填开始后实时写入的日志
+    await _write_requests(_at(11, 50))
+
+    await _backfill(_REQUEST_SPEC, state)
+    assert _counts(await query_request_stats(3600, group_by_route=False)) == {_at(10): 1, _at(11): 2}
+
+
+async def test_start_rollup_backfill_records_state(log_collections):
+    await _insert_request_logs(log_collections[RequestLogDocument], _at(10))
+
+    await start_rollup_backfill()
+    assert len(_backfill_tasks) == 1
+    await asyncio.gather(*_backfill_tasks)
+    assert (await StatsRollupBackfillDocument.get(_REQUEST_SPEC.rollup_type.get_collection_name())).completed
+    # 没有日志时直接记为完成
+    assert (await StatsRollupBackfillDocument.get("ask_stats_rollup")).completed
+    assert _counts(await query_request_stats(3600)) == {_at(10): 1}
+
+    await start_rollup_backfill()
+    assert not _backfill_tasks
+    await stop_rollup_backfill()
@@ -1,13 +1,18 @@
+import uuid
+from contextlib import aclosing
+from datetime import datetime, timezone
+
 import dateutil.parser
 from dateutil.tz import tzutc
-from httpx import HTTPError
-from sqlalchemy import select
+from sqlalchemy import select, update, case, or_, and_
 
 from api.conf import Config
 from api.database.sqlalchemy import get_async_session_context
+from api.enums import ChatSourceTypes
 from api.exceptions import OpenaiWebException
-from api.models.db import OpenaiWebConversation
-from api.sources import OpenaiWebChatManager
+from api.models.db import BaseConversation
+from api.models.doc import OpenaiWebSyncStateDocument
+from api.sources import OpenaiWebChatManager, OpenaiWebAccount
 from utils.logger import get_logger
 
 logger = get_logger(__name__)
@@ -15,87 +20,153 @@ logger = get_logger(__name__)
 manager = OpenaiWebChatManager()
 config = Config()
 
+SYNC_BATCH_SIZE = 500
+
+
+def _parse_time(value) -> datetime | None:
+    if value is None:
+        return None
+    if isinstance(value, (int, float)):
+        return datetime.fromtimestamp(value, tz=timezone.utc)
+    return dateutil.parser.isoparse(value).astimezone(tzutc())
+
+
+def _as_utc(value: datetime | None) -> datetime | None:
+    # mongodb 中读出的时间不带时区
+    if value is not None and value.tzinfo is None:
+        return value.replace(tzinfo=timezone.utc)
+    return value
+
+
+def _get_insert(dialect_name: str):
+    if dialect_name == "postgresql":
+        from sqlalchemy.dialects.postgresql import insert
+    else:
+        from sqlalchemy.dialects.sqlite import insert
+    return insert
+
 
-async def update_conversations(nonteam_conversations: list[dict], team_conversations: list[dict]):
+async def update_conversations(source_id: str | None, conversations: list[dict]):
+    """
+    批量 upsert 同一个 ChatGPT 账号下的对话
+    新对话直接插入；已有对话同步标题、创建时间和所属账号，update_time 只会前进
+    """
+    if not conversations:
+        return
+    table = BaseConversation.__table__
     async with get_async_session_context() as session:
-        r = await session.execute(select(OpenaiWebConversation))
-        existed_conversations: list[OpenaiWebConversation] = r.scalars().all()
-
-        merged_conversations = {conv["id"]: (conv, False) for conv in nonteam_conversations} | \
-                               {conv["id"]: (conv, True) for conv in team_conversations}
-
-        for conv_db in existed_conversations:
-            result = merged_conversations.get(str(conv_db.conversation_id), None)
-            if result:
-                same_one_in_openai_server, is_team = result
-                # 同步标题
-                if same_one_in_openai_server["title"] != conv_db.title:
-                    conv_db.title = same_one_in_openai_server["title"]
-                    logger.info(
-                        'Team ' if is_team else '' + f"Conversation {conv_db.conversation_id} title changed: {conv_db.title}")
-                # 同步时间
-                create_time = dateutil.parser.isoparse(same_one_in_openai_server["create_time"]).astimezone(tzutc())
-                if create_time != conv_db.create_time:
-                    conv_db.create_time = create_time
-                    logger.info(
-                        'Team ' if is_team else '' + f"Conversation {conv_db.conversation_id} create time changed：{conv_db.create_time}")
-                # 更新 source_id
-                if is_team and conv_db.source_id is None:
-                    assert config.openai_web.team_account_id is not None, "team_account_id is None"
-                    conv_db.source_id = config.openai_web.team_account_id
-                    logger.info(f"Team Conversation {conv_db.conversation_id} source_id updated to {conv_db.source_id}")
-                session.add(conv_db)
-                merged_conversations.pop(str(conv_db.conversation_id))
-            else:
-                if conv_db.is_valid:  # 数据库中存在，但 ChatGPT 中（可能）不存在
-                    conv_db.is_valid = False
-                    logger.info(
-                        f"Conversation [{conv_db.title}]({conv_db.conversation_id}) may be deleted, marked as invalid.")
-                    session.add(conv_db)
-
-        # 新增对话
-        for same_one_in_openai_server, is_team in merged_conversations.values():
-            new_conv = OpenaiWebConversation(
-                conversation_id=same_one_in_openai_server["id"],
-                title=same_one_in_openai_server["title"],
-                is_valid=True,
-                create_time=dateutil.parser.isoparse(same_one_in_openai_server["create_time"]),
-                source_id=config.openai_web.team_account_id if is_team else None
+        insert = _get_insert(session.bind.dialect.name)
+        for i in range(0, len(conversations), SYNC_BATCH_SIZE):
+            rows = [{
+                "source": ChatSourceTypes.openai_web,
+                "conversation_id": uuid.UUID(conv["id"]),
+                "title": conv.get("title"),
+                "create_time": _parse_time(conv.get("create_time")),
+                "update_time": _parse_time(conv.get("update_time")),
+                "source_id": source_id,
+                "is_valid": True,
+            } for conv in conversations[i:i + SYNC_BATCH_SIZE]]
+            stmt = insert(table).values(rows)
+            stmt = stmt.on_conflict_do_update(
+                index_elements=[table.c.conversation_id],
+                set_={
+                    "title": stmt.excluded.title,
+                    "create_time": stmt.excluded.create_time,
+                    "source_id": stmt.excluded.source_id,
+                    "update_time": case(
+                        (or_(table.c.update_time.is_(None), stmt.excluded.update_time > table.c.update_time),
+                         stmt.excluded.update_time),
+                        else_=table.c.update_time
+                    ),
+                }
             )
-            session.add(new_conv)
-            logger.info('Team: ' if is_team else '' +
-                                                 f"Add new conversation [{new_conv.title}]({new_conv.conversation_id})")
+            await session.execute(stmt)
+        await session.commit()
+
 
+async def reconcile_conversations(seen_conversation_ids: set[uuid.UUID]):
+    """
+    全量同步后，将数据库中存在、但所有 ChatGPT 账号中都不存在的对话标记为无效
+    """
+    async with get_async_session_context() as session:
+        r = await session.execute(select(BaseConversation.conversation_id).where(
+            and_(BaseConversation.source == ChatSourceTypes.openai_web, BaseConversation.is_valid == True)
+        ))
+        missing = [conversation_id for conversation_id in r.scalars() if conversation_id not in seen_conversation_ids]
+        for i in range(0, len(missing), SYNC_BATCH_SIZE):
+            await session.execute(
+                update(BaseConversation)
+                .where(BaseConversation.conversation_id.in_(missing[i:i + SYNC_BATCH_SIZE]))
+                .values(is_valid=False)
+            )
         await session.commit()
+    if missing:
+        logger.info(f"{len(missing)} conversations may be deleted from ChatGPT, marked as invalid.")
+
+
+async def _sync_account(account: OpenaiWebAccount, full: bool) -> set[uuid.UUID]:
+    """
+    增量同步时按 update_time 从新到旧分页获取，遇到早于水位线的对话即停止
+    """
+    state_id = account.source_id or "default"
+    state = await OpenaiWebSyncStateDocument.get(state_id) or OpenaiWebSyncStateDocument(id=state_id)
+    watermark = None if full else _as_utc(state.watermark)
+    new_watermark = _as_utc(state.watermark)
+
+    seen_conversation_ids = set()
+    # 各页到达后立即写入数据库；提前停止时需要关闭生成器以取消预取中的请求
+    async with aclosing(manager.iter_conversation_pages(account)) as pages:
+        async for page in pages:
+            conversations = []
+            reached_watermark = False
+            for conv in page:
+                update_time = _parse_time(conv.get("update_time"))
+                if watermark is not None and update_time is not None and update_time < watermark:
+                    reached_watermark = True
+                    continue
+                conversations.append(conv)
+                if update_time is not None and (new_watermark is None or update_time > new_watermark):
+                    new_watermark = update_time
+            await update_conversations(account.source_id, conversations)
+            seen_conversation_ids.update(uuid.UUID(conv["id"]) for conv in conversations)
+            if reached_watermark:
+                break
+
+    now = datetime.now(tz=timezone.utc)
+    state.watermark = new_watermark
+    state.last_sync_time = now
+    if full:
+        state.last_full_sync_time = now
+    await state.save()
+
+    logger.info(f"Synced {len(seen_conversation_ids)} {'' if full else 'updated '}conversations "
+                f"from ChatGPT account {account.source_id or 'default'}.")
+    return seen_conversation_ids
 
 
-async def sync_conversations() -> Exception | None:
+async def sync_conversations(full: bool = False) -> Exception | None:
+    """
+    :param full: 全量同步：忽略水位线获取全部对话，并将 ChatGPT 中已不存在的对话标记为无效
+    """
     try:
-        logger.info("Start syncing conversations...")
-        non_team_result = await manager.get_conversations(use_team=False)
-        logger.info(f"Fetched {len(non_team_result)} conversations from ChatGPT Personal account.")
+        logger.info(f"Start {'full' if full else 'incremental'} syncing conversations...")
+        if config.openai_web.enable_team_subscription and config.openai_web.team_account_id is None:
+            return ValueError("Team account id is None. Please set team_account_id in config.")
 
-        if config.openai_web.enable_team_subscription:
-            if config.openai_web.team_account_id is None:
-                return ValueError("Team account id is None. Please set team_account_id in config.")
-            team_result = await manager.get_conversations(use_team=True)
-            logger.info(f"Fetched {len(team_result)} conversations from ChatGPT Team account.")
-        else:
-            team_result = []
+        seen_conversation_ids = set()
+        for account in list(manager.accounts.values()):
+            seen_conversation_ids |= await _sync_account(account, full)
 
-        await update_conversations(non_team_result, team_result)
+        if full:
+            await reconcile_conversations(seen_conversation_ids)
 
         logger.info("Sync conversations finished.")
         return None
     except OpenaiWebException as e:
         logger.error(f"Fetch conversation error ({e.__class__.__name__}) {e.code}: {e.message}")
-        logger.warning("Sync conversations on startup failed!")
+        logger.warning("Sync conversations failed!")
         return e
-    # except HTTPError as e:
-    #     logger.error(f"Fetch conversation error ({e.__class__.__name__}) {str(e)}")
-    #     logger.warning("Sync conversations on startup failed!")
-    #     return e
     except Exception as e:
         logger.error(f"Fetch conversation error ({e.__class__.__name__}) {str(e)}")
-        logger.warning("Sync conversations on startup failed!")
+        logger.warning("Sync conversations failed!")
         return e
@@ -0,0 +1,4 @@
+"""
+性能基准脚本，在 backend 目录下以 `python -m utils.benchmark.<name>` 运行
+各脚本的文档字符串中记录了修改前后的实测数据
+"""
@@ -0,0 +1,98 @@
+"""
+CustomJSONResponse 编码较大返回值的开销：旧实现在事件循环中执行 json.dumps(jsonable_encoder(...))，
+新实现用 pydantic-core 编码，估计大小超过 json_response_offload_threshold 时在线程池中逐项编码
+
+同时运行一个每 5 ms 醒来一次的任务（相当于 websocket 对话推送），并发返回 4 个响应，
+记录编码耗时以及该任务两次醒来的间隔，间隔越大说明事件循环被阻塞得越久
+运行：python -m utils.benchmark.json_response [--items 30000]
+
+实测（Python 3.11，单核虚拟机，并发返回 4 个 30000 项的列表）：
+    before  4 x 8.6 MB in  9.98 s    tick gap p50 9984.5 ms, max  9984.5 ms
+    after   4 x 8.0 MB in  0.47 s    tick gap p50   44.1 ms, max   118.8 ms
+旧实现编码期间事件循环完全阻塞；新实现的输出没有多余空格，因此较小
+"""
+import argparse
+import asyncio
+import json
+import time
+
+from fastapi.encoders import jsonable_encoder
+
+from api.response import CustomJSONResponse, ResponseWrapper, get_http_message
+
+TICK_SECONDS = 0.005
+CONCURRENCY = 4
+
+
+def _render_before(content) -> bytes:
+    """
+    修改前的 CustomJSONResponse.render
+    """
+    content = ResponseWrapper(code=200, message=get_http_message(200), result=content)
+    return json.dumps(jsonable_encoder(content), ensure_ascii=False).encode("utf-8")
+
+
+async def _send_before(content) -> bytes:
+    return _render_before(content)
+
+
+async def _send_after(content) -> bytes:
+    body = []
+
+    async def send(message):
+        if message["type"] == "http.response.body":
+            body.append(message.get("body", b""))
+
+    await CustomJSONResponse(content=content)({"type": "http"}, None, send)
+    return b"".join(body)
+
+
+def _make_content(item_count: int) -> list[dict]:
+    return [{
+        "id": i, "username": f"user{i}", "nickname": "昵称" * 3, "email": f"user{i}@example.com", "is_active": True,
+        "setting": {"openai_web": {"allow_to_use": True, "available_models": ["gpt_4", "gpt_4o"],
+                                   "per_model_ask_count": {"gpt_4": 10}}},
+        "last_active_time": "2024-01-01T00:00:00Z",
+    } for i in range(item_count)]
+
+
+async def _measure(send, content):
+    gaps = []
+    stopped = False
+
+    async def tick():
+        last = time.perf_counter()
+        while not stopped:
+            await asyncio.sleep(TICK_SECONDS)
+            now = time.perf_counter()
+            gaps.append(now - last)
+            last = now
+
+    ticker = asyncio.create_task(tick())
+    await asyncio.sleep(0.05)
+    gaps.clear()
+    start = time.perf_counter()
+    bodies = await asyncio.gather(*(send(content) for _ in range(CONCURRENCY)))
+    elapsed = time.perf_counter() - start
+    stopped = True
+    await ticker
+    gaps.sort()
+    return bodies[0], elapsed, gaps[len(gaps) // 2], gaps[-1]
+
+
+async def main(item_count: int):
+    content = _make_content(item_count)
+    results = {}
+    for name, send in (("before", _send_before), ("after", _send_after)):
+        body, elapsed, gap_p50, gap_max = await _measure(send, content)
+        results[name] = json.loads(body)
+        print(f"{name:<7} {CONCURRENCY} x {len(body) / 2 ** 20:.1f} MB in {elapsed:5.2f} s    "
+              f"tick gap p50 {gap_p50 * 1000:6.1f} ms, max {gap_max * 1000:7.1f} ms")
+    assert results["before"] == results["after"]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--items", type=int, default=30000)
+    args = parser.parse_args()
+    asyncio.run(main(args.items))
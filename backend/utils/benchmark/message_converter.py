@@ -0,0 +1,141 @@
+"""
+流式回复中每个 chunk 的转换开销：旧实现每个 chunk 完整校验消息并构造两次 metadata，
+新实现 OpenaiWebMessageConverter 直接构造消息并复用未变化的 metadata
+
+回放按 ChatGPT 回复格式生成的流（逐字增长的 text，以及末尾带 finish_details 的 chunk），
+并检查两种实现的输出一致
+运行：python -m utils.benchmark.message_converter [--chunks 500] [--repeat 10]
+
+实测（Python 3.11，单核虚拟机，500 个 chunk，取 10 次最好成绩；多次运行间波动约 ±20%）：
+    text             before:  42.0 us/chunk    after:  16.9 us/chunk
+    multimodal_text  before:  33.0 us/chunk    after:  15.9 us/chunk
+"""
+import argparse
+import time
+import uuid
+
+# api.models.doc 与 api.schemas 相互导入，与应用启动时一样先导入 api.schemas
+import api.schemas  # noqa: F401
+from api.enums import OpenaiWebChatModels
+from api.models.doc import OpenaiWebChatMessage, OpenaiWebChatMessageMetadata
+from api.sources.openai_web import OPENAI_WEB_CONTENT_TYPES, OpenaiWebMessageConverter
+
+
+def convert_before(item: dict) -> OpenaiWebChatMessage | None:
+    """
+    修改前的 convert_openai_web_message（省略日志）
+    """
+    if not item.get("message"):
+        return None
+    content = None
+    fallback_content = None
+    if item["message"].get("content"):
+        content_type = item["message"]["content"].get("content_type")
+        if content_type not in OPENAI_WEB_CONTENT_TYPES:
+            fallback_content = item["message"]["content"]
+        else:
+            content = OPENAI_WEB_CONTENT_TYPES[content_type](**item["message"]["content"])
+
+    result = OpenaiWebChatMessage(
+        source="openai_web",
+        id=item["message"]["id"],
+        role=item["message"]["author"]["role"],
+        author_name=item["message"]["author"].get("name"),
+        model=None,
+        create_time=item["message"].get("create_time"),
+        parent=item.get("parent"),
+        children=item.get("children", []),
+        content=content
+    )
+    metadata_dict = OpenaiWebChatMessageMetadata(
+        source="openai_web",
+        weight=item["message"].get("weight"),
+        end_turn=item["message"].get("end_turn"),
+        recipient=item["message"].get("recipient"),
+        message_status=item["message"].get("status"),
+        fallback_content=fallback_content,
+    ).model_dump(exclude_unset=True, exclude_none=True)
+    if "metadata" in item["message"] and item["message"]["metadata"] != {}:
+        metadata_dict.update(item["message"]["metadata"])
+        result.metadata = OpenaiWebChatMessageMetadata.model_validate(metadata_dict)
+        model_code = item["message"]["metadata"].get("model_slug")
+        result.model = OpenaiWebChatModels.from_code(model_code) or model_code
+    else:
+        result.metadata = OpenaiWebChatMessageMetadata.model_validate(metadata_dict)
+    return result
+
+
+def _make_stream(chunk_count: int, multimodal: bool) -> list[dict]:
+    message_id = str(uuid.uuid4())
+    conversation_id = str(uuid.uuid4())
+    parent = str(uuid.uuid4())
+    model_slug = OpenaiWebChatModels.gpt_4.code()
+    text = ""
+    stream = []
+    for i in range(chunk_count):
+        text += "这是第 %d 段回复。" % i
+        is_last = i == chunk_count - 1
+        metadata = {"message_type": "next", "model_slug": model_slug, "parent_id": parent}
+        if is_last:
+            metadata["finish_details"] = {"type": "stop", "stop_tokens": [100260]}
+            metadata["is_complete"] = True
+        if multimodal:
+            content = {"content_type": "multimodal_text", "parts": [{
+                "content_type": "image_asset_pointer", "asset_pointer": "file-service://file-abc",
+                "size_bytes": 1024, "width": 512, "height": 512,
+            }, text]}
+        else:
+            content = {"content_type": "text", "parts": [text]}
+        stream.append({
+            "message": {
+                "id": message_id,
+                "author": {"role": "assistant", "name": None, "metadata": {}},
+                "create_time": 1700000000.123,
+                "content": content,
+                "status": "finished_successfully" if is_last else "in_progress",
+                "end_turn": True if is_last else None,
+                "weight": 1.0,
+                "metadata": metadata,
+                "recipient": "all",
+            },
+            "conversation_id": conversation_id,
+            "error": None,
+        })
+    return stream
+
+
+def _bench(convert, stream: list[dict], repeat: int) -> float:
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        convert(stream)
+        elapsed = (time.perf_counter() - start) / len(stream)
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main(chunk_count: int, repeat: int):
+    for name, multimodal in (("text", False), ("multimodal_text", True)):
+        stream = _make_stream(chunk_count, multimodal)
+
+        def run_before(items):
+            return [convert_before(item) for item in items]
+
+        def run_after(items):
+            converter = OpenaiWebMessageConverter()
+            return [converter.convert(item) for item in items]
+
+        for before, after in zip(run_before(stream), run_after(stream)):
+            assert before.model_dump() == after.model_dump()
+
+        before = _bench(run_before, stream, repeat)
+        after = _bench(run_after, stream, repeat)
+        print(f"{name:<16} before: {before * 1e6:6.1f} us/chunk    after: {after * 1e6:6.1f} us/chunk")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--chunks", type=int, default=500)
+    parser.add_argument("--repeat", type=int, default=10)
+    args = parser.parse_args()
+    main(args.chunks, args.repeat)
@@ -0,0 +1,174 @@
+"""
+SQLite 引擎配置：旧配置为 aiosqlite 默认的 NullPool，每个 session 各自打开连接，并发写入时争抢数据库锁；
+新配置为 WAL 模式、单个写连接在进程内排队，只读查询使用单独的 query_only 连接池
+
+mixed：并发执行读取（用户及设置、对话列表）、单行 UPDATE 和两条 UPDATE 的事务，统计延迟和错误数
+hold：新配置下，写事务在持有写连接时等待 20 ms（例如等待频率限制）与先等待再打开写 session 的对比
+运行：python -m utils.benchmark.sqlite_engine [--tasks 64] [--ops 40]
+
+实测（Python 3.11，单核虚拟机，64 个并发任务，每个 40 次操作）：
+    mixed before     15.38 s, 36 个 "database is locked"    读 p50  59.4 / p99  591.8 ms    写 p50   95.1 / p99 4512.0 ms
+    mixed after       9.57 s, 无错误                        读 p50  20.1 / p99  603.6 ms    写 p50  515.2 / p99 1116.5 ms
+    hold writer      31.15 s, 无错误                        读 p50   7.2 / p99  402.4 ms    写 p50 1898.2 / p99 2034.6 ms
+    wait then write  12.55 s, 无错误                        读 p50  28.6 / p99  414.0 ms    写 p50  671.7 / p99 1383.7 ms
+单个写连接下，持有写 session 时等待其它服务会使所有写入一起排队，因此写 session 中只执行 SQL
+"""
+import argparse
+import asyncio
+import os
+import random
+import tempfile
+import time
+import uuid
+from datetime import datetime, timezone
+
+from sqlalchemy import event, insert, select, update
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy.orm import joinedload, sessionmaker
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+
+from api.models.db import Base, User, UserSetting, BaseConversation
+from api.schemas import UserSettingSchema
+
+USER_COUNT = 200
+CONVERSATIONS_PER_USER = 20
+HOLD_SECONDS = 0.02
+
+
+def _set_sqlite_pragmas(dbapi_connection, query_only: bool):
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute("PRAGMA busy_timeout=5000")
+    if query_only:
+        cursor.execute("PRAGMA query_only=ON")
+    cursor.close()
+
+
+def _create_before(url: str):
+    engine = create_async_engine(url)
+    session_maker = sessionmaker(engine, class_=AsyncSession, expire_on_commit=False)
+    return [engine], session_maker, session_maker
+
+
+def _create_after(url: str):
+    engine = create_async_engine(url, poolclass=AsyncAdaptedQueuePool, pool_size=1, max_overflow=0)
+    read_engine = create_async_engine(url, poolclass=AsyncAdaptedQueuePool, pool_size=10, max_overflow=20)
+    event.listen(engine.sync_engine, "connect", lambda conn, record: _set_sqlite_pragmas(conn, query_only=False))
+    event.listen(read_engine.sync_engine, "connect", lambda conn, record: _set_sqlite_pragmas(conn, query_only=True))
+    return ([engine, read_engine], sessionmaker(engine, class_=AsyncSession, expire_on_commit=False),
+            sessionmaker(read_engine, class_=AsyncSession, expire_on_commit=False))
+
+
+async def _populate(url: str):
+    engine = create_async_engine(url)
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+    async with AsyncSession(engine) as session:
+        now = datetime.now(timezone.utc)
+        setting = UserSettingSchema.default()
+        await session.execute(insert(User), [{
+            "id": i, "username": f"user{i}", "nickname": f"user{i}", "email": f"user{i}@example.com",
+            "create_time": now, "is_superuser": False, "is_active": True, "is_verified": True, "hashed_password": "x",
+        } for i in range(1, USER_COUNT + 1)])
+        await session.execute(insert(UserSetting), [{
+            "user_id": i, "credits": 0, "_openai_web": setting.openai_web, "_openai_api": setting.openai_api,
+        } for i in range(1, USER_COUNT + 1)])
+        await session.execute(insert(BaseConversation), [{
+            "source": "openai_web", "conversation_id": uuid.uuid4(), "title": "title", "user_id": i,
+            "is_valid": True, "create_time": now, "update_time": now,
+        } for i in range(1, USER_COUNT + 1) for _ in range(CONVERSATIONS_PER_USER)])
+        await session.commit()
+    await engine.dispose()
+
+
+async def _read(write_maker, read_maker, user_id: int):
+    async with read_maker() as session:
+        await session.execute(select(User).where(User.id == user_id).options(joinedload(User.setting)))
+        (await session.execute(select(BaseConversation).where(BaseConversation.user_id == user_id))).scalars().all()
+
+
+async def _update(write_maker, read_maker, user_id: int):
+    async with write_maker() as session:
+        await session.execute(update(User).where(User.id == user_id).values(remark=str(time.time())))
+        await session.commit()
+
+
+async def _transaction(write_maker, read_maker, user_id: int):
+    async with write_maker() as session:
+        await session.execute(update(UserSetting).where(UserSetting.user_id == user_id)
+                              .values(credits=UserSetting.credits + 1))
+        await session.execute(update(User).where(User.id == user_id).values(remark=str(time.time())))
+        await session.commit()
+
+
+async def _hold_writer(write_maker, read_maker, user_id: int):
+    # 写 session 中先读取，再等待其它服务，期间一直占用写连接
+    async with write_maker() as session:
+        await session.get(User, user_id)
+        await asyncio.sleep(HOLD_SECONDS)
+        await session.execute(update(User).where(User.id == user_id).values(remark=str(time.time())))
+        await session.commit()
+
+
+async def _wait_then_write(write_maker, read_maker, user_id: int):
+    async with read_maker() as session:
+        await session.get(User, user_id)
+    await asyncio.sleep(HOLD_SECONDS)
+    await _update(write_maker, read_maker, user_id)
+
+
+async def _run(write_maker, read_maker, operations, task_count: int, op_count: int):
+    latencies: dict[str, list[float]] = {}
+    errors: dict[str, int] = {}
+
+    async def worker():
+        for _ in range(op_count):
+            kind, op = random.choices(operations, weights=[w for w, _, _ in operations])[0][1:]
+            start = time.perf_counter()
+            try:
+                await op(write_maker, read_maker, random.randint(1, USER_COUNT))
+            except Exception as e:
+                errors[e.__class__.__name__] = errors.get(e.__class__.__name__, 0) + 1
+                continue
+            latencies.setdefault(kind, []).append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(task_count)))
+    return latencies, errors, time.perf_counter() - start
+
+
+def _report(name: str, latencies: dict[str, list[float]], errors: dict[str, int], total: float):
+    parts = []
+    for kind in sorted(latencies):
+        values = sorted(latencies[kind])
+        parts.append(f"{kind} p50 {values[len(values) // 2] * 1000:6.1f} ms / p99 "
+                     f"{values[int(len(values) * 0.99)] * 1000:7.1f} ms")
+    print(f"{name:<16} total {total:5.2f} s, errors {sum(errors.values()):3d}    " + "    ".join(parts))
+
+
+async def main(task_count: int, op_count: int):
+    mixed = [(0.6, "read", _read), (0.2, "write", _update), (0.2, "write", _transaction)]
+    scenarios = [
+        ("mixed before", _create_before, mixed),
+        ("mixed after", _create_after, mixed),
+        ("hold writer", _create_after, [(0.6, "read", _read), (0.4, "write", _hold_writer)]),
+        ("wait then write", _create_after, [(0.6, "read", _read), (0.4, "write", _wait_then_write)]),
+    ]
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for name, create, operations in scenarios:
+            url = f"sqlite+aiosqlite:///{os.path.join(tmp_dir, name.replace(' ', '_') + '.db')}"
+            await _populate(url)
+            engines, write_maker, read_maker = create(url)
+            random.seed(0)
+            _report(name, *await _run(write_maker, read_maker, operations, task_count, op_count))
+            for engine in engines:
+                await engine.dispose()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--tasks", type=int, default=64)
+    parser.add_argument("--ops", type=int, default=40)
+    args = parser.parse_args()
+    asyncio.run(main(args.tasks, args.ops))
@@ -0,0 +1,115 @@
+"""
+StatisticsMiddleware 每个请求的额外开销：旧实现解码并 json 解析响应体以获取 code，新实现从 scope 读取
+
+通过 httpx.ASGITransport 请求一个返回 CustomJSONResponse 的 FastAPI 应用，比较三种配置下每个请求的耗时：
+none 不加中间件；after 使用 StatisticsMiddleware；before 在 StatisticsMiddleware 外再包一层旧实现中解析响应体的 send
+基准路由位于 filter_keywords 中，不构造 RequestLogDocument（需要初始化 MongoDB），这部分开销修改前后相同
+运行：python -m utils.benchmark.stats_middleware [--rounds 15]
+
+实测（Python 3.11，单核虚拟机，--rounds 31，每个请求耗时的中位数，括号中为相对 none 的额外开销）：
+          body         none                  before                   after
+          1 KB     424.1 us     469.0 us (+   44.9)     449.8 us (+   25.7)
+         96 KB    2554.2 us    3407.1 us (+  852.9)    2600.7 us (+   46.5)
+       1980 KB   29855.7 us   50997.3 us (+21141.6)   29755.9 us (+  -99.8)
+after 的额外开销与响应大小无关，处于机器波动范围（约 ±100 us）内
+"""
+import argparse
+import asyncio
+import gc
+import json
+import statistics
+import time
+
+import httpx
+from fastapi import FastAPI
+from fastapi.middleware import Middleware
+
+import api.schemas  # noqa: F401
+from api.middlewares import StatisticsMiddleware
+from api.response import CustomJSONResponse
+
+BENCH_PATH = "/bench"
+
+
+class _InspectBodyMiddleware:
+    """
+    修改前 StatisticsMiddleware 中的 send_with_inspecting_body：解码并解析响应体以获取 code
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        body_code = None
+
+        async def send_with_inspecting_body(message):
+            nonlocal body_code
+            if message["type"] == "http.response.body":
+                body = message.get("body", None)
+                if body is not None:
+                    body = body.decode("utf-8")
+                    try:
+                        body = json.loads(body)
+                        body_code = body.get("code", None)
+                    except json.JSONDecodeError:
+                        pass
+            await send(message)
+
+        await self.app(scope, receive, send_with_inspecting_body)
+
+
+def _make_content(size: int) -> list[dict]:
+    item = {"conversation_id": "6b0c5b36-7d8c-4bfa-9b7e-3f7a7f3e1c2a", "title": "标题" * 8,
+            "create_time": "2024-01-01T00:00:00+00:00", "is_valid": True}
+    return [item] * (size // len(json.dumps(item, ensure_ascii=False).encode()) + 1)
+
+
+def _make_app(middleware: list[Middleware], content: list[dict]) -> FastAPI:
+    app = FastAPI(default_response_class=CustomJSONResponse, middleware=middleware)
+
+    @app.get(BENCH_PATH)
+    async def bench():
+        return CustomJSONResponse(content)
+
+    return app
+
+
+async def _bench(client: httpx.AsyncClient, number: int) -> float:
+    gc.collect()
+    start = time.perf_counter()
+    for _ in range(number):
+        response = await client.get(BENCH_PATH)
+        assert response.status_code == 200
+    return (time.perf_counter() - start) / number
+
+
+async def main(rounds: int):
+    stats = Middleware(StatisticsMiddleware, filter_keywords=[BENCH_PATH])
+    print(f"{'body':>10} {'none':>12} {'before':>23} {'after':>23}")
+    for size in (1 << 10, 100 << 10, 2 << 20):
+        content = _make_content(size)
+        number = max(5, 2_000_000 // size)
+        clients = {name: httpx.AsyncClient(transport=httpx.ASGITransport(app=_make_app(middleware, content)),
+                                           base_url="http://bench")
+                   for name, middleware in (("none", []), ("before", [Middleware(_InspectBodyMiddleware), stats]),
+                                            ("after", [stats]))}
+        body_size = len((await clients["none"].get(BENCH_PATH)).content)
+        # 轮流运行三种配置，取各轮的中位数，减少机器负载波动的影响
+        results = {name: [] for name in clients}
+        names = list(clients)
+        for i in range(rounds):
+            for name in names[i % 3:] + names[:i % 3]:
+                results[name].append(await _bench(clients[name], number))
+        none, before, after = (statistics.median(results[name]) for name in ("none", "before", "after"))
+        for client in clients.values():
+            await client.aclose()
+        print(f"{body_size >> 10:>7} KB {none * 1e6:>9.1f} us "
+              f"{before * 1e6:>9.1f} us (+{(before - none) * 1e6:>7.1f}) "
+              f"{after * 1e6:>9.1f} us (+{(after - none) * 1e6:>7.1f})")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rounds", type=int, default=15)
+    args = parser.parse_args()
+    asyncio.run(main(args.rounds))
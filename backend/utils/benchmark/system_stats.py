@@ -0,0 +1,137 @@
+"""
+/status/common 与 /system/info 的计数：旧实现加载全部 User / OpenaiWebConversation 后在 Python 中计数，
+新实现在数据库中聚合，内存占用与数据量无关
+
+在临时 SQLite 数据库中生成数据后分别运行两种实现，记录耗时和 Python 内存分配峰值（tracemalloc）
+运行：python -m utils.benchmark.system_stats [--users 50000] [--conversations 1000000]
+
+实测（Python 3.11，单核虚拟机，50k 用户 / 1M 对话）：
+    users          before:  35.66 s, peak   481.4 MB    after:   0.10 s, peak   0.1 MB
+    conversations  before: 126.35 s, peak  1581.5 MB    after:   0.56 s, peak   0.1 MB
+"""
+import argparse
+import asyncio
+import os
+import random
+import tempfile
+import time
+import tracemalloc
+import uuid
+from datetime import datetime, timedelta, timezone
+
+from sqlalchemy import select, func, case, and_, insert
+from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
+from sqlalchemy.orm import sessionmaker
+
+from api.enums import ChatSourceTypes
+from api.models.db import Base, User, UserSetting, BaseConversation, OpenaiWebConversation
+from api.schemas import UserSettingSchema
+
+BATCH_SIZE = 10000
+
+
+async def _populate(session_maker, user_count: int, conversation_count: int):
+    now = datetime.now(timezone.utc)
+    setting = UserSettingSchema.default()
+    async with session_maker() as session:
+        for start in range(0, user_count, BATCH_SIZE):
+            ids = range(start + 1, min(start + BATCH_SIZE, user_count) + 1)
+            await session.execute(insert(User), [{
+                "id": i, "username": f"user{i}", "nickname": f"user{i}", "email": f"user{i}@example.com",
+                "last_active_time": now - timedelta(seconds=random.randint(0, 3 * 24 * 3600)),
+                "create_time": now, "is_superuser": False, "is_active": True, "is_verified": True,
+                "hashed_password": "x",
+            } for i in ids])
+            await session.execute(insert(UserSetting), [{
+                "user_id": i, "credits": 0, "_openai_web": setting.openai_web, "_openai_api": setting.openai_api,
+            } for i in ids])
+        for start in range(0, conversation_count, BATCH_SIZE):
+            await session.execute(insert(BaseConversation), [{
+                "source": ChatSourceTypes.openai_web, "conversation_id": uuid.uuid4(), "title": "title",
+                "user_id": random.randint(1, user_count), "is_valid": random.random() < 0.9,
+                "create_time": now, "update_time": now,
+            } for _ in range(start, min(start + BATCH_SIZE, conversation_count))])
+        await session.commit()
+
+
+async def count_users_before(session_maker, current_time: datetime):
+    async with session_maker() as session:
+        users = (await session.execute(select(User))).scalars().all()
+    active_user_in_5m = active_user_in_1h = active_user_in_1d = 0
+    for user in users:
+        if not user.last_active_time or user.is_superuser:
+            continue
+        if user.last_active_time > current_time - timedelta(minutes=5):
+            active_user_in_5m += 1
+        if user.last_active_time > current_time - timedelta(hours=1):
+            active_user_in_1h += 1
+        if user.last_active_time > current_time - timedelta(days=1):
+            active_user_in_1d += 1
+    return active_user_in_5m, active_user_in_1h, active_user_in_1d, len(users)
+
+
+async def count_users_after(session_maker, current_time: datetime):
+    def _count_active_since(delta: timedelta):
+        return func.count(case((and_(User.is_superuser == False, User.last_active_time > current_time - delta), 1)))
+
+    async with session_maker() as session:
+        r = await session.execute(select(
+            _count_active_since(timedelta(minutes=5)),
+            _count_active_since(timedelta(hours=1)),
+            _count_active_since(timedelta(days=1)),
+            func.count(User.id),
+        ))
+        return tuple(r.one())
+
+
+async def count_conversations_before(session_maker, current_time: datetime):
+    async with session_maker() as session:
+        conversations = (await session.execute(select(OpenaiWebConversation))).scalars().all()
+    return len(conversations), len([c for c in conversations if c.is_valid])
+
+
+async def count_conversations_after(session_maker, current_time: datetime):
+    async with session_maker() as session:
+        r = await session.execute(
+            select(func.count(), func.count(case((BaseConversation.is_valid == True, 1))))
+            .where(BaseConversation.source == ChatSourceTypes.openai_web)
+        )
+        return tuple(r.one())
+
+
+async def _measure(func, session_maker, current_time: datetime):
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = await func(session_maker, current_time)
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, elapsed, peak
+
+
+async def main(user_count: int, conversation_count: int):
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        engine = create_async_engine(f"sqlite+aiosqlite:///{os.path.join(tmp_dir, 'benchmark.db')}")
+        session_maker = sessionmaker(engine, class_=AsyncSession, expire_on_commit=False)
+        async with engine.begin() as conn:
+            await conn.run_sync(Base.metadata.create_all)
+        await _populate(session_maker, user_count, conversation_count)
+        # 两种实现使用同一时间点，保证结果可以比较
+        current_time = datetime.now(timezone.utc)
+
+        for name, before, after in (("users", count_users_before, count_users_after),
+                                    ("conversations", count_conversations_before, count_conversations_after)):
+            result_before, elapsed_before, peak_before = await _measure(before, session_maker, current_time)
+            result_after, elapsed_after, peak_after = await _measure(after, session_maker, current_time)
+            assert result_before == result_after, (result_before, result_after)
+            print(f"{name:<14} before: {elapsed_before:6.2f} s, peak {peak_before / 2 ** 20:7.1f} MB    "
+                  f"after: {elapsed_after:6.2f} s, peak {peak_after / 2 ** 20:5.1f} MB")
+        await engine.dispose()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--users", type=int, default=50000)
+    parser.add_argument("--conversations", type=int, default=1000000)
+    args = parser.parse_args()
+    asyncio.run(main(args.users, args.conversations))
@@ -0,0 +1,46 @@
+import hashlib
+import math
+
+# HyperLogLog 基数估计，寄存器以稀疏的 dict[str, int] 保存，便于直接存入 mongodb 并用 $max 合并
+# 精度 p=10，共 1024 个寄存器，标准误差约 3.2%
+
+HLL_PRECISION = 10
+HLL_REGISTER_COUNT = 1 << HLL_PRECISION
+_HASH_BITS = 64
+
+
+def hll_register(value) -> tuple[str, int]:
+    """
+    返回 value 对应的寄存器下标及其 rank
+    """
+    h = int.from_bytes(hashlib.blake2b(str(value).encode(), digest_size=_HASH_BITS // 8).digest(), "big")
+    index = h >> (_HASH_BITS - HLL_PRECISION)
+    remaining_bits = _HASH_BITS - HLL_PRECISION
+    w = h & ((1 << remaining_bits) - 1)
+    rank = remaining_bits - w.bit_length() + 1
+    return str(index), rank
+
+
+def hll_add(registers: dict[str, int], value):
+    index, rank = hll_register(value)
+    if rank > registers.get(index, 0):
+        registers[index] = rank
+
+
+def hll_merge(registers: dict[str, int], other: dict[str, int]):
+    for index, rank in other.items():
+        if rank > registers.get(index, 0):
+            registers[index] = rank
+
+
+def hll_count(registers: dict[str, int]) -> int:
+    if not registers:
+        return 0
+    m = HLL_REGISTER_COUNT
+    alpha = 0.7213 / (1 + 1.079 / m)
+    zeros = m - len(registers)
+    estimate = alpha * m * m / (zeros + sum(2.0 ** -rank for rank in registers.values()))
+    if estimate <= 2.5 * m and zeros > 0:
+        # 小基数时使用线性计数
+        estimate = m * math.log(m / zeros)
+    return round(estimate)
@@ -1,25 +1,60 @@
-import axios from 'axios';
+import axios, { AxiosResponse } from 'axios';
 
-import { BaseConversationHistory, BaseConversationSchema, OpenaiChatInterpreterInfo } from '@/types/schema';
+import { operations } from '@/types/openapi';
+import {
+  BaseConversationHistory,
+  BaseConversationSchema,
+  ConversationListPage,
+  OpenaiChatInterpreterInfo,
+} from '@/types/schema';
 
 import ApiUrl from './url';
 
-export function getAllConversationsApi() {
-  return axios.get<Array<BaseConversationSchema>>(ApiUrl.Conversation);
+export type ConversationListParams = NonNullable<operations['get_my_conversations_conv_get']['parameters']['query']>;
+export type AdminConversationListParams = NonNullable<
+  operations['get_all_conversations_conv_all_get']['parameters']['query']
+>;
+
+export type ConversationHistoryParams = NonNullable<
+  operations['get_conversation_history_conv__conversation_id__get']['parameters']['query']
+>;
+
+const CONVERSATION_PAGE_SIZE = 1000;
+
+export function getConversationsApi(params?: ConversationListParams) {
+  return axios.get<ConversationListPage>(ApiUrl.Conversation, { params });
 }
 
-export function getAdminAllConversationsApi(valid_only = false) {
-  return axios.get<Array<BaseConversationSchema>>(ApiUrl.AllConversation, {
-    params: { valid_only },
-  });
+export function getAdminConversationsApi(params?: AdminConversationListParams) {
+  return axios.get<ConversationListPage>(ApiUrl.AllConversation, { params });
+}
+
+async function fetchAllPages(fetchPage: (cursor: string | null) => Promise<AxiosResponse<ConversationListPage>>) {
+  const result: BaseConversationSchema[] = [];
+  let cursor: string | null = null;
+  do {
+    const page: ConversationListPage = (await fetchPage(cursor)).data;
+    // 未指定 fields 时 items 包含全部字段；指定 fields 的调用方只使用所请求的字段
+    result.push(...(page.items as BaseConversationSchema[]));
+    cursor = page.next_cursor ?? null;
+  } while (cursor);
+  return result;
+}
+
+export function getAllConversationsApi(params?: ConversationListParams) {
+  return fetchAllPages((cursor) => getConversationsApi({ ...params, limit: CONVERSATION_PAGE_SIZE, cursor }));
+}
+
+export function getAdminAllConversationsApi(params?: AdminConversationListParams) {
+  return fetchAllPages((cursor) => getAdminConversationsApi({ ...params, limit: CONVERSATION_PAGE_SIZE, cursor }));
 }
 
-export function getConversationHistoryApi(conversation_id: string) {
-  return axios.get<BaseConversationHistory>(ApiUrl.Conversation + '/' + conversation_id);
+export function getConversationHistoryApi(conversation_id: string, params?: ConversationHistoryParams) {
+  return axios.get<BaseConversationHistory>(ApiUrl.Conversation + '/' + conversation_id, { params });
 }
 
-export function getConversationHistoryFromCacheApi(conversation_id: string) {
-  return axios.get<BaseConversationHistory>(`${ApiUrl.Conversation}/${conversation_id}/cache`);
+export function getConversationHistoryFromCacheApi(conversation_id: string, params?: ConversationHistoryParams) {
+  return axios.get<BaseConversationHistory>(`${ApiUrl.Conversation}/${conversation_id}/cache`, { params });
 }
 
 export function deleteConversationApi(conversation_id: string) {
@@ -16,15 +16,20 @@ export function getSystemInfoApi() {
   return axios.get<SystemInfo>(ApiUrl.SystemInfo);
 }
 
-export function getRequestStatisticsApi(granularity: number) {
+export function getRequestStatisticsApi(
+  granularity: number,
+  groupByRoute = true,
+  startTime: string | null = null,
+  endTime: string | null = null
+) {
   return axios.get<RequestLogAggregation[]>(ApiUrl.SystemRequestStatistics, {
-    params: { granularity },
+    params: { granularity, group_by_route: groupByRoute, start_time: startTime, end_time: endTime },
   });
 }
 
-export function getAskStatisticsApi(granularity: number) {
+export function getAskStatisticsApi(granularity: number, startTime: string | null = null, endTime: string | null = null) {
   return axios.get<AskLogAggregation[]>(ApiUrl.SystemAskStatistics, {
-    params: { granularity },
+    params: { granularity, start_time: startTime, end_time: endTime },
   });
 }
 
@@ -44,8 +49,8 @@ export function updateSystemCredentials(credentials: CredentialsModel) {
   return axios.put<CredentialsModel>(ApiUrl.SystemCredentials, credentials);
 }
 
-export function runActionSyncOpenaiWebConversations() {
-  return axios.post(ApiUrl.SystemActionSyncOpenaiWebConversations);
+export function runActionSyncOpenaiWebConversations(full = true) {
+  return axios.post(ApiUrl.SystemActionSyncOpenaiWebConversations, null, { params: { full } });
 }
 
 export function SystemCheckOpenaiWebAccount() {
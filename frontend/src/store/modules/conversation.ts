@@ -23,7 +23,7 @@ const useConversationStore = defineStore('conversation', {
   getters: {},
   actions: {
     async fetchAllConversations() {
-      const result = (await getAllConversationsApi()).data;
+      const result = await getAllConversationsApi();
       this.$patch({ conversations: result });
     },
 
@@ -45,7 +45,7 @@ export interface paths {
   "/conv": {
     /**
      * Get My Conversations
-     * @description 返回自己的有效会话
+     * @description 分页返回自己的有效会话，从最近更新的开始
      */
     get: operations["get_my_conversations_conv_get"];
     /** Delete All Conversation */
@@ -56,7 +56,10 @@ export interface paths {
     get: operations["get_all_conversations_conv_all_get"];
   };
   "/conv/{conversation_id}": {
-    /** Get Conversation History */
+    /**
+     * Get Conversation History
+     * @description 返回对话历史，可只返回当前分支、省略消息 metadata 中的大字段
+     */
     get: operations["get_conversation_history_conv__conversation_id__get"];
     /**
      * Delete Conversation
@@ -229,6 +232,11 @@ export interface components {
       count: number;
       /** User Ids */
       user_ids?: (number | null)[];
+      /**
+       * User Count
+       * @default 0
+       */
+      user_count?: number;
       /** Total Queueing Time */
       total_queueing_time?: number | null;
       /** Total Ask Time */
@@ -266,6 +274,12 @@ export interface components {
       queueing_time: number | null;
       /** Ask Time */
       ask_time: number | null;
+      /** Stream Frames Sent */
+      stream_frames_sent?: number | null;
+      /** Stream Frames Merged */
+      stream_frames_merged?: number | null;
+      /** Stream Bytes Saved */
+      stream_bytes_saved?: number | null;
     };
     /** AskRequest */
     AskRequest: {
@@ -292,6 +306,30 @@ export interface components {
       openai_web_multimodal_image_parts?: components["schemas"]["OpenaiWebChatMessageMultimodalTextContentImagePart-Input"][] | null;
       /** Arkose Token */
       arkose_token?: string | null;
+      /**
+       * Accept Delta
+       * @default false
+       */
+      accept_delta?: boolean;
+    };
+    /**
+     * AskMessageDelta
+     * @description 相对于同一 id 的上一帧消息的变化
+     * text_append: 追加到正文末尾的文本（content.parts 的最后一项，或 content.text）
+     * changed: 其余发生变化的顶层字段，整体替换
+     */
+    AskMessageDelta: {
+      /**
+       * Id
+       * Format: uuid
+       */
+      id: string;
+      /** Text Append */
+      text_append?: string | null;
+      /** Changed */
+      changed?: {
+        [key: string]: unknown;
+      } | null;
     };
     /** AskResponse */
     AskResponse: {
@@ -305,14 +343,21 @@ export interface components {
       conversation_id?: string;
       /** Message */
       message?: (components["schemas"]["OpenaiWebChatMessage"] | components["schemas"]["OpenaiApiChatMessage"]) | null;
+      delta?: components["schemas"]["AskMessageDelta"] | null;
       /** Error Detail */
       error_detail?: string | null;
+      /** Queue Position */
+      queue_position?: number | null;
+      /** Estimated Wait Seconds */
+      estimated_wait_seconds?: number | null;
+      /** Retry After Seconds */
+      retry_after_seconds?: number | null;
     };
     /**
      * AskResponseType
      * @enum {string}
      */
-    AskResponseType: "waiting" | "queueing" | "message" | "error";
+    AskResponseType: "waiting" | "queueing" | "message" | "delta" | "error";
     /** AuthSetting */
     AuthSetting: {
       /**
@@ -404,6 +449,41 @@ export interface components {
       /** Metadata */
       metadata?: (components["schemas"]["OpenaiWebConversationHistoryMeta"] | components["schemas"]["OpenaiApiConversationHistoryMeta"]) | null;
     };
+    /**
+     * ConversationListItemSchema
+     * @description 对话列表中的一项，字段与 BaseConversationSchema 相同；只返回请求的字段，因此均为可选
+     */
+    ConversationListItemSchema: {
+      /** Id */
+      id?: number | null;
+      source?: components["schemas"]["ChatSourceTypes"] | null;
+      /** Conversation Id */
+      conversation_id?: string | null;
+      /** Source Id */
+      source_id?: string | null;
+      /** Title */
+      title?: string | null;
+      /** User Id */
+      user_id?: number | null;
+      /** Is Valid */
+      is_valid?: boolean | null;
+      /** Current Model */
+      current_model?: string | null;
+      /** Create Time */
+      create_time?: string | null;
+      /** Update Time */
+      update_time?: string | null;
+    };
+    /**
+     * ConversationListPage
+     * @description 按 update_time、id 从新到旧排序的一页对话；items 只包含请求的字段（fields），next_cursor 为空表示没有下一页
+     */
+    ConversationListPage: {
+      /** Items */
+      items: components["schemas"]["ConversationListItemSchema"][];
+      /** Next Cursor */
+      next_cursor?: string | null;
+    };
     /** BaseConversationSchema */
     BaseConversationSchema: {
       /**
@@ -937,6 +1017,10 @@ export interface components {
       current_model?: string | null;
       /** Metadata */
       metadata?: (components["schemas"]["OpenaiWebConversationHistoryMeta"] | components["schemas"]["OpenaiApiConversationHistoryMeta"]) | null;
+      /** Node Index */
+      node_index?: {
+        [key: string]: components["schemas"]["OpenaiApiConversationNode"];
+      } | null;
     };
     /** OpenaiApiConversationHistoryMeta */
     OpenaiApiConversationHistoryMeta: {
@@ -946,6 +1030,16 @@ export interface components {
        */
       source: "openai_api";
     };
+    /**
+     * OpenaiApiConversationNode
+     * @description 消息在对话树中的位置，提问时据此只读取上下文需要的消息
+     */
+    OpenaiApiConversationNode: {
+      /** Parent */
+      parent?: string | null;
+      /** Depth */
+      depth: number;
+    };
     /** OpenaiApiConversationSchema */
     OpenaiApiConversationSchema: {
       /**
@@ -1741,6 +1835,11 @@ export interface components {
        * @default []
        */
       user_ids: (number | null)[];
+      /**
+       * User Count
+       * @default 0
+       */
+      user_count: number;
       /** Avg Elapsed Ms */
       avg_elapsed_ms?: number | null;
     };
@@ -1821,6 +1920,11 @@ export interface components {
        * @description 在给定时间窗口内最多的请求次数
        */
       max_requests: number;
+      /**
+       * Model
+       * @description 仅统计该模型的请求；为空时统计该对话类型下所有模型的请求
+       */
+      model?: string | null;
     };
     /** UploadedFileExtraInfo */
     UploadedFileExtraInfo: {
@@ -2253,11 +2357,26 @@ export interface operations {
    * @description 返回自己的有效会话
    */
   get_my_conversations_conv_get: {
+    parameters: {
+      query?: {
+        limit?: number;
+        cursor?: string | null;
+        source?: components["schemas"]["ChatSourceTypes"] | null;
+        model?: string | null;
+        fields?: string | null;
+      };
+    };
     responses: {
       /** @description Successful Response */
       200: {
         content: {
-          "application/json": string;
+          "application/json": components["schemas"]["ConversationListPage"];
+        };
+      };
+      /** @description Validation Error */
+      422: {
+        content: {
+          "application/json": components["schemas"]["HTTPValidationError"];
         };
       };
     };
@@ -2277,14 +2396,20 @@ export interface operations {
   get_all_conversations_conv_all_get: {
     parameters: {
       query?: {
-        valid_only?: boolean;
+        limit?: number;
+        cursor?: string | null;
+        is_valid?: boolean | null;
+        user_id?: number | null;
+        source?: components["schemas"]["ChatSourceTypes"] | null;
+        model?: string | null;
+        fields?: string | null;
       };
     };
     responses: {
       /** @description Successful Response */
       200: {
         content: {
-          "application/json": string;
+          "application/json": components["schemas"]["ConversationListPage"];
         };
       };
       /** @description Validation Error */
@@ -2298,6 +2423,11 @@ export interface operations {
   /** Get Conversation History */
   get_conversation_history_conv__conversation_id__get: {
     parameters: {
+      query?: {
+        stream?: boolean;
+        current_branch_only?: boolean;
+        fields?: string | null;
+      };
       path: {
         conversation_id: string;
       };
@@ -2370,6 +2500,11 @@ export interface operations {
   /** Get Conversation History From Cache */
   get_conversation_history_from_cache_conv__conversation_id__cache_get: {
     parameters: {
+      query?: {
+        stream?: boolean;
+        current_branch_only?: boolean;
+        fields?: string | null;
+      };
       path: {
         conversation_id: unknown;
       };
@@ -2638,7 +2773,10 @@ export interface operations {
   get_request_statistics_system_stats_request_get: {
     parameters: {
       query?: {
+        start_time?: string | null;
+        end_time?: string | null;
         granularity?: number;
+        group_by_route?: boolean;
       };
     };
     responses: {
@@ -2660,6 +2798,8 @@ export interface operations {
   get_ask_statistics_system_stats_ask_get: {
     parameters: {
       query?: {
+        start_time?: string | null;
+        end_time?: string | null;
         granularity?: number;
       };
     };
@@ -47,6 +47,7 @@ export type OpenaiChatInterpreterInfo = components['schemas']['OpenaiChatInterpr
 export type BaseConversationSchema = components['schemas']['BaseConversationSchema'];
 export type OpenaiWebConversationSchema = components['schemas']['OpenaiWebConversationSchema'];
 export type OpenaiApiConversationSchema = components['schemas']['OpenaiApiConversationSchema'];
+export type ConversationListPage = components['schemas']['ConversationListPage'];
 
 export type BaseConversationHistory = components['schemas']['BaseConversationHistory'];
 export type OpenaiApiConversationHistoryDocument = components['schemas']['OpenaiApiConversationHistoryDocument'];
@@ -63,6 +64,7 @@ export type OpenaiChatFileUploadUrlRequest = components['schemas']['OpenaiChatFi
 
 export type AskRequest = components['schemas']['AskRequest'];
 export type AskResponse = components['schemas']['AskResponse'];
+export type AskMessageDelta = components['schemas']['AskMessageDelta'];
 
 export type SystemInfo = components['schemas']['SystemInfo'];
 export type RequestLogAggregation = components['schemas']['RequestLogAggregation'];
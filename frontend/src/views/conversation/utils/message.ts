@@ -1,6 +1,7 @@
 import { getFileDownloadUrlApi, getInterpreterSandboxFileDownloadUrlApi } from '@/api/conv';
 import { i18n } from '@/i18n';
 import {
+  AskMessageDelta,
   BaseChatMessage,
   ChatSourceTypes,
   OpenaiApiChatMessage,
@@ -172,6 +173,22 @@ export function modifiyTemporaryMessageContent(message: BaseChatMessage, textCon
   return message.content;
 }
 
+// 将 delta 帧应用到上一帧消息上，返回新的消息
+export function applyMessageDelta(message: BaseChatMessage, delta: AskMessageDelta): BaseChatMessage {
+  const result = { ...message, ...(delta.changed || {}) } as BaseChatMessage;
+  if (delta.text_append) {
+    const content = { ...result.content } as any;
+    if (Array.isArray(content.parts) && typeof content.parts[content.parts.length - 1] === 'string') {
+      content.parts = [...content.parts];
+      content.parts[content.parts.length - 1] += delta.text_append;
+    } else {
+      content.text = (content.text || '') + delta.text_append;
+    }
+    result.content = content;
+  }
+  return result;
+}
+
 function htmlToElement(html: string) {
   const template = document.createElement('template');
   template.innerHTML = html.trim();